@@ -0,0 +1,65 @@
+# synarere -- a highly modular and stable IRC bot.
+# Copyright (C) 2010 Michael Rodriguez.
+# Rights to this code are documented in docs/LICENSE.
+
+'''
+Benchmarks for synarere.
+
+These run from the top of the source tree, for example:
+
+    python -m bench.hotpath -o results.json
+    python -m bench.hotpath -c results.json
+    python -m bench.loadtest -u 50 -r 10 -d 30
+    python -m bench.resolver
+
+bench/loadtest.py runs the real bot against bench/fakeircd.py, a fake
+IRC server on the loopback interface, so it can't be run as root.
+'''
+
+__all__ = ['corpus', 'fakeircd', 'hotpath', 'loadtest', 'resolver']
+
+def quiet():
+    '''Set up enough of the core to run it without a configuration file.'''
+
+    # Import required Python module.
+    import logging
+
+    # Import required core modules.
+    from core import logger, var, confparse
+
+    var.log = logging.getLogger('synarere.bench')
+    var.log.addHandler(logging.StreamHandler())
+    var.log.setLevel(logging.WARNING)
+
+    logger.debug, logger.info, logger.warning = var.log.debug, var.log.info, var.log.warning
+    logger.error, logger.critical = var.log.error, var.log.critical
+
+    if var.options is None:
+        var.options = confparse.Options()
+
+def server(id='Benchnet', nick='synarere'):
+    '''Return a server dict like irc.new_server() makes.'''
+
+    return { 'id'            : id,
+             'address'       : 'irc.bench.invalid',
+             'port'          : 6667,
+             'servers'       : [('irc.bench.invalid', 6667)],
+             'current'       : 0,
+             'nick'          : nick,
+             'ident'         : 'synarere',
+             'gecos'         : 'benchmark',
+             'vhost'         : None,
+             'chans'         : ['#bench'],
+             'connected'     : True,
+             'connecting'    : False,
+             'pass'          : None,
+             'recontime'     : 0,
+             'recontime_max' : 600,
+             'tries'         : 0,
+             'attempts'      : 0,
+             'failures'      : 0,
+             'trigger'       : '.',
+             'flood_burst'   : 0,
+             'flood_rate'    : 0,
+             'ping_interval' : 60,
+             'ping_timeout'  : 150 }
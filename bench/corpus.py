@@ -0,0 +1,91 @@
+# synarere -- a highly modular and stable IRC bot.
+# Copyright (C) 2010 Michael Rodriguez.
+# Rights to this code are documented in docs/LICENSE.
+
+'''Generated IRC traffic for benchmarks.'''
+
+# Import required Python module.
+import random
+
+# Words to build messages out of.
+words = ('the', 'bot', 'is', 'down', 'again', 'who', 'broke', 'it', 'lol', 'yes',
+         'no', 'maybe', 'tomorrow', 'channel', 'server', 'ping', 'lag', 'python')
+
+# How often each kind of line shows up, out of 100.
+mix = ( ('ping',    3),
+        ('numeric', 20),
+        ('chan',    25),
+        ('chanme',  10),
+        ('ctcp',    5),
+        ('priv',    12),
+        ('chatter', 20),
+        ('misc',    5) )
+
+def commands(count):
+    '''Return the names of `count` commands, without a trigger.'''
+
+    return ['cmd%d' % i for i in xrange(count)]
+
+def generate(count, nick='synarere', users=500, chans=20, cmds=commands(50), seed=1):
+    '''Return `count` lines of server to client traffic, always the same for the same `seed`.'''
+
+    rand = random.Random(seed)
+    kinds = []
+
+    for kind, weight in mix:
+        kinds.extend([kind] * weight)
+
+    def user():
+        i = rand.randrange(users)
+        return 'user%d!ident%d@host%d.users.bench.invalid' % (i, i % 97, i)
+
+    def chan():
+        return '#chan%d' % rand.randrange(chans)
+
+    def text(least=1, most=12):
+        return ' '.join(rand.choice(words) for i in xrange(rand.randint(least, most)))
+
+    lines = []
+
+    for i in xrange(count):
+        kind = rand.choice(kinds)
+
+        if kind == 'ping':
+            lines.append('PING :irc.bench.invalid')
+        elif kind == 'numeric':
+            numeric = rand.choice(('353', '372', '005', '311', '332'))
+
+            if numeric == '353':
+                names = ' '.join('@user%d' % rand.randrange(users) for j in xrange(40))
+                lines.append(':irc.bench.invalid 353 %s = %s :%s' % (nick, chan(), names))
+            elif numeric == '005':
+                lines.append(':irc.bench.invalid 005 %s CHANTYPES=# PREFIX=(ov)@+ CASEMAPPING=rfc1459 NETWORK=Benchnet :are supported by this server' % nick)
+            elif numeric == '311':
+                lines.append(':irc.bench.invalid 311 %s user1 ident1 host1.users.bench.invalid * :%s' % (nick, text()))
+            else:
+                lines.append(':irc.bench.invalid %s %s %s :%s' % (numeric, nick, chan(), text()))
+        elif kind == 'chan':
+            lines.append(':%s PRIVMSG %s :.%s %s' % (user(), chan(), rand.choice(cmds), text(0, 5)))
+        elif kind == 'chanme':
+            lines.append(':%s PRIVMSG %s :%s: %s %s' % (user(), chan(), nick, rand.choice(cmds), text(0, 5)))
+        elif kind == 'ctcp':
+            lines.append(':%s PRIVMSG %s :\1%s\1' % (user(), nick, rand.choice(('VERSION', 'PING 1234567890'))))
+        elif kind == 'priv':
+            lines.append(':%s PRIVMSG %s :%s %s' % (user(), nick, rand.choice(cmds), text(0, 5)))
+        elif kind == 'chatter':
+            lines.append(':%s PRIVMSG %s :%s' % (user(), chan(), text()))
+        else:
+            what = rand.choice(('JOIN', 'PART', 'QUIT', 'NICK', 'MODE'))
+
+            if what == 'JOIN':
+                lines.append(':%s JOIN :%s' % (user(), chan()))
+            elif what == 'PART':
+                lines.append(':%s PART %s :%s' % (user(), chan(), text()))
+            elif what == 'QUIT':
+                lines.append(':%s QUIT :%s' % (user(), text()))
+            elif what == 'NICK':
+                lines.append(':%s NICK :newnick%d' % (user(), rand.randrange(users)))
+            else:
+                lines.append(':%s MODE %s +o user%d' % (user(), chan(), rand.randrange(users)))
+
+    return lines
@@ -0,0 +1,446 @@
+# synarere -- a highly modular and stable IRC bot.
+# Copyright (C) 2010 Michael Rodriguez.
+# Rights to this code are documented in docs/LICENSE.
+
+'''
+A stand-in IRC server for load tests.
+
+It speaks just enough of the protocol for a client to register, join
+channels and exchange PRIVMSG. On top of that it can play a number of
+users flooding a channel with commands, send large NAMES and LIST
+bursts, and read slowly from its clients to build up their send queues.
+
+Every command sent by a simulated user carries a sequence number. The
+bot under test is expected to answer with `bench <number>` to the same
+channel, which is how round trip times are measured.
+
+Run on its own, it just serves until interrupted:
+
+    python -m bench.fakeircd -p 6667 -u 50 -r 2
+'''
+
+# Import required Python modules.
+import asyncore, errno, getopt, os, socket, sys, time
+from collections import deque
+
+# The name we go by.
+name = 'fake.ircd.invalid'
+
+class Client(asyncore.dispatcher):
+    '''A client connected to the fake server.'''
+
+    def __init__(self, sock, ircd):
+        asyncore.dispatcher.__init__(self, sock, map=ircd.map)
+
+        self.ircd = ircd
+        self.nick = None
+        self.ident = None
+        self.registered = False
+        self.chans = set()
+
+        self.inbuf = ''
+        self.outbuf = deque()
+        self.outoff = 0
+
+        # Bytes we're still allowed to read, when reading slowly.
+        # A small receive buffer makes the client feel it sooner.
+        self.allowance = ircd.read_rate
+
+        if ircd.read_rate:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+
+        # Lines and bytes in both directions.
+        self.lines_in = self.lines_out = 0
+        self.bytes_in = self.bytes_out = 0
+
+    def send_line(self, line):
+        '''Queue `line` for the client.'''
+
+        self.outbuf.append(line + '\r\n')
+        self.lines_out += 1
+
+    def numeric(self, num, text):
+        '''Send numeric `num` to the client.'''
+
+        self.send_line(':%s %s %s %s' % (name, num, self.nick or '*', text))
+
+    def readable(self):
+        return not self.ircd.read_rate or self.allowance > 0
+
+    def writable(self):
+        return bool(self.outbuf)
+
+    def handle_read(self):
+        size = 4096
+
+        if self.ircd.read_rate:
+            size = max(1, min(size, int(self.allowance)))
+
+        try:
+            data = self.recv(size)
+        except socket.error, why:
+            if why.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+
+            raise
+
+        if not data:
+            return
+
+        self.bytes_in += len(data)
+
+        if self.ircd.read_rate:
+            self.allowance -= len(data)
+
+        lines = (self.inbuf + data).split('\n')
+        self.inbuf = lines.pop()
+
+        for line in lines:
+            line = line.rstrip('\r')
+
+            if line:
+                self.lines_in += 1
+                self.handle_line(line)
+
+    def handle_write(self):
+        # Pack what's waiting into one write.
+        if len(self.outbuf) > 1:
+            data = ''.join(self.outbuf)
+            self.outbuf.clear()
+            self.outbuf.append(data)
+
+        data = self.outbuf[0]
+        sent = self.send(buffer(data, self.outoff))
+        self.bytes_out += sent
+        self.outoff += sent
+
+        if self.outoff >= len(data):
+            self.outbuf.popleft()
+            self.outoff = 0
+
+    def handle_close(self):
+        self.close()
+
+        if self in self.ircd.clients:
+            self.ircd.clients.remove(self)
+
+    def handle_error(self):
+        # Whatever went wrong, we don't want to take the whole test down.
+        exc = sys.exc_info()[1]
+        print >> sys.stderr, 'fakeircd: dropping %s: %s' % (self.nick or 'unregistered client', exc)
+        self.handle_close()
+
+    def handle_line(self, line):
+        '''Act on one line from the client.'''
+
+        if line.startswith(':'):
+            line = line.partition(' ')[2]
+
+        head, colon, trailing = line.partition(' :')
+        parv = head.split()
+
+        if colon:
+            parv.append(trailing)
+
+        if not parv:
+            return
+
+        cmd = parv[0].upper()
+        parv = parv[1:]
+
+        if cmd == 'NICK' and parv:
+            self.nick = parv[0]
+            self.welcome()
+        elif cmd == 'USER' and parv:
+            self.ident = parv[0]
+            self.welcome()
+        elif cmd == 'PING':
+            self.send_line(':%s PONG %s :%s' % (name, name, parv[-1] if parv else ''))
+        elif cmd == 'PONG':
+            pass
+        elif not self.registered:
+            self.numeric('451', ':You have not registered')
+        elif cmd == 'JOIN' and parv:
+            for chan in parv[0].split(','):
+                self.join(chan)
+        elif cmd == 'PART' and parv:
+            for chan in parv[0].split(','):
+                self.chans.discard(chan)
+                self.send_line(':%s PART %s' % (self.mask(), chan))
+        elif cmd in ('PRIVMSG', 'NOTICE') and len(parv) > 1:
+            self.ircd.reply(self, parv[0], parv[-1])
+        elif cmd == 'NAMES' and parv:
+            self.names(parv[0])
+        elif cmd == 'LIST':
+            self.list()
+        elif cmd == 'QUIT':
+            self.send_line('ERROR :Closing Link: %s (Quit)' % self.nick)
+            self.handle_close()
+
+    def mask(self):
+        '''Return our nick!user@host.'''
+
+        return '%s!%s@127.0.0.1' % (self.nick, self.ident)
+
+    def welcome(self):
+        '''Finish registration once we have both NICK and USER.'''
+
+        if self.registered or not self.nick or not self.ident:
+            return
+
+        self.registered = True
+
+        self.numeric('001', ':Welcome to the fake IRC network %s' % self.mask())
+        self.numeric('002', ':Your host is %s, running fakeircd' % name)
+        self.numeric('003', ':This server was created just now')
+        self.numeric('004', '%s fakeircd iowghraAsORTVSxNCWqBzvdHtGp lvhopsmntikrRcaqOALQbSeIKVfMCuzNTGjZ' % name)
+        self.numeric('005', 'CHANTYPES=# PREFIX=(ov)@+ CASEMAPPING=rfc1459 NETWORK=Fakenet :are supported by this server')
+        self.numeric('375', ':- %s Message of the Day -' % name)
+        self.numeric('372', ':- This server exists to be flooded.')
+        self.numeric('376', ':End of /MOTD command.')
+
+    def join(self, chan):
+        '''Put the client in `chan`.'''
+
+        if chan in self.chans:
+            return
+
+        self.chans.add(chan)
+        self.send_line(':%s JOIN :%s' % (self.mask(), chan))
+        self.numeric('332', '%s :Load test in progress' % chan)
+        self.names(chan)
+
+        if self.ircd.list_size:
+            self.list()
+
+    def names(self, chan):
+        '''Send a NAMES reply for `chan`, with every simulated user in it.'''
+
+        nicks = [self.nick] + ['%suser%d' % ('@' if i % 10 == 0 else '', i) for i in xrange(self.ircd.names_size)]
+        prefix = ':%s 353 %s = %s :' % (name, self.nick, chan)
+        line = []
+
+        for nick in nicks:
+            # Keep well under the line length limit.
+            if line and len(prefix) + sum(len(n) + 1 for n in line) + len(nick) > 400:
+                self.send_line(prefix + ' '.join(line))
+                line = []
+
+            line.append(nick)
+
+        if line:
+            self.send_line(prefix + ' '.join(line))
+
+        self.numeric('366', '%s :End of /NAMES list.' % chan)
+
+    def list(self):
+        '''Send a LIST reply with `list_size` made up channels.'''
+
+        self.numeric('321', 'Channel :Users  Name')
+
+        for i in xrange(self.ircd.list_size):
+            self.numeric('322', '#chan%d %d :[+nt] Channel number %d of a big network' % (i, i % 500, i))
+
+        self.numeric('323', ':End of /LIST')
+
+class Server(asyncore.dispatcher):
+    '''
+    The fake IRC server.
+
+    users     -- How many simulated users send commands.
+    rate      -- How many commands each of them sends per second.
+    names     -- How many simulated users are in every channel (NAMES burst).
+    list      -- How many channels LIST returns. Sent after every JOIN too.
+    read_rate -- Read at most this many bytes a second from each client (0 is unlimited).
+    chan      -- The channel the simulated users flood.
+    trigger   -- The command the simulated users send, the sequence number follows.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=0, users=10, rate=1.0, names=0, list=0, read_rate=0, chan='#bench', trigger='.bench'):
+        # Keep our sockets apart from anything else using asyncore.
+        self.map = {}
+
+        asyncore.dispatcher.__init__(self, map=self.map)
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(16)
+
+        self.address = self.socket.getsockname()
+        self.clients = []
+
+        self.users = users
+        self.rate = rate
+        self.names_size = names
+        self.list_size = list
+        self.read_rate = read_rate
+        self.chan = chan
+        self.trigger = trigger
+
+        # Sequence number to the time it was sent, for commands not answered yet.
+        self.pending = {}
+        self.seq = 0
+        self.sent = 0
+        self.latencies = []
+        self.unknown_replies = 0
+
+        self.flooding = False
+        self.next_send = 0
+        self.last_tick = time.time()
+
+    def handle_accept(self):
+        pair = self.accept()
+
+        if pair:
+            self.clients.append(Client(pair[0], self))
+
+    def joined(self):
+        '''Return the registered clients in the flooded channel.'''
+
+        return [c for c in self.clients if c.registered and self.chan in c.chans]
+
+    def start(self):
+        '''Start flooding.'''
+
+        self.flooding = True
+        self.next_send = time.time()
+
+    def stop(self):
+        '''Stop flooding.'''
+
+        self.flooding = False
+
+    def reply(self, client, target, text):
+        '''Called for every PRIVMSG and NOTICE a client sends.'''
+
+        word, _, rest = text.partition(' ')
+
+        if word != 'bench':
+            return
+
+        try:
+            sent = self.pending.pop(int(rest.split()[0]))
+        except (ValueError, IndexError, KeyError):
+            self.unknown_replies += 1
+            return
+
+        self.latencies.append(time.time() - sent)
+
+    def tick(self):
+        '''Send whatever is due and top up slow readers.'''
+
+        now = time.time()
+
+        if self.read_rate:
+            for client in self.clients:
+                client.allowance = min(self.read_rate, client.allowance + self.read_rate * (now - self.last_tick))
+
+        self.last_tick = now
+
+        if not self.flooding or not self.users or not self.rate:
+            return
+
+        targets = self.joined()
+
+        # Nobody to send to yet, so don't fall behind either.
+        if not targets:
+            self.next_send = now
+            return
+
+        while self.next_send <= now:
+            self.next_send += 1.0 / (self.users * self.rate)
+
+            user = self.seq % self.users
+            line = ':user%d!ident%d@host%d.users.bench.invalid PRIVMSG %s :%s %d' % (user, user % 97, user, self.chan, self.trigger, self.seq)
+
+            for client in targets:
+                client.send_line(line)
+
+            self.pending[self.seq] = time.time()
+            self.seq += 1
+            self.sent += 1
+
+    def timeout(self):
+        '''How long the next poll may block.'''
+
+        if not self.flooding:
+            return 0.05
+
+        return max(0, min(0.05, self.next_send - time.time()))
+
+    def run(self, seconds=None, until=None):
+        '''Serve for `seconds`, or forever. Returns early once `until()` is true.'''
+
+        end = time.time() + seconds if seconds is not None else None
+
+        while end is None or time.time() < end:
+            if until and until():
+                return True
+
+            self.tick()
+            asyncore.loop(timeout=self.timeout(), use_poll=True, map=self.map, count=1)
+
+        return bool(until and until())
+
+    def shutdown(self):
+        '''Close every socket.'''
+
+        for client in list(self.clients):
+            client.close()
+
+        self.clients = []
+        self.close()
+
+def print_help():
+    '''Output command line options and their meanings.'''
+
+    print '-p (--port) <port>: Port to listen on (default 6667).'
+    print '-u (--users) <count>: How many users flood the channel (default 10).'
+    print '-r (--rate) <rate>: Commands per second each user sends (default 1).'
+    print '-N (--names) <count>: How many users are in each channel (default 0).'
+    print '-l (--list) <count>: How many channels LIST returns (default 0).'
+    print '-s (--slow) <bytes>: Read at most this many bytes a second from each client.'
+    print '-h (--help): Output this message.'
+
+def main(argv=sys.argv[1:]):
+    '''Our entry point.'''
+
+    port, users, rate, names, channels, read_rate = 6667, 10, 1.0, 0, 0, 0
+
+    try:
+        opts, args = getopt.getopt(argv, 'p:u:r:N:l:s:h', ['port=', 'users=', 'rate=', 'names=', 'list=', 'slow=', 'help'])
+    except getopt.GetoptError, err:
+        print >> sys.stderr, '%s\n' % err
+        print_help()
+        sys.exit(os.EX_USAGE)
+
+    for opt, arg in opts:
+        if opt in ('-p', '--port'):
+            port = int(arg)
+        elif opt in ('-u', '--users'):
+            users = int(arg)
+        elif opt in ('-r', '--rate'):
+            rate = float(arg)
+        elif opt in ('-N', '--names'):
+            names = int(arg)
+        elif opt in ('-l', '--list'):
+            channels = int(arg)
+        elif opt in ('-s', '--slow'):
+            read_rate = int(arg)
+        elif opt in ('-h', '--help'):
+            print_help()
+            sys.exit(os.EX_OK)
+
+    ircd = Server(port=port, users=users, rate=rate, names=names, list=channels, read_rate=read_rate)
+    ircd.start()
+
+    print 'fakeircd: listening on %s:%d' % ircd.address
+
+    try:
+        ircd.run()
+    except KeyboardInterrupt:
+        ircd.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+# synarere -- a highly modular and stable IRC bot.
+# Copyright (C) 2010 Michael Rodriguez.
+# Rights to this code are documented in docs/LICENSE.
+
+'''
+Micro-benchmarks for the receive, parse and dispatch hot path.
+
+A generated corpus is fed through a Connection which has no socket,
+with a realistic number of handlers registered. Every stage is timed
+on its own, and the results can be saved as JSON and compared against
+an earlier run.
+'''
+
+# Import required Python modules.
+import gc, getopt, json, os, platform, resource, subprocess, sys, time
+
+# Make the core importable when run as `python bench/hotpath.py`.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Import required benchmark modules.
+import bench
+from bench import corpus
+
+# Import required core modules.
+from core import irc, command, event, framing, message
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+def noop(*args):
+    '''A handler which does nothing, so we only measure the core.'''
+
+def register(cmds):
+    '''Register handlers the way a bot with a bunch of modules would have them.'''
+
+    for name in cmds:
+        for func in (noop, lambda *args: None):
+            command.add('.' + name, func, command.chan)
+            command.add(name, func, command.chanme)
+            command.add(name, func, command.priv)
+
+    for name in ('VERSION', 'PING'):
+        command.add(name, noop, command.ctcp)
+
+    for name in ('JOIN', 'PART', 'QUIT', 'NICK', 'MODE', '353', '005'):
+        command.add(name, noop, command.irc)
+
+    for name in ('OnParse', 'OnPING', 'OnJoinChannel'):
+        event.attach(name, noop)
+
+def best(func, repeat):
+    '''Return the best time of `repeat` calls to `func`.'''
+
+    times = []
+
+    for i in xrange(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+
+    return min(times)
+
+def allocations(func):
+    '''Measure what one call to `func` allocates.'''
+
+    gc.collect()
+
+    if tracemalloc:
+        tracemalloc.start()
+        func()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return { 'peak_bytes' : peak, 'retained_bytes' : current }
+
+    # Python 2 can't trace allocations, so count the objects left behind.
+    before = len(gc.get_objects())
+    func()
+    return { 'retained_objects' : len(gc.get_objects()) - before }
+
+def stages(lines):
+    '''Build the benchmark stages. Returns (name, function, units per call).'''
+
+    server = bench.server()
+    conn = irc.Connection(server)
+    data = ''.join(line + '\r\n' for line in lines)
+
+    def frame():
+        buf = framing.LineBuffer()
+        pos = 0
+
+        while pos < len(data):
+            view = buf.space()
+            chunk = data[pos:pos + len(view)]
+            view[:len(chunk)] = chunk
+            buf.commit(len(chunk))
+            pos += len(chunk)
+
+    def parse():
+        for line in lines:
+            message.parse(line)
+
+    def connection():
+        conn.recvq.extend(lines)
+        conn.parse()
+        conn.sendq.clear()
+
+    calls = 10000
+    who = ('user1', 'ident1', 'host1.users.bench.invalid')
+
+    def dispatch_command():
+        for i in xrange(calls):
+            command.dispatch(False, command.chan, '.CMD1', conn, who, '#chan1', 'some arguments')
+
+    def dispatch_event():
+        for i in xrange(calls):
+            event.dispatch('OnParse', server, 'line')
+
+    def dispatch_idle_event():
+        for i in xrange(calls):
+            event.dispatch('OnNobodyListens', server, 'line')
+
+    return ( ('framing',             frame,               len(lines)),
+             ('message.parse',       parse,               len(lines)),
+             ('Connection.parse',    connection,          len(lines)),
+             ('command.dispatch',    dispatch_command,    calls),
+             ('event.dispatch',      dispatch_event,      calls),
+             ('event.dispatch.idle', dispatch_idle_event, calls) )
+
+def revision():
+    '''Return the git commit we're running, if we can find out.'''
+
+    try:
+        return subprocess.Popen(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=open(os.devnull, 'w')).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+def run(count, repeat):
+    '''Run every stage and return the results.'''
+
+    bench.quiet()
+
+    cmds = corpus.commands(50)
+    lines = corpus.generate(count, cmds=cmds)
+    register(cmds)
+
+    results = { 'revision' : revision(),
+                'python'   : platform.python_version(),
+                'time'     : time.time(),
+                'lines'    : count,
+                'repeat'   : repeat,
+                'stages'   : {} }
+
+    for name, func, units in stages(lines):
+        # Warm up first.
+        func()
+
+        elapsed = best(func, repeat)
+
+        stage = { 'seconds'     : elapsed,
+                  'per_second'  : units / elapsed if elapsed else None,
+                  'usec_per_op' : elapsed / units * 1e6 }
+
+        stage.update(allocations(func))
+        results['stages'][name] = stage
+
+    results['maxrss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return results
+
+def report(results, baseline=None):
+    '''Print the results, next to `baseline` if given.'''
+
+    print 'synarere hot path: %d lines, best of %d, revision %s, Python %s' % (results['lines'], results['repeat'], (results['revision'] or 'unknown')[:12], results['python'])
+
+    for name in sorted(results['stages']):
+        stage = results['stages'][name]
+        line = '  %-20s %12.0f/s %9.3f usec/op' % (name, stage['per_second'] or 0, stage['usec_per_op'])
+
+        if baseline and name in baseline['stages']:
+            old = baseline['stages'][name]['usec_per_op']
+            line += '  (%+.1f%% vs %s)' % ((stage['usec_per_op'] - old) / old * 100, (baseline['revision'] or 'baseline')[:12])
+
+        print line
+
+def print_help():
+    '''Output command line options and their meanings.'''
+
+    print '-n (--lines) <count>: How many corpus lines to generate (default 20000).'
+    print '-r (--repeat) <count>: How many times to run each stage (default 5).'
+    print '-o (--output) <file>: Save the results as JSON.'
+    print '-c (--compare) <file>: Compare against results saved earlier.'
+    print '-h (--help): Output this message.'
+
+def main(argv=sys.argv[1:]):
+    '''Our entry point.'''
+
+    count, repeat, output, baseline = 20000, 5, None, None
+
+    try:
+        opts, args = getopt.getopt(argv, 'n:r:o:c:h', ['lines=', 'repeat=', 'output=', 'compare=', 'help'])
+    except getopt.GetoptError, err:
+        print >> sys.stderr, '%s\n' % err
+        print_help()
+        sys.exit(os.EX_USAGE)
+
+    for opt, arg in opts:
+        if opt in ('-n', '--lines'):
+            count = int(arg)
+        elif opt in ('-r', '--repeat'):
+            repeat = int(arg)
+        elif opt in ('-o', '--output'):
+            output = arg
+        elif opt in ('-c', '--compare'):
+            baseline = json.load(open(arg))
+        elif opt in ('-h', '--help'):
+            print_help()
+            sys.exit(os.EX_OK)
+
+    results = run(count, repeat)
+    report(results, baseline)
+
+    if output:
+        fh = open(output, 'w')
+        json.dump(results, fh, indent=2, sort_keys=True)
+        fh.close()
+
+if __name__ == '__main__':
+    main()
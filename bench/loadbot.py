@@ -0,0 +1,64 @@
+# synarere -- a highly modular and stable IRC bot.
+# Copyright (C) 2010 Michael Rodriguez.
+# Rights to this code are documented in docs/LICENSE.
+
+'''
+The module bench/loadtest.py loads into the bot under test.
+
+It answers `.bench <number>` with `bench <number>`, and every so often
+writes how deep the send and receive queues are to the file named by
+the SYNARERE_LOADTEST_STATS environment variable.
+'''
+
+# Import required Python modules.
+import os, time
+
+# Import required source modules.
+from core import command, timer, var
+
+# How often we sample the queues.
+interval = 0.1
+
+stats_file, stats_timer = None, None
+
+def chan_bench(conn, (nick, user, host), target, message):
+    '''Handle the .bench channel command.'''
+
+    conn.privmsg(target, 'bench %s' % message)
+
+def sample(args):
+    '''Write one line of queue depths: time, sendq lines, unsent bytes, recvq lines.'''
+
+    sendq = sendbuf = recvq = 0
+
+    for conn in var.conns:
+        if hasattr(conn, 'sendq'):
+            sendq += len(conn.sendq)
+            sendbuf += len(conn.sendbuf) - conn.sendoff
+            recvq += len(conn.recvq)
+
+    stats_file.write('%f %d %d %d\n' % (time.time(), sendq, sendbuf, recvq))
+    stats_file.flush()
+
+def module_init():
+    '''Module entry point.'''
+
+    global stats_file, stats_timer
+
+    command.add('.bench', chan_bench, command.chan)
+
+    if os.environ.get('SYNARERE_LOADTEST_STATS'):
+        stats_file = open(os.environ['SYNARERE_LOADTEST_STATS'], 'a')
+        stats_timer = timer.add('loadbot.sample', False, sample, interval)
+
+def module_fini():
+    '''Module exit point.'''
+
+    global stats_file, stats_timer
+
+    command.delete('.bench', chan_bench, command.chan)
+
+    if stats_timer:
+        timer.cancel(stats_timer)
+        stats_file.close()
+        stats_file = stats_timer = None
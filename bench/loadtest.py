@@ -0,0 +1,288 @@
+# synarere -- a highly modular and stable IRC bot.
+# Copyright (C) 2010 Michael Rodriguez.
+# Rights to this code are documented in docs/LICENSE.
+
+'''
+End to end load test.
+
+Starts the fake IRC server from bench/fakeircd.py, runs synarere in
+the foreground (-n) against it with bench/loadbot.py loaded, floods it
+with commands and reports command round trip times, how deep the send
+queue got and how much CPU the bot used per line it received.
+'''
+
+# Import required Python modules.
+import getopt, json, os, platform, shutil, signal, subprocess, sys, tempfile, time
+
+# Make the benchmarks importable when run as `python bench/loadtest.py`.
+top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, top)
+
+# Import required benchmark modules.
+from bench import fakeircd, hotpath
+
+config = '''network:
+        id = Loadnet
+        address = %(host)s
+        port = %(port)d
+        nick = synarere
+        ident = synarere
+        gecos = load test
+        chans = %(chan)s
+        trigger = .
+%(flood)s
+module:
+        name = %(module)s
+
+logger:
+        path = %(dir)s/synarere.log
+        level = warning
+        max_size = 0
+        max_logs = 0
+        format = [%%(asctime)s] -- %%(levelname)s: %%(message)s
+        stream_format = [%%(asctime)s] -- %%(levelname)s: %%(message)s
+
+options:
+        pidfile = %(dir)s/synarere.pid
+        tbfile = %(dir)s/synarere.tb
+%(options)s
+'''
+
+def write_config(path, ircd, burst, rate, options):
+    '''Write the configuration the bot under test runs with.'''
+
+    flood = ''
+
+    if rate:
+        flood = '        flood_burst = %d\n        flood_rate = %s\n' % (burst, rate)
+
+    fh = open(path, 'w')
+    fh.write(config % { 'host'    : ircd.address[0],
+                        'port'    : ircd.address[1],
+                        'chan'    : ircd.chan,
+                        'flood'   : flood,
+                        'module'  : os.path.join(top, 'bench', 'loadbot.py'),
+                        'dir'     : os.path.dirname(path),
+                        'options' : ''.join('        %s = %s\n' % pair for pair in options) })
+    fh.close()
+
+def cpu_time(pid):
+    '''Return the CPU seconds `pid` has used so far, or None if we can't tell.'''
+
+    try:
+        fields = open('/proc/%d/stat' % pid).read().rpartition(')')[2].split()
+    except IOError:
+        return None
+
+    # utime and stime, fields 14 and 15 counting from the pid.
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+def percentile(values, pct):
+    '''Return the `pct`th percentile of sorted `values`.'''
+
+    if not values:
+        return None
+
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+def read_samples(path):
+    '''Read the queue samples written by bench/loadbot.py.'''
+
+    samples = []
+
+    try:
+        for line in open(path):
+            fields = line.split()
+
+            if len(fields) == 4:
+                samples.append((float(fields[0]), int(fields[1]), int(fields[2]), int(fields[3])))
+    except IOError:
+        pass
+
+    return samples
+
+def depth(samples, start, end, field):
+    '''Summarise one column of the queue samples taken between `start` and `end`.'''
+
+    values = sorted(s[field] for s in samples if start <= s[0] <= end)
+
+    if not values:
+        return None
+
+    return { 'max'  : values[-1],
+             'mean' : sum(values) / float(len(values)),
+             'p99'  : percentile(values, 99) }
+
+def run(users, rate, duration, names, channels, read_rate, burst, flood_rate, options, drain, keep):
+    '''Run one load test and return the results.'''
+
+    tmp = tempfile.mkdtemp(prefix='synarere-loadtest.')
+    ircd = fakeircd.Server(users=users, rate=rate, names=names, list=channels, read_rate=read_rate)
+    proc = None
+
+    try:
+        conf = os.path.join(tmp, 'synarere.conf')
+        stats = os.path.join(tmp, 'stats')
+        output = open(os.path.join(tmp, 'output'), 'w+')
+
+        write_config(conf, ircd, burst, flood_rate, options)
+
+        env = dict(os.environ, SYNARERE_LOADTEST_STATS=stats)
+        proc = subprocess.Popen([sys.executable, os.path.join(top, 'synarere.py'), '-n', '-c', conf], cwd=top, env=env, stdout=output, stderr=subprocess.STDOUT)
+
+        # Wait for the bot to register and join.
+        if not ircd.run(30, lambda: ircd.joined() or proc.poll() is not None) or proc.poll() is not None:
+            output.seek(0)
+            raise RuntimeError('the bot never joined %s:\n%s' % (ircd.chan, output.read()[-2000:]))
+
+        # Let it digest the NAMES and LIST bursts before we start counting.
+        ircd.run(1)
+
+        client = ircd.joined()[0]
+        cpu_before, lines_before = cpu_time(proc.pid), client.lines_out
+
+        ircd.start()
+        start = time.time()
+        ircd.run(duration, lambda: proc.poll() is not None)
+        ircd.stop()
+        end = time.time()
+
+        # Give it a chance to answer whatever is still queued.
+        ircd.run(drain, lambda: not ircd.pending or proc.poll() is not None)
+
+        cpu_after, lines = cpu_time(proc.pid), client.lines_out - lines_before
+    finally:
+        ircd.shutdown()
+
+        if proc and proc.poll() is None:
+            os.kill(proc.pid, signal.SIGTERM)
+            proc.wait()
+
+        samples = read_samples(os.path.join(tmp, 'stats'))
+
+        if keep:
+            print 'loadtest: files kept in %s' % tmp
+        else:
+            shutil.rmtree(tmp, True)
+
+    latencies = sorted(ircd.latencies)
+    cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+
+    return { 'revision'  : hotpath.revision(),
+             'python'    : platform.python_version(),
+             'time'      : start,
+             'params'    : { 'users'      : users,
+                             'rate'       : rate,
+                             'duration'   : duration,
+                             'names'      : names,
+                             'list'       : channels,
+                             'read_rate'  : read_rate,
+                             'flood_rate' : flood_rate,
+                             'options'    : dict(options) },
+             'sent'      : ircd.sent,
+             'answered'  : len(latencies),
+             'lost'      : len(ircd.pending),
+             'per_second': len(latencies) / (end - start),
+             'latency_ms': dict((name, percentile(latencies, pct) * 1000 if latencies else None)
+                                for name, pct in (('p50', 50), ('p90', 90), ('p99', 99), ('max', 100))),
+             'sendq'     : { 'lines' : depth(samples, start, end + drain, 1),
+                             'bytes' : depth(samples, start, end + drain, 2) },
+             'recvq'     : depth(samples, start, end + drain, 3),
+             'lines_in'  : lines,
+             'cpu'       : { 'seconds'       : cpu,
+                             'usec_per_line' : cpu / lines * 1e6 if cpu is not None and lines else None,
+                             'usec_per_cmd'  : cpu / ircd.sent * 1e6 if cpu is not None and ircd.sent else None } }
+
+def report(results):
+    '''Print the results.'''
+
+    def ms(value):
+        return '%.2fms' % value if value is not None else 'n/a'
+
+    params = results['params']
+    print 'synarere load test: %d users at %g cmd/s for %gs, revision %s, Python %s' % (params['users'], params['rate'], params['duration'], (results['revision'] or 'unknown')[:12], results['python'])
+    print '  commands: %d sent, %d answered, %d lost (%.0f/s)' % (results['sent'], results['answered'], results['lost'], results['per_second'])
+    print '  latency:  p50 %s  p90 %s  p99 %s  max %s' % tuple(ms(results['latency_ms'][k]) for k in ('p50', 'p90', 'p99', 'max'))
+
+    for name, value in (('sendq', results['sendq']['lines']), ('sendbuf', results['sendq']['bytes']), ('recvq', results['recvq'])):
+        if value:
+            print '  %-9s max %d  mean %.1f  p99 %d' % (name + ':', value['max'], value['mean'], value['p99'])
+
+    cpu = results['cpu']
+
+    if cpu['seconds'] is not None:
+        print '  cpu:      %.3fs, %.1f usec/line received, %.1f usec/command' % (cpu['seconds'], cpu['usec_per_line'] or 0, cpu['usec_per_cmd'] or 0)
+
+def print_help():
+    '''Output command line options and their meanings.'''
+
+    print '-u (--users) <count>: How many users flood the channel (default 20).'
+    print '-r (--rate) <rate>: Commands per second each user sends (default 5).'
+    print '-d (--duration) <seconds>: How long to flood for (default 10).'
+    print '-N (--names) <count>: How many users are in the channel (default 1000).'
+    print '-l (--list) <count>: How many channels the LIST burst has (default 0).'
+    print '-s (--slow) <bytes>: Have the server read at most this many bytes a second.'
+    print '-b (--flood-burst) <lines>: The bot\'s flood_burst (default 5).'
+    print '-f (--flood-rate) <rate>: The bot\'s flood_rate (default no flood control).'
+    print '-O (--option) <name=value>: Set an option in the bot\'s options block.'
+    print '-k (--keep): Keep the configuration, log and samples around.'
+    print '-o (--output) <file>: Save the results as JSON.'
+    print '-h (--help): Output this message.'
+
+def main(argv=sys.argv[1:]):
+    '''Our entry point.'''
+
+    users, rate, duration, names, channels, read_rate = 20, 5.0, 10.0, 1000, 0, 0
+    burst, flood_rate, options, keep, output = 5, 0, [], False, None
+
+    try:
+        opts, args = getopt.getopt(argv, 'u:r:d:N:l:s:b:f:O:ko:h', ['users=', 'rate=', 'duration=', 'names=', 'list=', 'slow=',
+                                                                   'flood-burst=', 'flood-rate=', 'option=', 'keep', 'output=', 'help'])
+    except getopt.GetoptError, err:
+        print >> sys.stderr, '%s\n' % err
+        print_help()
+        sys.exit(os.EX_USAGE)
+
+    for opt, arg in opts:
+        if opt in ('-u', '--users'):
+            users = int(arg)
+        elif opt in ('-r', '--rate'):
+            rate = float(arg)
+        elif opt in ('-d', '--duration'):
+            duration = float(arg)
+        elif opt in ('-N', '--names'):
+            names = int(arg)
+        elif opt in ('-l', '--list'):
+            channels = int(arg)
+        elif opt in ('-s', '--slow'):
+            read_rate = int(arg)
+        elif opt in ('-b', '--flood-burst'):
+            burst = int(arg)
+        elif opt in ('-f', '--flood-rate'):
+            flood_rate = float(arg)
+        elif opt in ('-O', '--option'):
+            name, _, value = arg.partition('=')
+            options.append((name.strip(), value.strip()))
+        elif opt in ('-k', '--keep'):
+            keep = True
+        elif opt in ('-o', '--output'):
+            output = arg
+        elif opt in ('-h', '--help'):
+            print_help()
+            sys.exit(os.EX_OK)
+
+    try:
+        results = run(users, rate, duration, names, channels, read_rate, burst, flood_rate, options, 10.0, keep)
+    except RuntimeError, e:
+        print >> sys.stderr, 'loadtest: %s' % e
+        sys.exit(os.EX_SOFTWARE)
+
+    report(results)
+
+    if output:
+        fh = open(output, 'w')
+        json.dump(results, fh, indent=2, sort_keys=True)
+        fh.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# synarere -- a highly modular and stable IRC bot.
+# Copyright (C) 2010 Michael Rodriguez.
+# Rights to this code are documented in docs/LICENSE.
+
+'''
+Check that name lookups run side by side.
+
+getaddrinfo() is replaced by one which takes `delay` seconds, and
+`count` different names are looked up at once through core/resolver.py,
+the way connect_to_all() does for every network. With enough lookup
+threads, that should take about `delay` times the number of rounds
+resolver.max_threads needs, not `delay` times `count`. Exits with a
+failure status if it doesn't.
+'''
+
+# Import required Python modules.
+import getopt, os, socket, sys, threading, time
+
+# Make the core importable when run as `python bench/resolver.py`.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Import required benchmark module.
+import bench
+
+# Import required core modules.
+from core import io, resolver
+
+def slow_getaddrinfo(delay, used):
+    '''
+    Make a getaddrinfo() which takes `delay` seconds and always answers
+    127.0.0.1, adding the name of every thread calling it to `used`.
+    '''
+
+    def getaddrinfo(host, port, family=0, socktype=0, proto=0, flags=0):
+        used.add(threading.currentThread().getName())
+        time.sleep(delay)
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('127.0.0.1', port))]
+
+    return getaddrinfo
+
+def run(count, delay):
+    '''Look up `count` names at once. Returns (seconds taken, names of the threads used).'''
+
+    bench.quiet()
+    io.init()
+
+    used, answers = set(), []
+    real, socket.getaddrinfo = socket.getaddrinfo, slow_getaddrinfo(delay, used)
+
+    def answered(addresses, error):
+        answers.append(error)
+
+    try:
+        start = time.time()
+
+        for i in xrange(count):
+            resolver.resolve('host%d.bench.invalid' % i, 6667, answered)
+
+        while len(answers) < count and time.time() - start < delay * count + 5:
+            io.poll(0.1)
+            io.run_calls()
+
+        elapsed = time.time() - start
+    finally:
+        socket.getaddrinfo = real
+
+    if len(answers) < count:
+        raise RuntimeError('only %d of %d lookups were answered' % (len(answers), count))
+
+    return elapsed, used
+
+def print_help():
+    '''Output command line options and their meanings.'''
+
+    print '-n (--names) <count>: How many names to look up at once (default 8).'
+    print '-d (--delay) <seconds>: How long each lookup takes (default 0.5).'
+    print '-h (--help): Output this message.'
+
+def main(argv=sys.argv[1:]):
+    '''Our entry point.'''
+
+    count, delay = 8, 0.5
+
+    try:
+        opts, args = getopt.getopt(argv, 'n:d:h', ['names=', 'delay=', 'help'])
+    except getopt.GetoptError, err:
+        print >> sys.stderr, '%s\n' % err
+        print_help()
+        sys.exit(os.EX_USAGE)
+
+    for opt, arg in opts:
+        if opt in ('-n', '--names'):
+            count = int(arg)
+        elif opt in ('-d', '--delay'):
+            delay = float(arg)
+        elif opt in ('-h', '--help'):
+            print_help()
+            sys.exit(os.EX_OK)
+
+    elapsed, used = run(count, delay)
+
+    # Every round of lookups takes `delay`, and a round is max_threads of them.
+    rounds = -(-count // resolver.max_threads)
+    expected = rounds * delay
+
+    print 'synarere resolver: %d lookups of %.2fs each took %.2fs on %d thread%s (expected about %.2fs)' % (count, delay, elapsed, len(used), 's' if len(used) != 1 else '', expected)
+
+    if len(used) != min(count, resolver.max_threads) or elapsed > expected + delay / 2:
+        print >> sys.stderr, 'synarere resolver: lookups did not run concurrently'
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
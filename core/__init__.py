@@ -4,29 +4,40 @@
 
 '''Initialization code.'''
 
-__all__ = ['command', 'confparse', 'event', 'io', 'irc', 'logger', 'module', 'timer', 'var']
+__all__ = ['command', 'confparse', 'connector', 'event', 'framing', 'io', 'irc', 'logger', 'masks', 'message', 'metrics', 'module', 'pool', 'procpool', 'profiler', 'reconnect', 'resolver', 'router', 'sendq', 'shard', 'state', 'task', 'timer', 'var']
 
 def shutdown(code=0, reason="No reason specified."):
-    '''Exit gracefully.'''
-
-    pid_file = None
+    '''Exit gracefully. Whatever goes wrong on the way, this exits.'''
 
     # Import required Python functions.
     from sys import exit
     from os import remove
+    from traceback import format_exc
 
     # Import required source modules.
-    import logger, var, irc, module
+    import logger, var, irc, module, metrics, profiler, shard, procpool
 
-    logger.info('shutdown(): exiting with code %d: %s' % (code, reason))
-    irc.quit_all('shutdown(): exiting with code %d: %s' % (code, reason))
-    module.unload_all()
+    # Workers exit their own way, leaving the supervisor's pidfile alone.
+    if shard.role == 'worker':
+        shard.leave(code, reason)
 
-    # Remove the PID file.
     try:
-        pid_file = open(var.conf.get('options', 'pidfile')[0], 'r')
-        remove(pid_file)
-    except IOError:
-        pass
-
+        logger.info('shutdown(): exiting with code %d: %s', code, reason)
+        irc.quit_all('shutdown(): exiting with code %d: %s' % (code, reason))
+        irc.flush_all()
+        module.unload_all()
+        shard.stop()
+        procpool.stop()
+        metrics.stop()
+        profiler.stop()
+
+        # Remove the PID file.
+        try:
+            remove(var.options.pidfile)
+        except OSError:
+            pass
+    except Exception:
+        logger.error('shutdown(): cleaning up failed:\n%s', format_exc())
+
+    logger.fini()
     exit(code)
@@ -4,11 +4,11 @@
 
 '''Command handlers.'''
 
-# Import required Python function.
-from thread import start_new_thread
+# Import required Python modules.
+import time, traceback
 
 # Import required core modules.
-import logger, event
+import logger, event, task, pool, procpool, metrics
 
 # This is the IRC command hash table.
 # This determines which functions are called
@@ -36,72 +36,182 @@ priv = {}
 # when someone sends a certain CTCP.
 ctcp = {}
 
+# The names of the hash tables above, for logging and metrics.
+names = { id(irc)    : 'irc',
+          id(chan)   : 'chan',
+          id(chanme) : 'chanme',
+          id(priv)   : 'priv',
+          id(ctcp)   : 'ctcp' }
+
+# Other names for commands, per hash table: alias -> command.
+aliases = dict((name, {}) for name in names.values())
+
+# Bumped on every change to the tables or aliases, so that
+# the compiled routers know they're out of date.
+generation = 0
+
+def type_name(cmd_type):
+    '''Return the name of the command hash table `cmd_type`.'''
+
+    return names.get(id(cmd_type))
+
+def call(on_thread, func, args, entry):
+    '''Call a single command handler.'''
+
+    # CPU-heavy handlers run in another process altogether.
+    if func in entry['process']:
+        procpool.submit(func, args)
+        return
+
+    # Generator handlers yield instead of blocking, so they never need a thread.
+    if on_thread and not task.is_task(func):
+        pool.submit(func, args)
+    else:
+        task.run(func, args)
+
+def run(on_thread, entry, *args):
+    '''Call every handler of the command `entry`. One failing doesn't stop the others.'''
+
+    start = time.time()
+    funcs = entry['funcs']
+
+    if entry['first'] or entry['last']:
+        funcs = [entry['first']] + funcs + [entry['last']]
+
+    for func in funcs:
+        if not func:
+            continue
+
+        try:
+            call(on_thread, func, args, entry)
+        except Exception:
+            logger.error('Command handler %s for %s raised an exception:\n%s', func, entry['key'][1], traceback.format_exc())
+
+    metrics.dispatch_time.observe(time.time() - start, entry['key'])
+
 def dispatch(on_thread, cmd_type, command, *args):
     '''Dispatch commands.'''
 
-    logger.debug('Dispatching %s of type %s (threaded = %s)' % (command, cmd_type, on_thread))
+    if logger.tracing:
+        logger.debug('Dispatching %s of type %s (threaded = %s)', command, type_name(cmd_type), on_thread)
 
     try:
-        if cmd_type[command]['first']:
-            if on_thread:
-                start_new_thread(cmd_type[command]['first'], args)
-            else:
-                cmd_type[command]['first'](*args)
-
-        for func in cmd_type[command]['funcs']:
-            if on_thread:
-                start_new_thread(func, args)
-            else:
-                func(*args)
-
-        if cmd_type[command]['last']:
-            if on_thread:
-                start_new_thread(cmd_type[command]['last'], args)
-            else:
-                cmd_type[command]['last'](*args)
+        run(on_thread, cmd_type[command], *args)
     except:
         pass
 
-def add(eventname, func, cmd_type):
-    '''Add a function to an event's list of functions.'''
+def parse_spec(spec):
+    '''
+    Compile an argument spec like 'nick [channel] [reason...]' into
+    (names, how many are required, whether the last one takes the rest).
+    '''
 
-    eventname = eventname.upper()
+    names, required, greedy = [], 0, False
+
+    for word in spec.split():
+        if greedy:
+            raise ValueError('only the last argument of %r may take the rest' % spec)
+
+        optional = word.startswith('[') and word.endswith(']')
+        word = word.strip('[]')
+
+        if word.endswith('...'):
+            greedy = True
+            word = word[:-3]
+
+        if not optional:
+            if required != len(names):
+                raise ValueError('required argument %s follows an optional one in %r' % (word, spec))
+
+            required += 1
+
+        names.append(word)
+
+    return names, required, greedy
+
+def split_args(entry, message):
+    '''Split `message` by the spec of `entry`. Returns None if it doesn't fit.'''
+
+    names, required, greedy = entry['spec']
+    words = message.split(None, len(names) - 1) if greedy and names else message.split()
+
+    if len(words) < required or len(words) > len(names):
+        return None
+
+    return words + [None] * (len(names) - len(words))
+
+def _entry(eventname, cmd_type):
+    '''Return the entry of `eventname`, creating it if need be.'''
 
     try:
-        test = cmd_type[eventname]
+        return cmd_type[eventname]
     except KeyError:
-        cmd_type[eventname] = { 'first' : None,
-                            'funcs' : [],
-                            'last'  : None }
+        entry = cmd_type[eventname] = { 'first'   : None,
+                                        'funcs'   : [],
+                                        'last'    : None,
+                                        'process' : [],
+                                        'spec'    : None,
+                                        'usage'   : None,
+                                        'key'     : (type_name(cmd_type), eventname) }
+        return entry
+
+def changed():
+    '''Tell the routers (see router.py) to recompile.'''
+
+    global generation
+
+    generation += 1
+
+def add(eventname, func, cmd_type, process=False, args=None):
+    '''
+    Add a function to an event's list of functions.
+    If `process` is True, the function is run in a worker process (see procpool).
+    If `args` is an argument spec like 'nick [reason...]', the message is split
+    by it once and handlers get the list of arguments instead of the message.
+    Messages which don't fit get a usage notice.
+    '''
+
+    eventname = eventname.upper()
+    entry = _entry(eventname, cmd_type)
+
+    if args is not None:
+        entry['spec'], entry['usage'] = parse_spec(args), args
 
-    if func in cmd_type[eventname]['funcs']:
+    if func in entry['funcs']:
         return True
 
-    cmd_type[eventname]['funcs'].append(func)
+    entry['funcs'].append(func)
+
+    if process:
+        entry['process'].append(func)
+
+    changed()
     return True
 
-    logger.debug('Created new command %s assigned to function %s (low-priority)' % (eventname, func))
+    logger.debug('Created new command %s assigned to function %s (low-priority)', eventname, func)
     event.dispatch('OnCommandAdd', eventname, func, cmd_type)
 
-def add_first(eventname, func, cmd_type):
+def add_first(eventname, func, cmd_type, process=False, args=None):
     '''Add a function as an event's first function.'''
 
     eventname = eventname.upper()
+    entry = _entry(eventname, cmd_type)
 
-    try:
-        test = cmd_type[eventname]
-    except KeyError:
-        cmd_type[eventname] = { 'first' : None,
-                            'funcs' : [],
-                            'last'  : None }
-
-    if cmd_type[eventname]['first']:
+    if entry['first']:
         return False
 
-    cmd_type[eventname]['first'] = func
+    if args is not None:
+        entry['spec'], entry['usage'] = parse_spec(args), args
+
+    entry['first'] = func
+
+    if process:
+        entry['process'].append(func)
+
+    changed()
     return True
 
-    logger.debug('Created new command %s assigned to %s (high-priority)' % (eventname, func))
+    logger.debug('Created new command %s assigned to %s (high-priority)', eventname, func)
     event.dispatch('OnCommandAddFirst', eventname, func, cmd_type)
 
 def delete(eventname, func, cmd_type):
@@ -113,9 +223,14 @@ def delete(eventname, func, cmd_type):
         return False
 
     cmd_type[eventname]['funcs'].remove(func)
+
+    if func in cmd_type[eventname]['process']:
+        cmd_type[eventname]['process'].remove(func)
+
+    changed()
     return True
 
-    logger.debug('Deleted command %s assigned to %s (low-priority)' % (eventname, func))
+    logger.debug('Deleted command %s assigned to %s (low-priority)', eventname, func)
     event.dispatch('OnCommandDelete', eventname, func, cmd_type)
 
 def delete_first(eventname, func, cmd_type):
@@ -123,6 +238,26 @@ def delete_first(eventname, func, cmd_type):
 
     eventname = eventname.upper()
 
+    if func in cmd_type[eventname]['process']:
+        cmd_type[eventname]['process'].remove(func)
+
     cmd_type[eventname]['first'] = None
-    logger.debug('Deleted command %s assigned to %s (high-priority)' % (eventname, func))
+    changed()
+
+    logger.debug('Deleted command %s assigned to %s (high-priority)', eventname, func)
     event.dispatch('OnCommandDeleteFirst', eventname, func, cmd_type)
+
+def alias(name, target, cmd_type):
+    '''Make `name` another name for the command `target`. For chan commands, give both with the trigger.'''
+
+    aliases[type_name(cmd_type)][name.upper()] = target.upper()
+    changed()
+
+def unalias(name, cmd_type):
+    '''Remove the alias `name`.'''
+
+    if aliases[type_name(cmd_type)].pop(name.upper(), None) is None:
+        return False
+
+    changed()
+    return True
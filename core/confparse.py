@@ -4,11 +4,87 @@
 
 '''Configuration parser.'''
 
-# Import required Python module.
-import os
+# Import required Python modules.
+import os, re
 
 # Import required source modules.
-import logger, irc, var, event
+import logger, irc, module, var, event, masks
+
+class Exception(Exception):
+    '''A problem with the configuration.'''
+
+def boolean(value):
+    '''Turn a configuration value into True or False.'''
+
+    value = value.lower()
+
+    if value in ('true', 'yes', 'on', '1'):
+        return True
+
+    if value in ('false', 'no', 'off', '0'):
+        return False
+
+    raise ValueError('%r is not a boolean' % value)
+
+def choice(*choices):
+    '''Make a converter that only accepts one of `choices`.'''
+
+    def convert(value):
+        value = value.lower()
+
+        if value not in choices:
+            raise ValueError('%r is not one of %s' % (value, ', '.join(choices)))
+
+        return value
+
+    return convert
+
+# Every known variable of the `options` block, its type and its default.
+option_types = ( ('pidfile',           str,                    'etc/synarere.pid'),
+                 ('tbfile',            str,                    'etc/synarere.tb'),
+                 ('irc_cmd_thread',    boolean,                False),
+                 ('chan_cmd_thread',   boolean,                False),
+                 ('chanme_cmd_thread', boolean,                False),
+                 ('priv_cmd_thread',   boolean,                False),
+                 ('ctcp_cmd_thread',   boolean,                False),
+                 ('workers',           int,                    8),
+                 ('worker_queue',      int,                    100),
+                 ('worker_overload',   choice('drop', 'busy'), 'drop'),
+                 ('process_workers',   int,                    0),
+                 ('process_queue',     int,                    100),
+                 ('stats_listen',      str,                    None),
+                 ('stats_command',     boolean,                False),
+                 ('shards',            int,                    0),
+                 ('dns_ttl',           int,                    300),
+                 ('reconnect_rate',    float,                  2.0) )
+
+class Options(object):
+    '''
+    A typed, read-only snapshot of the `options` block.
+
+    A new one is built every time the configuration is parsed and
+    swapped into var.options in one go, so readers never see half of
+    an old configuration and half of a new one.
+    '''
+
+    __slots__ = [name for name, convert, default in option_types]
+
+    def __init__(self, values={}):
+        for name, convert, default in option_types:
+            value = values.get(name)
+
+            if value is None:
+                value = default
+            else:
+                try:
+                    value = convert(value)
+                except ValueError, e:
+                    raise Exception('options:%s: %s' % (name, e))
+
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('options are read-only, rehash to change them')
 
 class ConfigBlock(object):
     def __init__ (self, label, values={}):
@@ -25,6 +101,9 @@ class ConfigBlock(object):
     def get (self, name, defval=None):
         return self.vars.get(name, defval)
 
+# Finds the character which decides what a line is.
+special = re.compile(r'[#:=]')
+
 class ConfigParser:
     def __init__(self, file):
         self.file = file
@@ -33,43 +112,100 @@ class ConfigParser:
     def rehash(self, on_sighup):
         '''Rehash configuration and change synarere to fit the new conditions.'''
 
-        logger.info('Rehashing configuration %s' % ('due to SIGHUP.' if on_sighup else ''))
-        self.parse()
+        logger.info('Rehashing configuration %s', 'due to SIGHUP.' if on_sighup else '')
+
+        old = self.index
+
+        # If the new configuration is broken, keep running on the old one.
+        try:
+            self.parse()
+        except (Exception, IOError), e:
+            logger.error('Rehash of %s failed, keeping the old configuration: %s', self.file, e)
+            return
+
+        # Only touch what actually changed.
+        added, removed, changed = self.diff(old, 'network', 'id')
+
+        if added or removed or changed:
+            irc.rehash(added, removed, changed)
+
+        # Always, so modules whose files changed get reloaded.
+        module.rehash(*self.diff(old, 'module', 'name'))
+
+        if self.values(old, 'logger') != self.values(self.index, 'logger'):
+            logger.rehash()
+
+        if self.values(old, 'ignore') != self.values(self.index, 'ignore') or self.values(old, 'access') != self.values(self.index, 'access'):
+            masks.load()
 
         event.dispatch('OnRehash', self.file, on_sighup)
 
+    def values(self, index, label):
+        '''Return the variables of every `label` block in `index`.'''
+
+        return [b.vars for b in index.get(label, [])]
+
+    def diff(self, old, label, key):
+        '''
+        Compare the `label` blocks in the `old` index with ours, matching
+        them up by their `key` variable. Returns the lists of blocks which
+        were added and removed, and (old, new) pairs of blocks which changed.
+        '''
+
+        before = dict((b.get(key), b) for b in old.get(label, []))
+        after = dict((b.get(key), b) for b in self.index.get(label, []))
+
+        added = [b for b in self.index.get(label, []) if b.get(key) not in before]
+        removed = [b for b in old.get(label, []) if b.get(key) not in after]
+        changed = [(before[k], after[k]) for k in after if k in before and before[k].vars != after[k].vars]
+
+        return added, removed, changed
+
     def parse(self):
         '''Parse our file, and put the data into a dictionary.'''
 
-        lno = 0
-
         # Attempt to open the file.
         fh = open(self.file, 'r')
 
         # Parse.
-        self.blocks = []
+        blocks = []
+
+        try:
+            for line in fh:
+                # Whichever of these comes first decides what the line is.
+                match = special.search(line)
+
+                if not match:
+                    continue
 
-        for line in fh.xreadlines():
-            for cno, c in enumerate(line):
-                if c == '\n':
-                    # Increment the line number.
-                    lno += 1
+                c = match.group()
+                cno = match.start()
 
                 if c == '#': # Comment until EOL.
-                    break
+                    continue
                 if c == ':': # Block label.
-                    label = line[:cno].strip()
-                    self.blocks.append(ConfigBlock(label))
-                if c == '=': # Variable.
-                    if not self.blocks:  # Skip this line, as no block label was given yet.
-                        break
-                    varname = line[:cno].strip()
-                    varval = line[cno + 1:].strip()
-                    self.blocks[-1].add(varname, varval)
-                    break
-
-        # Close the file handle
-        fh.close()
+                    blocks.append(ConfigBlock(line[:cno].strip()))
+                    continue
+                if not blocks: # Skip this line, as no block label was given yet.
+                    continue
+
+                # Variable.
+                blocks[-1].add(line[:cno].strip(), line[cno + 1:].strip())
+        finally:
+            # Close the file handle
+            fh.close()
+
+        # Index the blocks by their label.
+        index = {}
+
+        for b in blocks:
+            index.setdefault(b.label, []).append(b)
+
+        # Compile the options block. Nothing is replaced unless this works.
+        options = index.get('options')
+        options = Options(options[0].vars if options else {})
+
+        self.blocks, self.index, var.options = blocks, index, options
 
     def xget(self, block, variable=None):
         '''
@@ -78,15 +214,15 @@ class ConfigParser:
         return multiple values from multiple blocks.
         '''
 
-        if block not in set(b.label for b in self.blocks):
-            logger.debug('%r block not in configuration.' % block)
+        if block not in self.index:
+            logger.debug('%r block not in configuration.', block)
+            return
 
-        for i in self.blocks:
-            if i.label == block:
-                if variable is None: # Just get blocks by this name
-                    yield i
-                else: # Get a member of blocks by this name.
-                    yield i.get(variable)
+        for i in self.index[block]:
+            if variable is None: # Just get blocks by this name
+                yield i
+            else: # Get a member of blocks by this name.
+                yield i.get(variable)
 
     def get(self, block, variable=None):
         '''
@@ -94,4 +230,4 @@ class ConfigParser:
         results into a list to return all at once.
         '''
 
-        return [b for b in self.xget(block, variable)]
+        return list(self.xget(block, variable))
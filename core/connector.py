@@ -0,0 +1,182 @@
+# synarere -- a highly modular and stable IRC bot.
+# Copyright (C) 2010 Michael Rodriguez.
+# Rights to this code are documented in docs/LICENSE.
+
+'''
+Connecting to every address a name has, Happy Eyeballs style (RFC 8305).
+
+The addresses are tried alternating between IPv6 and IPv4, starting with
+whichever getaddrinfo() put first. A new attempt is started every
+`attempt_delay` seconds, or straight away when one fails, without
+giving up on the attempts already made. The first to connect wins and
+the others are closed.
+'''
+
+# Import required Python modules.
+import asyncore, socket, sys
+from collections import deque
+
+# Import required core modules.
+import logger, timer
+
+# How long to give an attempt before starting the next one alongside it.
+attempt_delay = 0.25
+
+def interleave(addresses):
+    '''Order getaddrinfo() results alternating between address families.'''
+
+    families, by_family = [], {}
+
+    for address in addresses:
+        if address[0] not in by_family:
+            families.append(address[0])
+            by_family[address[0]] = deque()
+
+        by_family[address[0]].append(address)
+
+    ordered = []
+
+    while len(ordered) < len(addresses):
+        for family in families:
+            if by_family[family]:
+                ordered.append(by_family[family].popleft())
+
+    return ordered
+
+class Attempt(asyncore.dispatcher):
+    '''One connection attempt of a Race.'''
+
+    def __init__(self, race, address):
+        asyncore.dispatcher.__init__(self)
+
+        self.race = race
+        self.sockaddr = address[4]
+
+        self.create_socket(address[0], address[1])
+
+        try:
+            if race.vhost:
+                self.bind((race.vhost, 0))
+
+            self.connect(self.sockaddr)
+        except socket.error:
+            self.close()
+            raise
+
+    def readable(self):
+        return False
+
+    def writable(self):
+        return self.connecting
+
+    def handle_connect(self):
+        self.race.won(self)
+
+    def handle_write(self):
+        pass
+
+    def handle_close(self):
+        self.race.lost(self, socket.error('connection closed'))
+
+    def handle_error(self):
+        self.race.lost(self, sys.exc_info()[1])
+
+class Race(object):
+    '''
+    Connect to one of `addresses`, binding to `vhost` if it is set.
+    Calls done(socket, sockaddr, None) with the connected socket of the
+    winner, or done(None, None, errors) with [(sockaddr, error)] if every
+    address failed.
+    '''
+
+    def __init__(self, addresses, vhost, done):
+        self.queue = deque(interleave(addresses))
+        self.vhost = vhost
+        self.done = done
+
+        self.attempts = []
+        self.errors = []
+        self.timer = None
+        self.finished = False
+
+        self.next()
+
+    def next(self, args=None):
+        '''Start the next attempt.'''
+
+        self.timer = None
+
+        while self.queue:
+            address = self.queue.popleft()
+
+            try:
+                attempt = Attempt(self, address)
+            except socket.error, e:
+                self.errors.append((address[4], e))
+                continue
+
+            # It may have connected on the spot.
+            if self.finished:
+                return
+
+            self.attempts.append(attempt)
+            break
+
+        if self.queue and self.attempts:
+            self.timer = timer.add('connector.next', True, self.next, attempt_delay)
+
+        if not self.attempts and not self.queue:
+            self.finish(None, None, self.errors)
+
+    def won(self, attempt):
+        '''`attempt` connected. Hand its socket over and call off the rest.'''
+
+        if attempt in self.attempts:
+            self.attempts.remove(attempt)
+
+        self.cancel()
+
+        # Keep the socket open, but stop asyncore watching it for us.
+        sock = attempt.socket
+        attempt.del_channel()
+        attempt.socket = None
+
+        self.finish(sock, attempt.sockaddr, None)
+
+    def lost(self, attempt, error):
+        '''`attempt` failed. Start the next one right away.'''
+
+        if attempt not in self.attempts:
+            return
+
+        if logger.tracing:
+            logger.debug('Connecting to %s failed: %s', attempt.sockaddr, error)
+
+        self.attempts.remove(attempt)
+        self.errors.append((attempt.sockaddr, error))
+        attempt.close()
+
+        if self.timer:
+            timer.cancel(self.timer)
+
+        self.next()
+
+    def cancel(self):
+        '''Give up on every attempt still running.'''
+
+        if self.timer:
+            timer.cancel(self.timer)
+            self.timer = None
+
+        for attempt in self.attempts:
+            attempt.close()
+
+        self.attempts = []
+        self.queue.clear()
+
+    def finish(self, sock, sockaddr, errors):
+        '''Tell whoever started the race how it went, once.'''
+
+        if not self.finished:
+            self.finished = True
+            self.done(sock, sockaddr, errors)
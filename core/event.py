@@ -2,52 +2,124 @@
 # Copyright (C) 2010 Michael Rodriguez.
 # Rights to this code are documented in docs/LICENSE.
 
-'''Event system for non-IRC events.'''
+'''
+Event system for non-IRC events.
+
+Every event with listeners has a dispatcher in `active`, rebuilt
+whenever a listener is attached or detached. Events nobody listens to
+aren't in there at all, so code which fires an event on every line can
+check `if 'OnParse' in event.active` and skip building the arguments.
+
+Listeners with a higher priority are called first, and listeners with
+the same priority in the order they were attached. A listener raising
+an exception is logged and doesn't stop the others from being called.
+'''
+
+# Import required Python modules.
+import itertools, time, traceback
 
 # Import required core module.
 import logger
 
-# Event data.
+class Listener(object):
+    '''A function attached to an event, and how it has been doing.'''
+
+    __slots__ = ['func', 'priority', 'seq', 'calls', 'time', 'errors']
+
+    def __init__(self, func, priority, seq):
+        self.func = func
+        self.priority = priority
+        self.seq = seq
+        self.calls = 0
+        self.time = 0.0
+        self.errors = 0
+
+# Event data: name -> { 'funcs' : [functions in call order], 'listeners' : [Listener] }
 events = {}
 
+# Name -> dispatcher, for every event somebody listens to.
+active = {}
+
+# Keeps attach order for listeners of the same priority.
+_seq = itertools.count()
+
+def failed(name, listener):
+    '''Log the exception `listener` of event `name` just raised.'''
+
+    listener.errors += 1
+    logger.error('Listener %s of event %s raised an exception:\n%s', listener.func, name, traceback.format_exc())
+
+def rebuild(name):
+    '''Build the dispatcher for event `name`, or drop it if nobody listens.'''
+
+    listeners = events[name]['listeners']
+
+    if not listeners:
+        del events[name]
+        active.pop(name, None)
+        return
+
+    listeners.sort(key=lambda l: (-l.priority, l.seq))
+    events[name]['funcs'] = [l.func for l in listeners]
+
+    # Bind everything the dispatcher needs to locals, so calling it
+    # doesn't look anything up but the listeners themselves.
+    def dispatcher(args, listeners=tuple(listeners), name=name, clock=time.time):
+        for listener in listeners:
+            start = clock()
+
+            try:
+                listener.func(*args)
+            except Exception:
+                failed(name, listener)
+
+            listener.calls += 1
+            listener.time += clock() - start
+
+    active[name] = dispatcher
+
 def dispatch(name, *args):
     '''Dispatch the event.'''
 
-    global events
+    dispatcher = active.get(name)
 
-    # Call every function attached to 'name'.
-    try:
-        for func in events[name]['funcs']:
-            func(*args)
-    except KeyError:
-        pass
-
-def attach(event, func):
-    '''Add a function to an event.'''
+    if dispatcher is not None:
+        dispatcher(args)
 
-    global events
+def attach(event, func, priority=0):
+    '''Add a function to an event. Higher `priority` functions are called first.'''
 
     try:
-        test = events[event]
+        entry = events[event]
     except KeyError:
-        events[event] = { 'funcs' : [] }
+        entry = events[event] = { 'funcs' : [], 'listeners' : [] }
 
-    if func in events[event]['funcs']:
+    if func in entry['funcs']:
         return True
 
-    events[event]['funcs'].append(func)
-    return True
+    entry['listeners'].append(Listener(func, priority, next(_seq)))
+    rebuild(event)
 
-    logger.debug('Attached event %s to %s' % (event, func))
+    if logger.tracing:
+        logger.debug('Attached event %s to %s (priority %d)', event, func, priority)
+
+    return True
 
 def detach(event, func):
     '''Remove a function from an event.'''
 
-    global events
-
-    if func not in events[event]['funcs']:
+    if event not in events or func not in events[event]['funcs']:
         return False
 
-    events[event]['funcs'].remove(func)
+    events[event]['listeners'] = [l for l in events[event]['listeners'] if l.func != func]
+    rebuild(event)
+
+    if logger.tracing:
+        logger.debug('Detached event %s from %s', event, func)
+
+    return True
+
+def stats():
+    '''Return (event, function, calls, seconds, errors) for every listener.'''
 
-    logger.debug('Detached event %s from %s' % (event, func))
+    return [(name, l.func, l.calls, l.time, l.errors) for name in sorted(events) for l in events[name]['listeners']]
@@ -0,0 +1,101 @@
+# synarere -- a highly modular and stable IRC bot.
+# Copyright (C) 2010 Michael Rodriguez.
+# Rights to this code are documented in docs/LICENSE.
+
+'''Receive buffer and IRC line framing.'''
+
+# The longest line we accept, including the line terminator.
+# RFC 1459 allows 512 bytes. IRCv3 message tags may add up to 8191 more.
+max_line = 512
+max_tagged_line = 8191 + 512
+
+# How much we ask the socket for at once.
+recv_size = 8192
+
+class LineBuffer(object):
+    '''
+    A reusable receive buffer which cuts incoming data into lines.
+
+    Data is received straight into the buffer through the memoryview
+    returned by space(), and commit() scans only the newly received
+    bytes for line terminators. Both '\r\n' and a bare '\n' end a line.
+    Lines longer than the protocol allows are thrown away rather than
+    kept around, so a server can't make us buffer without bound.
+    '''
+
+    __slots__ = ['buf', 'view', 'start', 'end', 'discarding', 'dropped']
+
+    def __init__(self):
+        self.buf = bytearray(max_tagged_line + recv_size)
+        self.view = memoryview(self.buf)
+
+        # Unprocessed data lives in buf[start:end].
+        self.start = 0
+        self.end = 0
+
+        # Whether we're skipping the rest of an overlong line,
+        # and how many of those we've skipped in total.
+        self.discarding = False
+        self.dropped = 0
+
+    def space(self):
+        '''Return a view of where the next recv_into() should put its data.'''
+
+        # Move a partial line back to the front when we're running out of room.
+        if len(self.buf) - self.end < recv_size:
+            pending = self.end - self.start
+            self.buf[:pending] = self.buf[self.start:self.end]
+            self.start, self.end = 0, pending
+
+        return self.view[self.end:self.end + recv_size]
+
+    def commit(self, count):
+        '''Account for `count` received bytes, and return the lines they completed.'''
+
+        buf = self.buf
+        scan = self.end
+        self.end += count
+        lines = []
+
+        while True:
+            nl = buf.find('\n', scan, self.end)
+
+            if nl == -1:
+                break
+
+            begin, stop = self.start, nl
+
+            if stop > begin and buf[stop - 1] == 13: # '\r'
+                stop -= 1
+
+            self.start = scan = nl + 1
+
+            if self.discarding:
+                # This is the end of a line we already gave up on.
+                self.discarding = False
+                continue
+
+            if stop == begin:
+                continue
+
+            if stop - begin + 2 > (max_tagged_line if buf[begin] == 64 else max_line): # '@'
+                self.dropped += 1
+                continue
+
+            lines.append(str(buf[begin:stop]))
+
+        # Still no end to a line we gave up on, so there's nothing worth keeping.
+        if self.discarding:
+            self.start = self.end = 0
+
+        # Give up on a partial line which is already too long to ever be valid.
+        elif self.end - self.start > max_tagged_line:
+            self.dropped += 1
+            self.discarding = True
+            self.start = self.end = 0
+
+        # Nothing pending, start over at the front.
+        elif self.start == self.end:
+            self.start = self.end = 0
+
+        return lines
@@ -5,24 +5,297 @@
 '''Main loop.'''
 
 # Import required Python modules.
-import asyncore, time
+import asyncore, errno, fcntl, os, select, signal, thread, time, traceback
+from collections import deque
 
 # Import required core modules.
-import timer, var
+import logger, timer, var
+
+# The poll events we register for. epoll uses the same values.
+POLLIN, POLLPRI, POLLOUT = select.POLLIN, select.POLLPRI, select.POLLOUT
+
+# The poller object, either epoll or poll, and the object and
+# events each file descriptor is currently registered for.
+poller, use_epoll = None, False
+registered = {}
+
+# File descriptors whose object may want different events than the poller
+# was told, because they were added, removed, had I/O or were notify()'d.
+dirty = set()
+
+# The self-pipe used to wake the loop up from other threads.
+wake_r, wake_w = None, None
+
+# The identity of the thread running io().
+loop_thread = None
+
+# (function, arguments) other threads want called on the main loop.
+calls = deque()
+
+class SocketMap(dict):
+    '''
+    asyncore's socket map, noting every socket added to or removed from it,
+    so that update() only has to look at those.
+    '''
+
+    def __setitem__(self, fd, obj):
+        dict.__setitem__(self, fd, obj)
+        dirty.add(fd)
+
+    def __delitem__(self, fd):
+        dict.__delitem__(self, fd)
+        dirty.add(fd)
+
+    def pop(self, fd, *default):
+        dirty.add(fd)
+        return dict.pop(self, fd, *default)
+
+    def clear(self):
+        dirty.update(self)
+        dict.clear(self)
+
+# Dispatchers look the map up when they use it, so this catches them all.
+asyncore.socket_map = SocketMap(asyncore.socket_map)
+
+def _nonblocking(fd):
+    '''Put `fd` into non-blocking mode.'''
+
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def init():
+    '''Set up the poller and the wakeup pipe.'''
+
+    global poller, use_epoll, wake_r, wake_w
+
+    if poller is not None:
+        return
+
+    # epoll is only available on Linux. Everybody else gets poll().
+    use_epoll = hasattr(select, 'epoll')
+
+    if use_epoll:
+        poller = select.epoll()
+    else:
+        poller = select.poll()
+
+    wake_r, wake_w = os.pipe()
+    _nonblocking(wake_r)
+    _nonblocking(wake_w)
+
+    poller.register(wake_r, POLLIN)
+
+    # A signal arriving just before we go into poll() would otherwise
+    # leave what its handler asked for waiting until something else
+    # wakes us up.
+    signal.set_wakeup_fd(wake_w)
+
+def reset():
+    '''Forget the poller and the wakeup pipe. Used in freshly forked children.'''
+
+    global poller, wake_r, wake_w, loop_thread
+
+    if poller is not None and hasattr(poller, 'close'):
+        poller.close()
+
+    if wake_w is not None:
+        signal.set_wakeup_fd(-1)
+
+    for fd in (wake_r, wake_w):
+        if fd is not None:
+            os.close(fd)
+
+    poller, wake_r, wake_w, loop_thread = None, None, None, None
+    registered.clear()
+    dirty.clear()
+    calls.clear()
+
+def wakeup():
+    '''Interrupt the poll so that queued work is handled right away.'''
+
+    # The loop itself doesn't need waking up.
+    if wake_w is None or thread.get_ident() == loop_thread:
+        return
+
+    try:
+        os.write(wake_w, '\0')
+    except OSError, e:
+        # The pipe is full, so the loop is going to wake up anyway.
+        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+
+def notify(obj):
+    '''
+    Tell the loop that `obj` may want to be polled for something else now,
+    such as writing once it has something to send. Safe to call from any
+    thread.
+    '''
+
+    if obj._fileno is not None:
+        dirty.add(obj._fileno)
+
+    wakeup()
+
+def call_soon(func, *args):
+    '''
+    Call `func` with `args` on the main loop. Safe to call from any thread,
+    and from signal handlers.
+    '''
+
+    calls.append((func, args))
+    wakeup()
+
+def run_calls():
+    '''Make the calls other threads asked for.'''
+
+    while calls:
+        func, args = calls.popleft()
+
+        try:
+            func(*args)
+        except Exception:
+            logger.error('Call to %s from another thread raised an exception:\n%s', func, traceback.format_exc())
+
+def _drain():
+    '''Empty the wakeup pipe.'''
+
+    try:
+        while os.read(wake_r, 4096):
+            pass
+    except OSError, e:
+        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+
+def _interest(obj):
+    '''Return the events `obj` wants to be polled for.'''
+
+    flags = 0
+
+    if obj.readable():
+        flags |= POLLIN | POLLPRI
+
+    # Accepting sockets should not be writable.
+    if obj.writable() and not obj.accepting:
+        flags |= POLLOUT
+
+    return flags
+
+def update():
+    '''
+    Bring the poller's registrations in line with what the sockets which
+    changed want. Sockets nothing happened to are not asked again.
+    '''
+
+    # Other threads may add to it while we go.
+    while dirty:
+        fd = dirty.pop()
+        obj = asyncore.socket_map.get(fd)
+
+        if obj is None:
+            unregister(fd)
+            continue
+
+        flags = _interest(obj)
+        old = registered.get(fd)
+
+        # Only bother the kernel when the interest actually changed.
+        if old == (obj, flags):
+            continue
+
+        # A closed descriptor may have been reused by a new socket, in
+        # which case epoll already forgot about it.
+        if old is not None and old[0] is not obj:
+            unregister(fd)
+            old = None
+
+        if old is not None:
+            poller.modify(fd, flags)
+        else:
+            poller.register(fd, flags)
+
+        registered[fd] = (obj, flags)
+
+def unregister(fd):
+    '''Forget about `fd`.'''
+
+    if registered.pop(fd, None) is None:
+        return
+
+    try:
+        poller.unregister(fd)
+    except (IOError, OSError, KeyError, ValueError):
+        # It was closed before we got to it, which removes it from epoll.
+        pass
+
+def timeout():
+    '''Return how long we can wait in poll() before a timer is due, or None.'''
+
+    if calls:
+        return 0.0
+
+    when = timer.next_run()
+
+    if when == -1:
+        return None
+
+    return max(0.0, when - time.time())
+
+def poll(delay):
+    '''Wait up to `delay` seconds for I/O and dispatch it.'''
+
+    # epoll wants seconds (-1 blocks), poll wants milliseconds (None blocks).
+    if use_epoll:
+        delay = -1 if delay is None else delay
+    elif delay is not None:
+        delay = int(delay * 1000)
+
+    try:
+        ready = poller.poll(delay)
+    except (IOError, select.error), e:
+        if e.args[0] != errno.EINTR:
+            raise
+
+        ready = []
+
+    for fd, flags in ready:
+        if fd == wake_r:
+            _drain()
+            continue
+
+        obj = asyncore.socket_map.get(fd)
+
+        if obj is None:
+            unregister(fd)
+            continue
+
+        asyncore.readwrite(obj, flags)
+
+        # Reading and writing is what usually changes what it wants.
+        dirty.add(fd)
 
 def io():
     '''Infinite loop to handle routines.'''
 
+    global loop_thread
+
+    init()
+    loop_thread = thread.get_ident()
+
     while True:
         # Check for timers.
         delay = timer.next_run()
 
-        if delay <= time.time():
+        if delay != -1 and delay <= time.time():
             timer.run()
 
-        # We don't want to poll on no connections because it makes CPU usage skyrocket.
-        # Instead, just sleep.
-        if len(var.conns) == 0:
-            time.sleep(1)
-        else:
-            asyncore.poll(1)
+        if calls:
+            run_calls()
+
+        # Asking the connections what they want may add timers
+        # (flood control does), so do it before working out the timeout.
+        update()
+
+        # Sleep in the poller until a socket is ready, a timer is due
+        # or another thread wakes us up. With no connections, the wakeup
+        # pipe is the only thing being watched, so this costs no CPU.
+        poll(timeout())
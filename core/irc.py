@@ -5,43 +5,15 @@
 '''This handles connections to IRC, sending/receiving data, dispatching commands and more.'''
 
 # Import required Python modules.
-import asyncore, traceback, os, re, socket, time
+import asyncore, errno, traceback, os, socket, time
 from collections import deque
 from core import shutdown
 
 # Import required core modules.
-import logger, var, timer, command, event, misc
-
-# A regular expression to match and dissect IRC protocol messages.
-# This is actually around 60% faster than not using RE.
-pattern = r'''
-           ^              # beginning of string
-           (?:            # non-capturing group
-               \:         # if we have a ':' then we have an origin
-               ([^\s]+)   # get the origin without the ':'
-               \s         # space after the origin
-           )?             # close non-capturing group
-           (\w+)          # must have a command
-           \s             # and a space after it
-           (?:            # non-capturing group
-               ([^\s\:]+) # a target for the command
-               \s         # and a space after it
-           )?             # close non-capturing group
-           (?:            # non-capturing group
-               \:?        # if we have a ':' then we have freeform text
-               (.*)       # get the rest as one string without the ':'
-           )?             # close non-capturing group
-           $              # end of string
-           '''
-
-# Note that this doesn't match *every* IRC message,
-# just the ones we care about. It also doesn't match
-# every IRC message in the way we want. We get what
-# we need. The rest is ignored.
-#
-# Here's a compact version if you need it:
-#     ^(?:\:([^\s]+)\s)?(\w+)\s(?:([^\s\:]+)\s)?(?:\:?(.*))?$
-pattern = re.compile(pattern, re.VERBOSE)
+import logger, var, timer, command, event, misc, sendq, framing, message, metrics, router, shard, resolver, connector, reconnect, state, masks
+
+# The most we try to write to a socket at once.
+max_write = 16384
 
 class Connection(asyncore.dispatcher):
     '''Provide an event based IRC connection.'''
@@ -50,118 +22,279 @@ class Connection(asyncore.dispatcher):
         asyncore.dispatcher.__init__(self)
 
         self.server = server
-        self.holdline = None
+        self.recvbuf = framing.LineBuffer()
         self.last_recv = time.time()
+
+        # The watchdog timer, the token and time of the PING we're waiting
+        # for a PONG to, and the round trip time of the last one.
+        self.watchdog = None
         self.pinged = False
+        self.ping_token = None
+        self.lag = None
+        self.registered = False
+
+        # Our nick as the server knows it, what the server told us it supports
+        # in 005, and the commands compiled for this network.
+        self.nick = server['nick']
+        self.isupport = {}
+        self.router = router.Router(server)
+
+        # Who is on the channels we're on.
+        self.state = state.State(self.router)
+
+        # The connection attempts in progress, while we're connecting.
+        self.race = None
 
-        self.sendq = deque()
+        self.sendq = sendq.SendQueue(self, server['flood_burst'], server['flood_rate'])
         self.recvq = deque()
 
+        # Data packed from the sendq which is being written, how much of it
+        # has been written, and the lines in it (with where each one ends).
+        self.sendbuf = ''
+        self.sendoff = 0
+        self.sendlines = deque()
+
         # Add ourself to the connections list.
         var.conns.append(self)
 
     def writable(self):
         '''See if we need to send data.'''
 
-        return len(self.sendq) > 0
+        # While connecting we need the write event to find out we're connected.
+        return self.connecting or self.sendoff < len(self.sendbuf) or self.sendq.ready()
 
     def handle_read(self):
         '''Handle data read from the connection.'''
 
-        data = self.recv(8192)
-        self.last_recv = time.time()
+        # Receive straight into the line buffer.
+        try:
+            count = self.socket.recv_into(self.recvbuf.space())
+        except socket.error, why:
+            if why.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+
+            if why.args[0] in asyncore._DISCONNECTED:
+                self.handle_close()
+                return
 
+            raise
 
-        if not data:
+        if not count:
             # This means the connection was closed.
             # handle_close() takes care of all of this.
+            self.handle_close()
             return
 
-        datalines = data.split('\r\n')
-
-
-        if not datalines[-1]:
-            # Get rid of the empty element at the end.
-            datalines.pop()
-
-        if self.holdline:
-            # Check to see if we got part of a line previously.
-            # If we did, prepend it to the first line this time.
-            datalines[0] = self.holdline + datalines[0]
-            self.holdline = None
+        self.last_recv = time.time()
+        dropped = self.recvbuf.dropped
+        lines = self.recvbuf.commit(count)
 
-        if not data.endswith('\r\n'):
-            # Check to make sure we got a full line at the end.
-            self.holdline = datalines[-1]
-            datalines.pop()
+        net = (self.server['id'],)
+        metrics.bytes_in.inc(count, net)
+        metrics.lines_in.inc(len(lines), net)
 
         # Add this jazz to the recvq.
-        self.recvq.extend([line for line in datalines])
+        self.recvq.extend(lines)
+
+        if self.recvbuf.dropped != dropped:
+            logger.warning('%s: Dropped %d overlong line%s', self.server['id'], self.recvbuf.dropped - dropped, 's' if self.recvbuf.dropped - dropped != 1 else '')
 
         # Send it off to the parser.
         self.parse()
 
+    def fill_sendbuf(self):
+        '''Pack as many lines from the sendq as will fit into the send buffer.'''
+
+        chunks, size = [], 0
+
+        while size < max_write and self.sendq.ready():
+            line = self.sendq.pop()
+            data = misc.stripunicode(line + '\r\n')
+
+            chunks.append(data)
+            size += len(data)
+
+            # Remember where this line ends, so we know when it has been written.
+            self.sendlines.append((size, line))
+
+        self.sendbuf = ''.join(chunks)
+        self.sendoff = 0
+
     def handle_write(self):
-        '''Write the first line in the sendq to the socket.'''
+        '''Write as much of the sendq to the socket as we can.'''
 
-        # Grab the first line from the sendq.
-        line = self.sendq[-1] + '\r\n'
-        stripped_line = misc.stripunicode(line)
+        if self.sendoff >= len(self.sendbuf):
+            self.fill_sendbuf()
 
-        # Try to send it.
-        num_sent = self.send(stripped_line)
+            if not self.sendbuf:
+                return
 
-        # If it didn't all send we have to work this out.
-        if num_sent == len(stripped_line):
-            logger.debug('%s: %s <- %s' % (self.server['id'], self.server['address'], self.sendq.pop()))
-            event.dispatch('OnSocketWrite', self.server, line)
-        else:
-            logger.warning('%s: Incomplete write (%d byte%s written instead of %d)' % (self.server['id'], num_sent, 's' if num_sent != 1 else '', len(stripped_line)))
-            event.dispatch('OnIncompleteSocketWrite', self.server, num_sent, stripped_line)
-            self.sendq[-1] = self.sendq[-1][num_sent:]
+        # Try to send everything that's left, without copying it.
+        left = len(self.sendbuf) - self.sendoff
+        num_sent = self.send(memoryview(self.sendbuf)[self.sendoff:])
+        self.sendoff += num_sent
+        written = len(self.sendlines)
+
+        # Report every line that made it out completely.
+        while self.sendlines and self.sendlines[0][0] <= self.sendoff:
+            end, line = self.sendlines.popleft()
+
+            if logger.tracing:
+                logger.debug('%s: %s <- %s', self.server['id'], self.server['address'], line)
+
+            if 'OnSocketWrite' in event.active:
+                event.dispatch('OnSocketWrite', self.server, line + '\r\n')
+
+        net = (self.server['id'],)
+        metrics.bytes_out.inc(num_sent, net)
+        metrics.lines_out.inc(written - len(self.sendlines), net)
+
+        # If it didn't all send, the rest goes out on the next write event.
+        if num_sent != left:
+            logger.warning('%s: Incomplete write (%d byte%s written instead of %d)', self.server['id'], num_sent, 's' if num_sent != 1 else '', left)
+            event.dispatch('OnIncompleteSocketWrite', self.server, num_sent, self.sendbuf[self.sendoff - num_sent:])
 
     def handle_connect(self):
         '''Log into the IRC server.'''
 
-        logger.info('%s: Connection established.' % (self.server['id']))
+        logger.info('%s: Connection established to %s.', self.server['id'], self.addr[0])
 
         self.server['connected'] = True
+        self.server['connecting'] = False
+        self.last_recv = time.time()
         event.dispatch('OnConnect', self.server)
 
+        self.arm()
+
         if self.server['pass']:
             self.sendq.appendleft('PASS %s' % self.server['pass'])
 
         self.sendq.appendleft('NICK %s' % self.server['nick'])
         self.sendq.appendleft('USER %s 2 3 :%s' % (self.server['ident'], self.server['gecos']))
 
+    def resolved(self, addresses, error):
+        '''The server's address has been looked up. Connect to it.'''
+
+        if error:
+            self.failed('unable to look up %s: %s' % (self.server['address'], error.args[-1]))
+            return
+
+        self.race = connector.Race(addresses, self.server['vhost'], self.raced)
+
+    def raced(self, sock, sockaddr, errors):
+        '''One of the server's addresses answered, or none did.'''
+
+        self.race = None
+
+        if not sock:
+            # The addresses may have changed since we looked them up.
+            resolver.forget(self.server['address'], self.server['port'])
+            self.failed(', '.join('%s: %s' % (sa[0], e) for sa, e in errors))
+            return
+
+        # The network was removed while we were connecting.
+        if self.server not in var.servers:
+            sock.close()
+            self.server['connecting'] = False
+            self.lost()
+            return
+
+        self.set_socket(sock)
+        self.connected, self.connecting, self.addr = True, False, sockaddr
+        self.handle_connect()
+
+    def failed(self, why):
+        '''Connecting didn't work out.'''
+
+        logger.error('%s: Unable to connect to %s:%d (%s)', self.server['id'], self.server['address'], self.server['port'], why)
+        self.server['connecting'] = False
+        self.lost()
+
+    def arm(self):
+        '''(Re)start the watchdog at the network's ping_interval. At 0 or below, there is none.'''
+
+        if self.watchdog:
+            timer.cancel(self.watchdog)
+            self.watchdog = None
+
+        # Count the silence from now. Without a watchdog, nobody was counting.
+        self.last_recv = time.time()
+
+        if self.server['ping_interval'] > 0:
+            self.watchdog = timer.add('irc.watchdog', False, self.watch, self.server['ping_interval'])
+
+    def watch(self, args):
+        '''Check on the connection: PING the server, and give up on it if it stopped answering.'''
+
+        now = time.time()
+        silent = now - self.last_recv
+
+        if silent > self.server['ping_timeout']:
+            logger.warning('%s: Nothing from the server in %d seconds, dropping the connection.', self.server['id'], silent)
+            event.dispatch('OnPingTimeout', self.server, silent)
+            self.handle_close()
+            return
+
+        # Servers don't like being PINGed before we've registered.
+        if self.registered and not self.pinged:
+            self.pinged = now
+            self.ping_token = 'LAG%.6f' % now
+            self.sendq.appendleft('PING :%s' % self.ping_token)
+
+    def ponged(self, token):
+        '''The server answered a PING. If it was ours, work out the lag.'''
+
+        if not self.pinged or token != self.ping_token:
+            return
+
+        self.lag = time.time() - self.pinged
+        self.pinged = False
+
+        if logger.tracing:
+            logger.debug('%s: Lag is %.3f seconds', self.server['id'], self.lag)
+
+        if 'OnLag' in event.active:
+            event.dispatch('OnLag', self.server, self.lag)
+
     def handle_close(self):
         asyncore.dispatcher.close(self)
 
-        logger.info('%s: Connection lost.' % self.server['id'])
+        logger.info('%s: Connection lost.', self.server['id'])
+        self.lost()
+
+    def lost(self):
+        '''Clean up after the connection closed or couldn't be made, and reconnect if we should.'''
+
         self.server['connected'] = False
 
+        if self.watchdog:
+            timer.cancel(self.watchdog)
+            self.watchdog = None
+
+        self.state.clear()
+
         event.dispatch('OnConnectionClose', self.server)
 
+        # Remove us from the connections list. Reconnecting makes a new Connection.
+        try:
+            var.conns.remove(self)
+        except ValueError:
+            logger.error('%s: Could not find myself in the connectons list (BUG)', self.server['address'])
+
         if self.server['recontime']:
-            logger.info('%s: Reconnecting in %d second%s.' % (self.server['id'], self.server['recontime'], 's' if self.server['recontime'] != 1 else ''))
-            timer.add('io.reconnect', True, connect, self.server['recontime'], self.server)
+            wait = reconnect.lost(self.server, connect)
+            logger.info('%s: Reconnecting in %.1f seconds.', self.server['id'], wait)
 
             event.dispatch('OnPostReconnect', self.server)
-        else:
-            # Remove us from the connections list.
-            try:
-                var.conns.remove(self)
-            except ValueError:
-                logger.error('%s: Could not find myself in the connectons list (BUG)' % self.server['address'])
 
     # I absolutely despise `compact_traceback()`.
     def handle_error(self):
         '''Record the traceback and exit.'''
 
-        logger.critical('Internal asyncore failure, writing traceback to %s' % var.conf.get('options', 'tbfile')[0])
+        logger.critical('Internal asyncore failure, writing traceback to %s', var.options.tbfile)
 
         try:
-            tracefile = open(var.conf.get('options', 'tbfile')[0], 'w')
+            tracefile = open(var.options.tbfile, 'w')
             traceback.print_exc(file=tracefile)
             tracefile.close()
 
@@ -176,160 +309,163 @@ class Connection(asyncore.dispatcher):
     def parse(self):
         '''Parse IRC protocol and call methods based on the results.'''
 
-        global pattern
-
         # Go through every line in the recvq.
         while len(self.recvq):
             line = self.recvq.popleft()
 
-            event.dispatch('OnParse', self.server, line)
+            if 'OnParse' in event.active:
+                event.dispatch('OnParse', self.server, line)
+
+            if logger.tracing:
+                logger.debug('%s: %s -> %s', self.server['id'], self.server['address'], line)
 
-            logger.debug('%s: %s -> %s' % (self.server['id'], self.server['address'], line))
-            parv = []
+            msg = message.parse(line)
 
-            # Split this crap up with the help of RE.
-            try:
-                origin, cmd, target, message = pattern.match(line).groups()
-            except AttributeError:
+            if not msg:
                 continue
 
-            # Make an IRC parameter argument vector.
-            if target:
-                parv.append(target)
+            cmd, parv = msg.command, msg.params
 
-            parv.append(message)
+            # Keep track of who is where, so handlers can ask.
+            if cmd in state.tracked:
+                self.state.update(self, msg)
 
-            # Now see if the command is handled by the hash table.
-            try:
-                command.irc[cmd]
-            except KeyError:
-                pass
+            # Nothing from ignored users gets any further.
+            if masks.ignores and masks.ignored(msg.source()) and not self.state.is_me(self, msg.nick):
+                masks.ignored_messages.inc(1, (self.server['id'],))
+                continue
 
-            if var.conf.get('options', 'irc_cmd_thread')[0]:
-                command.dispatch(True, command.irc, cmd, self, origin, parv)
-            else:
-                command.dispatch(False, command.irc, cmd, self, origin, parv)
+            # Raw IRC command handlers get the whole message.
+            if cmd in command.irc:
+                command.dispatch(var.options.irc_cmd_thread, command.irc, cmd, self, msg)
 
             if cmd == 'PING':
-                event.dispatch('OnPING', self.server, parv[0])
-                self.sendq.appendleft('PONG :%s' % parv[0])
+                event.dispatch('OnPING', self.server, msg.target())
+                self.sendq.appendleft('PONG :%s' % (parv[-1] if parv else ''))
+
+            elif cmd == '001':
+                self.registered = True
+                reconnect.registered(self.server)
+
+                # The server may have changed our nick on the way in.
+                if parv:
+                    self.nick = parv[0]
 
-            if cmd == '001':
                 for i in self.server['chans']:
                     self.sendq.appendleft('JOIN %s' % i)
                     event.dispatch('OnJoinChannel', self.server, i)
 
-            if cmd == 'PRIVMSG':
-                try:
-                    n, u, h = dissect_origin(origin)
-                except:
-                   return
-
-                # Check to see if it's a channel.
-                if parv[0].startswith('#') or parv[0].startswith('&'):
-                    # Do the `chan_cmd` related stuff.
-                    cmd = parv[1].split()
-
-                    if not cmd:
-                        return
-
-                    # Chop the command off, as we don't want that.
-                    message = cmd[1:]
-                    message = ' '.join(message)
-                    cmd = cmd[0].upper()
-
-                    # Have we been addressed?
-                    # If so, do the `chanme_cmd` related stuff.
-                    if parv[1].startswith(self.server['nick']):
-                        message = message.split()
-
-                        if not message:
-                            return
-
-                        cmd = message[0].upper()
-                        del message[0]
-                        message = ' '.join(message)
-
-                        # Call the handlers.
-                        try:
-                            command.chanme[cmd]
-                        except KeyError:
-                            return
-
-                        if var.conf.get('options', 'chanme_cmd_thread')[0]:
-                            command.dispatch(True, command.chanme, cmd, self, (n, u, h), parv[0], message)
-                        else:
-                            command.dispatch(False, command.chanme, cmd, self, (n, u, h), parv[0], message)
-                    else:
-                         # Call the handlers.
-                         try:
-                             command.chan[cmd]
-                         except KeyError:
-                             return
-
-                         if var.conf.get('options', 'chan_cmd_thread')[0]:
-                             command.dispatch(True, command.chan, self.server['trigger'] + cmd, self, (n, u, h), parv[0], message)
-                         else:
-                             command.dispatch(False, command.chan, self.server['trigger'] + cmd, self, (n, u, h), parv[0], message)
-                else:
-                     # CTCP?
-                     if parv[1].startswith('\1'):
-                         parv[1] = parv[1].strip('\1')
-                         cmd = parv[1].split()
-
-                         if not cmd:
-                             return
-
-                         message = cmd[1:]
-                         message = ' '.join(message)
-                         cmd = cmd[0].upper()
-
-                         # Call the handlers.
-                         try:
-                             command.ctcp[cmd]
-                         except KeyError:
-                             return
-
-                         if var.conf.get('options', 'ctcp_cmd_thread')[0]:
-                             command.dispatch(True, command.ctcp, cmd, self, (n, u, h), message)
-                         else:
-                             command.dispatch(False, command.ctcp, cmd, self, (n, u, h), message)
-                     else:
-                          cmd = parv[1].split()
-
-                          if not cmd:
-                              return
-
-                          message = cmd[1:]
-                          message = ' '.join(message)
-                          cmd = cmd[0].upper()
-
-                          # Call the handlers.
-                          try:
-                             command.priv [cmd]
-                          except KeyError:
-                              try:
-                                  cmd = cmd[1:]
-                                  command.priv[cmd]
-                              except KeyError:
-                                 return
-
-                              if var.conf.get('options', 'priv_cmd_thread')[0]:
-                                  command.dispatch(True, command.priv, cmd, self, (n, u, h), message)
-                              else:
-                                  command.dispatch(False, command.priv, cmd, self, (n, u, h), message)
-
-    def privmsg(self, where, text):
-        '''PRIVMSG 'where' with 'text'.'''
-
-        self.sendq.appendleft('PRIVMSG %s :%s' % (where, text))
+            elif cmd == 'PRIVMSG' and len(parv) > 1:
+                self.parse_privmsg(msg)
+
+            elif cmd == '005':
+                self.parse_isupport(parv)
+
+            elif cmd == 'PONG' and parv:
+                self.ponged(parv[-1])
+
+            elif cmd == 'NICK' and parv and msg.nick and self.router.fold(msg.nick) == self.router.fold(self.nick):
+                self.nick = parv[-1]
+
+    def parse_isupport(self, parv):
+        '''Remember what the server supports, from a 005 reply.'''
+
+        # The first parameter is our nick and the last one is 'are supported by this server'.
+        for token in parv[1:-1]:
+            name, _, value = token.partition('=')
+
+            if name.startswith('-'):
+                self.isupport.pop(name[1:], None)
+            else:
+                self.isupport[name] = value
+
+            if name == 'CASEMAPPING':
+                self.router.set_casemapping(value)
+            elif name == 'PREFIX' and value:
+                self.state.set_prefix(value)
+            elif name == 'CHANMODES' and value:
+                self.state.set_chanmodes(value)
+
+    def parse_privmsg(self, msg):
+        '''Find and call the command handlers for a PRIVMSG.'''
+
+        who = msg.source()
+
+        # Only users can use commands.
+        if who[2] is None:
+            return
+
+        target, text = msg.params[0], msg.params[-1]
+        routes = self.router.current()
+
+        # CTCP goes to the CTCP handlers, wherever it was sent.
+        if text[:1] == '\1':
+            words = text.strip('\1').split(None, 1)
+
+            if words:
+                self.dispatch(var.options.ctcp_cmd_thread, routes.ctcp, words, (self, who))
+
+            return
+
+        if target and target[0] in self.isupport.get('CHANTYPES', '#&'):
+            # Have we been addressed? If so, it's a chanme command.
+            rest = routes.addressed(text, self.nick)
+
+            if rest is not None:
+                self.dispatch(var.options.chanme_cmd_thread, routes.chanme, rest.split(None, 1), (self, who, target))
+            else:
+                self.dispatch(var.options.chan_cmd_thread, routes.chan, text.split(None, 1), (self, who, target))
+        else:
+            self.dispatch(var.options.priv_cmd_thread, routes.priv, text.split(None, 1), (self, who))
+
+    def dispatch(self, on_thread, routes, words, args):
+        '''Call the command `words[0]` from `routes`, with `args` and the rest of the message.'''
+
+        if not words:
+            return
+
+        entry = routes.get(words[0].translate(self.router.table))
+
+        if entry is None:
+            return
+
+        if logger.tracing:
+            logger.debug('%s: Dispatching %s %s (threaded = %s)', self.server['id'], entry['key'][0], entry['key'][1], on_thread)
+
+        self.run(on_thread, entry, words[0], args, words[1] if len(words) > 1 else '')
+
+    def run(self, on_thread, entry, word, args, message):
+        '''Call the command `entry`, typed as `word`, with `args` and `message` split by its argument spec.'''
+
+        # Commands listed in access blocks are only for the people they list.
+        if entry['key'] in masks.access and not masks.allowed(entry['key'], args[1]):
+            if logger.tracing:
+                logger.debug('%s: %s!%s@%s may not use %s %s', self.server['id'], args[1][0], args[1][1], args[1][2], entry['key'][0], entry['key'][1])
+
+            masks.denied_commands.inc(1, (self.server['id'],))
+            return
+
+        # Commands with an argument spec get their arguments split up.
+        if entry['spec']:
+            message = command.split_args(entry, message)
+
+            if message is None:
+                self.notice(args[1][0], 'Usage: %s %s' % (word, entry['usage']), sendq.BULK)
+                return
+
+        command.run(on_thread, entry, *(args + (message,)))
+
+    def privmsg(self, where, text, lane=None):
+        '''PRIVMSG 'where' with 'text', in send queue 'lane' if given.'''
+
+        self.sendq.appendleft('PRIVMSG %s :%s' % (where, text), lane)
         event.dispatch('OnPRIVMSG', self.server, where, text)
         return
 
-    def notice(self, where, text):
-        '''NOTICE 'where' with 'text'.'''
+    def notice(self, where, text, lane=None):
+        '''NOTICE 'where' with 'text', in send queue 'lane' if given.'''
 
-        self.sendq.appendleft('NOTICE %s :%s' % (where, text))
+        self.sendq.appendleft('NOTICE %s :%s' % (where, text), lane)
         event.dispatch('OnNOTICE', self.server, where, text)
         return
 
@@ -369,75 +505,200 @@ class Connection(asyncore.dispatcher):
         event.dispatch('OnQuitWithReason', self.server, reason)
         return
 
-    def push(self, data):
-        '''Push raw data onto the server.'''
+    def flush(self):
+        '''Write what we can of the sendq right now, without waiting for the loop.'''
 
-        self.sendq.appendleft('%s' % data)
+        if not self.connected:
+            return
+
+        try:
+            while self.writable():
+                left = (len(self.sendq), self.sendoff)
+                self.handle_write()
+
+                # The socket won't take any more.
+                if (len(self.sendq), self.sendoff) == left:
+                    break
+        except socket.error:
+            pass
+
+    def push(self, data, lane=None):
+        '''Push raw data onto the server, in send queue 'lane' if given.'''
+
+        self.sendq.appendleft('%s' % data, lane)
         return
 
 def connect(server):
-    '''Connect to an IRC server.'''
+    '''
+    Start connecting to an IRC server. The lookup and the connection
+    attempts (see connector.py) happen in the background, so connecting
+    to many networks at once doesn't hold anything up.
+    '''
 
-    if server['connected']:
+    if server['connected'] or server['connecting'] or server not in var.servers:
         return
 
-    logger.info('%s: Connecting to %s:%d' % (server['id'], server['address'], server['port']))
+    reconnect.attempt(server)
+    logger.info('%s: Connecting to %s:%d', server['id'], server['address'], server['port'])
+    server['connecting'] = True
     conn = Connection(server)
 
     event.dispatch('OnPreConnect', server)
 
-    # This step is low-level to permit IPv6.
-    af, type, proto, canon, sa = socket.getaddrinfo(server['address'], server['port'], 0, 1)[0]
-    conn.create_socket(af, type)
-
-    # If there's a vhost, bind to it.
-    if server['vhost']:
-        conn.bind((server['vhost'], 0))
-
-    # Now connect to the IRC server.
-    conn.connect(sa)
+    resolver.resolve(server['address'], server['port'], conn.resolved)
+
+def new_server(block):
+    '''Make a server dict out of a `network` configuration block.'''
+
+    port = int(block.get('port'))
+    servers = reconnect.parse_addresses(block.get('address'), port)
+
+    serv = { 'id'            : block.get('id'),
+             'address'       : servers[0][0],
+             'port'          : servers[0][1],
+             'servers'       : servers,
+             'current'       : 0,
+             'nick'          : block.get('nick'),
+             'ident'         : block.get('ident'),
+             'gecos'         : block.get('gecos'),
+             'vhost'         : block.get('vhost'),
+             'chans'         : [],
+             'connected'     : False,
+             'connecting'    : False,
+             'pass'          : block.get('pass'),
+             'recontime'     : 0,
+             'recontime_max' : int(block.get('recontime_max') or 600),
+             'tries'         : 0,
+             'attempts'      : 0,
+             'failures'      : 0,
+             'trigger'       : block.get('trigger'),
+             'flood_burst'   : int(block.get('flood_burst') or 0),
+             'flood_rate'    : float(block.get('flood_rate') or 0),
+             'ping_interval' : int(block.get('ping_interval') or 60),
+             'ping_timeout'  : int(block.get('ping_timeout') or 150) }
+
+    if block.get('chans'):
+        serv['chans'] = [chan.strip() for chan in block.get('chans').split(',') if chan.strip()]
+
+    if block.get('recontime'):
+        serv['recontime'] = int(block.get('recontime'))
+
+    return serv
+
+def add_server(block):
+    '''Add a network from the configuration and connect to it.'''
+
+    serv = new_server(block)
+    var.servers.append(serv)
+
+    event.dispatch('OnNewServer', serv)
+    connect(serv)
+
+    return serv
 
 def connect_to_all():
     '''Connect to all servers in the configuration.'''
 
     for i in var.conf.get('network'):
-        serv = { 'id'        : i.get('id'),
-                 'address'   : i.get('address'),
-                 'port'      : int(i.get('port')),
-                 'nick'      : i.get('nick'),
-                 'ident'     : i.get('ident'),
-                 'gecos'     : i.get('gecos'),
-                 'vhost'     : i.get('vhost'),
-                 'chans'     : [],
-                 'connected' : False,
-                 'pass'      : i.get('pass'),
-                 'recontime' : 0,
-                 'trigger'   : i.get('trigger') }
+        if shard.owns(i.get('id')):
+            add_server(i)
 
-        serv['chans'].append(i.get('chans'))
+def find_server(id):
+    '''Find the server dict of network `id`.'''
 
-        if i.get('recontime'):
-            serv['recontime'] = int(i.get('recontime'))
+    for serv in var.servers:
+        if serv['id'] == id:
+            return serv
 
-        var.servers.append(serv)
+def find_conn(server):
+    '''Find the Connection belonging to `server`.'''
 
-        event.dispatch('OnNewServer', serv)
+    for conn in var.conns:
+        if isinstance(conn, Connection) and conn.server is server:
+            return conn
 
-        try:
-            connect(serv)
-        except socket.error, e:
-            logger.error('%s: Unable to connect - (%s)' % (serv['id'], serv['address'], serv['port'], os.strerror(e.args[0])))
+def rehash(added, removed, changed):
+    '''
+    Apply changed `network` blocks. Networks which didn't change are left
+    alone. Changes to the address, port, vhost, pass, ident and gecos of
+    a network take effect the next time it connects.
+    '''
+
+    for block in removed:
+        serv = find_server(block.get('id'))
+
+        if not serv:
+            continue
+
+        logger.info('%s: Network removed from the configuration.', serv['id'])
+
+        # Make sure it doesn't come back.
+        serv['recontime'] = 0
+        var.servers.remove(serv)
+
+        conn = find_conn(serv)
+
+        if conn:
+            conn.quit('Network removed from the configuration')
+
+    for block in added:
+        if not shard.owns(block.get('id')):
+            continue
+
+        logger.info('%s: Network added to the configuration.', block.get('id'))
+        add_server(block)
+
+    for old, new in changed:
+        serv = find_server(old.get('id'))
+
+        if not serv:
+            continue
+
+        logger.info('%s: Network changed in the configuration.', serv['id'])
+
+        fresh = new_server(new)
+        for key in ('connected', 'connecting', 'tries', 'attempts', 'failures'):
+            fresh[key] = serv[key]
+
+        # Stay on the address we're using if it's still there.
+        if (serv['address'], serv['port']) in fresh['servers']:
+            fresh['current'] = fresh['servers'].index((serv['address'], serv['port']))
+            fresh['address'], fresh['port'] = serv['address'], serv['port']
+        conn = find_conn(serv)
+
+        if conn and serv['connected']:
+            for chan in fresh['chans']:
+                if chan not in serv['chans']:
+                    conn.join(chan)
+
+            for chan in serv['chans']:
+                if chan not in fresh['chans']:
+                    conn.part(chan)
+
+            if fresh['nick'] != serv['nick']:
+                conn.push('NICK %s' % fresh['nick'])
+
+        rearm = fresh['ping_interval'] != serv['ping_interval']
+
+        if conn:
+            conn.sendq.burst, conn.sendq.rate = fresh['flood_burst'], fresh['flood_rate']
+
+            # The trigger may have changed.
+            conn.router.invalidate()
+
+        # Update the dict in place, as everything else holds a reference to it.
+        serv.update(fresh)
+
+        if conn and serv['connected'] and rearm:
+            conn.arm()
 
 def dissect_origin(origin):
     '''Split nick!user@host into nick, user, host.'''
 
-    try:
-        n, uh = origin.split('!')
-        u, h = uh.split('@')
+    n, u, h = message.split_prefix(origin)
 
+    if u is not None and h is not None:
         return n, u, h
-    except ValueError:
-        pass
 
 def quit_all(reason):
     '''Quit all IRC networks.'''
@@ -445,3 +706,10 @@ def quit_all(reason):
     for i in var.conns:
         if isinstance(i, Connection):
             i.quit(reason)
+
+def flush_all():
+    '''Write out what every connection has queued, as far as it goes without waiting. Used when exiting.'''
+
+    for i in var.conns:
+        if isinstance(i, Connection):
+            i.flush()
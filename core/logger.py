@@ -2,10 +2,17 @@
 # Copyright (C) 2010 Michael Rodriguez.
 # Rights to this code are documented in docs/LICENSE.
 
-'''Logger facility.'''
+'''
+Logger facility.
 
-# Import required Python module.
-import logging
+Log calls only put the record on a queue. A background thread formats
+and writes it, so the main loop never waits on the disk. Pass arguments
+separately (logger.debug('%s -> %s', a, b)) so nothing is formatted for
+levels which are disabled, and check `tracing` before logging every line.
+'''
+
+# Import required Python modules.
+import logging, os, threading, Queue
 
 # Import required Python function.
 from logging import handlers
@@ -16,6 +23,105 @@ import var
 # Make these references to the real methods.
 debug, info, warning, error, critical = None, None, None, None, None
 
+# Whether debug messages are logged. Checking this first is much cheaper
+# than a call to debug() which turns out to do nothing.
+tracing = False
+
+# How many records may wait for the writer before we start dropping them.
+queue_size = 10000
+
+class RotatingFileHandler(handlers.RotatingFileHandler):
+    '''A RotatingFileHandler where a backupCount of 0 keeps every old log.'''
+
+    def doRollover(self):
+        if self.backupCount:
+            handlers.RotatingFileHandler.doRollover(self)
+            return
+
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
+        # Find the oldest log and move everything up by one.
+        last = 0
+
+        while os.path.exists('%s.%d' % (self.baseFilename, last + 1)):
+            last += 1
+
+        for i in xrange(last, 0, -1):
+            os.rename('%s.%d' % (self.baseFilename, i), '%s.%d' % (self.baseFilename, i + 1))
+
+        if os.path.exists(self.baseFilename):
+            os.rename(self.baseFilename, self.baseFilename + '.1')
+
+        self.stream = self._open()
+
+class QueueHandler(logging.Handler):
+    '''Hand records over to the Writer thread without blocking.'''
+
+    def __init__(self, writer):
+        logging.Handler.__init__(self)
+        self.writer = writer
+
+    def emit(self, record):
+        # Arguments may change after we return, so merge them in now.
+        # This only happens for records which are actually logged.
+        record.msg = record.getMessage()
+        record.args = None
+
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        try:
+            self.writer.queue.put_nowait(record)
+        except Queue.Full:
+            self.writer.dropped += 1
+
+class Writer(threading.Thread):
+    '''Write queued records to the real handlers.'''
+
+    def __init__(self, targets):
+        threading.Thread.__init__(self, name='logger')
+        self.setDaemon(True)
+
+        self.queue = Queue.Queue(queue_size)
+        self.targets = targets
+        self.dropped = 0
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+
+            if record is None:
+                break
+
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                self.write(logging.makeLogRecord({ 'name'      : record.name,
+                                                   'levelno'   : logging.WARNING,
+                                                   'levelname' : 'WARNING',
+                                                   'msg'       : 'Logging fell behind, dropped %d message%s' % (dropped, 's' if dropped != 1 else '') }))
+
+            self.write(record)
+
+    def write(self, record):
+        for handler in self.targets:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def stop(self):
+        '''Write out whatever is queued and close the handlers.'''
+
+        self.queue.put(None)
+        self.join()
+
+        for handler in self.targets:
+            handler.close()
+
+# The writer thread, when running.
+writer = None
+
 def get_level():
     '''Get the logging level.'''
 
@@ -32,31 +138,98 @@ def get_level():
 
     return logging.INFO
 
+def get_rotation():
+    '''Get (maximum size in bytes, number of old logs to keep) for the log file.'''
+
+    try:
+        max_size = int(var.conf.get('logger', 'max_size')[0]) * 1024
+    except (TypeError, ValueError):
+        max_size = 0
+
+    try:
+        max_logs = int(var.conf.get('logger', 'max_logs')[0])
+    except (TypeError, ValueError):
+        max_logs = 0
+
+    return max(max_size, 0), max(max_logs, 0)
+
 def init():
     '''Initialise the logging subsystem.'''
 
-    global debug, info, warning, error, critical
+    global debug, info, warning, error, critical, tracing, writer
 
     var.log = logging.getLogger('synarere')
 
+    max_size, max_logs = get_rotation()
+
+    handler = RotatingFileHandler(filename=var.conf.get('logger', 'path')[0], maxBytes=max_size, backupCount=max_logs)
+    handler.setFormatter(logging.Formatter(var.conf.get('logger', 'format')[0]))
+    targets = [handler]
+
     # Set up logging to stderr if we're in foreground mode.
     if not var.fork:
         stream = logging.StreamHandler()
-    else:
-        stream = None
+        stream.setFormatter(logging.Formatter(var.conf.get('logger', 'stream_format')[0]))
+        targets.append(stream)
 
-    handler = handlers.RotatingFileHandler(filename=var.conf.get('logger', 'path')[0], maxBytes=var.conf.get('logger', 'max_size')[0], backupCount=var.conf.get('logger', 'max_logs')[0])
-    formatter = logging.Formatter(var.conf.get('logger', 'format')[0])
+    writer = Writer(targets)
+    writer.start()
 
-    handler.setFormatter(formatter)
-
-    if stream:
-        stream_format = logging.Formatter(var.conf.get('logger', 'stream_format')[0])
-        stream.setFormatter(stream_format)
-        var.log.addHandler(stream)
-
-    var.log.addHandler(handler)
+    var.log.addHandler(QueueHandler(writer))
     var.log.setLevel(get_level())
+    tracing = var.log.isEnabledFor(logging.DEBUG)
 
     debug, info, warning = var.log.debug, var.log.info, var.log.warning
     error, critical = var.log.error, var.log.critical
+
+def detach():
+    '''Stop handing records to the writer thread.'''
+
+    for handler in var.log.handlers[:]:
+        if isinstance(handler, QueueHandler):
+            var.log.removeHandler(handler)
+
+    var.log.addHandler(logging.NullHandler())
+
+def forked():
+    '''
+    Called in a child process. The writer thread wasn't forked along with
+    us and its queue may be locked, so log messages are thrown away here.
+    '''
+
+    global tracing, writer
+
+    if var.log:
+        detach()
+
+    tracing = False
+    writer = None
+
+def fini():
+    '''Write out everything still queued. Nothing is logged to the file after this.'''
+
+    global writer
+
+    if not writer:
+        return
+
+    detach()
+    writer.stop()
+    writer = None
+
+def rehash():
+    '''Apply a changed logging level and rotation policy. A changed path needs a restart.'''
+
+    global tracing
+
+    var.log.setLevel(get_level())
+    tracing = var.log.isEnabledFor(logging.DEBUG)
+
+    if writer:
+        max_size, max_logs = get_rotation()
+
+        for handler in writer.targets:
+            if isinstance(handler, RotatingFileHandler):
+                handler.maxBytes, handler.backupCount = max_size, max_logs
+
+    info('Logging level is now %s.', logging.getLevelName(var.log.level).lower())
@@ -0,0 +1,256 @@
+# synarere -- a highly modular and stable IRC bot.
+# Copyright (C) 2010 Michael Rodriguez.
+# Rights to this code are documented in docs/LICENSE.
+
+'''
+Matching nick!user@host against many wildcard masks at once.
+
+A MaskIndex sorts its masks by their most specific part, so matching
+someone is a handful of dict lookups however many masks there are:
+
+exact  -- Masks without wildcards, by the whole nick!user@host.
+nick   -- Masks like badnick!*@*, by the nick.
+host   -- Masks like *!*@host.example.net, by the host.
+suffix -- Masks like *!*@*.example.net, by the part after the '*'.
+prefix -- Masks like *!*@203.0.113.* or *!*@user/*, by the part before it.
+
+Masks with anything else on them are checked with the rest of their
+mask, and whatever fits none of these is checked with a single regular
+expression made out of all of them. Masks match the way the server
+compares nicks, * being any number of characters and ? any one.
+
+The `ignore` and `access` blocks of the configuration are compiled
+into indexes here (see conf/example.conf). Nothing ignored gets to a
+handler, and commands listed in an access block are only run for the
+masks it lists.
+'''
+
+# Import required Python module.
+import re
+
+# Import required core modules.
+import logger, var, command, metrics, router
+
+# Masks are folded the way most servers fold nicks.
+table = router.casemappings[router.default_casemapping]
+
+def glob(pattern):
+    '''Turn the wildcard `pattern` into a regular expression, without compiling it.'''
+
+    return ''.join('.*' if c == '*' else '.' if c == '?' else re.escape(c) for c in pattern)
+
+def split_mask(mask):
+    '''Split a mask into (nick, user, host). Missing parts are '*'.'''
+
+    if '@' not in mask:
+        nick, _, user = mask.partition('!')
+        return nick or '*', user or '*', '*'
+
+    rest, _, host = mask.rpartition('@')
+
+    if '!' not in rest:
+        return '*', rest or '*', host or '*'
+
+    nick, _, user = rest.partition('!')
+    return nick or '*', user or '*', host or '*'
+
+def literal(text):
+    '''See if `text` has no wildcards in it.'''
+
+    return '*' not in text and '?' not in text
+
+class MaskIndex(object):
+    '''
+    Wildcard masks, each with a value, compiled for matching.
+
+    masks -- [(mask, value)] in the order they were added.
+    '''
+
+    __slots__ = ['masks', 'exact', 'nick', 'host', 'suffix', 'prefix', 'prefix_lengths', 'fallback', 'combined']
+
+    def __init__(self, masks=()):
+        self.masks = []
+        self.exact, self.nick, self.host, self.suffix, self.prefix = {}, {}, {}, {}, {}
+        self.prefix_lengths = []
+        self.fallback = []
+        self.combined = None
+
+        for mask, value in masks:
+            self.add(mask, value)
+
+    def __len__(self):
+        return len(self.masks)
+
+    def __repr__(self):
+        return '<MaskIndex of %d mask%s>' % (len(self.masks), 's' if len(self.masks) != 1 else '')
+
+    def add(self, mask, value=True):
+        '''Add `mask`, which matches as `value`.'''
+
+        nick, user, host = split_mask(mask.translate(table))
+        full = '%s!%s@%s' % (nick, user, host)
+
+        self.masks.append((mask, value))
+
+        # The rest of the mask, if there is anything else to check.
+        def rest(*parts):
+            if all(part == '*' for part in parts):
+                return None
+
+            return re.compile(glob(full) + r'\Z')
+
+        if literal(full):
+            self.exact.setdefault((nick, user, host), []).append(value)
+        elif literal(host):
+            self.host.setdefault(host, []).append((rest(nick, user), value))
+        elif literal(nick):
+            self.nick.setdefault(nick, []).append((rest(user, host), value))
+        elif host.startswith('*.') and literal(host[1:]):
+            self.suffix.setdefault(host[1:], []).append((rest(nick, user), value))
+        elif host[-1:] == '*' and host[-2:-1] in ('.', ':', '/') and literal(host[:-1]):
+            self.prefix.setdefault(host[:-1], []).append((rest(nick, user), value))
+
+            # Only hosts this long are worth looking up.
+            if len(host) - 1 not in self.prefix_lengths:
+                self.prefix_lengths.append(len(host) - 1)
+        else:
+            self.fallback.append((re.compile(glob(full) + r'\Z'), value))
+
+            # Compiled again when next needed.
+            self.combined = None
+
+    def compile(self):
+        '''Make the one regular expression which matches whatever any of the fallback masks do.'''
+
+        self.combined = re.compile('|'.join('(?:%s)' % regex.pattern for regex, value in self.fallback))
+
+    def candidates(self, nick, user, host):
+        '''Yield the (rest, value) of every mask whose bucket `nick`, `user` and `host` fall in.'''
+
+        for value in self.exact.get((nick, user, host), ()):
+            yield None, value
+
+        for entry in self.nick.get(nick, ()):
+            yield entry
+
+        for entry in self.host.get(host, ()):
+            yield entry
+
+        if self.suffix:
+            i = host.find('.')
+
+            while i != -1:
+                for entry in self.suffix.get(host[i:], ()):
+                    yield entry
+
+                i = host.find('.', i + 1)
+
+        for length in self.prefix_lengths:
+            for entry in self.prefix.get(host[:length], ()):
+                yield entry
+
+    def match(self, nick, user, host):
+        '''Return the values of every mask nick!user@host matches.'''
+
+        nick, user, host = nick.translate(table), (user or '').translate(table), (host or '').translate(table)
+        full = '%s!%s@%s' % (nick, user, host)
+        values = []
+
+        for regex, value in self.candidates(nick, user, host):
+            if regex is None or regex.match(full):
+                values.append(value)
+
+        if self.fallback and self.combined is None:
+            self.compile()
+
+        if self.fallback and self.combined.match(full):
+            values.extend(value for regex, value in self.fallback if regex.match(full))
+
+        return values
+
+    def matches(self, nick, user, host):
+        '''See if nick!user@host matches any of the masks.'''
+
+        nick, user, host = nick.translate(table), (user or '').translate(table), (host or '').translate(table)
+        full = '%s!%s@%s' % (nick, user, host)
+
+        for regex, value in self.candidates(nick, user, host):
+            if regex is None or regex.match(full):
+                return True
+
+        if self.fallback and self.combined is None:
+            self.compile()
+
+        return bool(self.fallback and self.combined.match(full))
+
+# Who to ignore.
+ignores = MaskIndex()
+
+# (command type, command) -> MaskIndex of who may use it.
+access = {}
+
+# Name of an access block -> MaskIndex of the masks it lists.
+groups = {}
+
+ignored_messages = metrics.Counter('synarere_ignored_messages_total', 'Messages from ignored users.', ('network',))
+denied_commands = metrics.Counter('synarere_denied_commands_total', 'Commands refused by access blocks.', ('network',))
+
+def split_list(value):
+    '''Split a comma separated list of masks.'''
+
+    return [mask.strip() for mask in (value or '').split(',') if mask.strip()]
+
+def ignored(who):
+    '''See if the user (nick, user, host) is ignored.'''
+
+    return who[2] is not None and ignores.matches(*who)
+
+def allowed(key, who):
+    '''See if the user (nick, user, host) may use the command with entry key `key`.'''
+
+    index = access.get(key)
+    return index is None or (who[2] is not None and index.matches(*who))
+
+def is_in(name, who):
+    '''See if the user (nick, user, host) is listed by the access block called `name`.'''
+
+    index = groups.get(name)
+    return index is not None and who[2] is not None and index.matches(*who)
+
+def load():
+    '''Compile the `ignore` and `access` blocks of the configuration.'''
+
+    global ignores, access, groups
+
+    new_ignores, new_access, new_groups = MaskIndex(), {}, {}
+
+    for block in var.conf.get('ignore'):
+        for mask in split_list(block.get('masks')):
+            new_ignores.add(mask)
+
+    for block in var.conf.get('access'):
+        name, masks = block.get('name'), split_list(block.get('masks'))
+
+        if name:
+            index = new_groups.setdefault(name, MaskIndex())
+
+            for mask in masks:
+                index.add(mask, name)
+
+        for word in (block.get('commands') or '').split():
+            kind, sep, cmd = word.partition(':')
+
+            if not sep or kind not in command.aliases or kind == 'irc':
+                logger.error('access: command %s should look like type:name, with type one of %s.', word, ', '.join(sorted(k for k in command.aliases if k != 'irc')))
+                continue
+
+            index = new_access.setdefault((kind, cmd.upper()), MaskIndex())
+
+            for mask in masks:
+                index.add(mask, name)
+
+    # Swap them in at once, like var.options.
+    ignores, access, groups = new_ignores, new_access, new_groups
+
+    if ignores or access:
+        logger.info('Ignoring %d mask%s, %d command%s limited by access blocks.', len(ignores), 's' if len(ignores) != 1 else '', len(access), 's' if len(access) != 1 else '')
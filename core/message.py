@@ -0,0 +1,104 @@
+# synarere -- a highly modular and stable IRC bot.
+# Copyright (C) 2010 Michael Rodriguez.
+# Rights to this code are documented in docs/LICENSE.
+
+'''IRC protocol message parser.'''
+
+class Message(object):
+    '''
+    A parsed IRC protocol message.
+
+    prefix   -- Where the message came from, without the ':', or None.
+    command  -- The command or numeric, in upper case.
+    params   -- Every parameter, the trailing one (if any) included as the last.
+    trailing -- The parameter given after ' :', or None if there was none.
+    nick, user, host -- The prefix split up. Worked out when first asked for.
+    tags     -- The raw IRCv3 message tags, without the '@', or None.
+    line     -- The line this was parsed from.
+    '''
+
+    __slots__ = ['line', 'tags', 'prefix', 'command', 'params', 'trailing', '_source']
+
+    def __init__(self, line, tags, prefix, command, params, trailing):
+        self.line = line
+        self.tags = tags
+        self.prefix = prefix
+        self.command = command
+        self.params = params
+        self.trailing = trailing
+        self._source = None
+
+    def __repr__(self):
+        return '<Message %s %r from %s>' % (self.command, self.params, self.prefix)
+
+    def source(self):
+        '''Return (nick, user, host) from the prefix. Missing parts are None.'''
+
+        if self._source is None:
+            self._source = split_prefix(self.prefix)
+
+        return self._source
+
+    nick = property(lambda self: self.source()[0])
+    user = property(lambda self: self.source()[1])
+    host = property(lambda self: self.source()[2])
+
+    def target(self):
+        '''Return the first parameter, or None.'''
+
+        return self.params[0] if self.params else None
+
+def split_prefix(prefix):
+    '''Split nick!user@host into (nick, user, host). Missing parts are None.'''
+
+    if not prefix:
+        return None, None, None
+
+    nick, bang, rest = prefix.partition('!')
+
+    if bang:
+        user, at, host = rest.partition('@')
+        return nick, user, host if at else None
+
+    nick, at, host = prefix.partition('@')
+    return nick, None, host if at else None
+
+def parse(line, _new=object.__new__):
+    '''Parse `line` into a Message in one pass. Returns None if it isn't one.'''
+
+    tags = prefix = None
+    rest = line
+    first = line[:1]
+
+    if first == '@':
+        tags, _, rest = rest[1:].partition(' ')
+        first = rest[:1]
+
+    if first == ':':
+        prefix, _, rest = rest[1:].partition(' ')
+
+    # Everything after ' :' is one parameter, spaces and all.
+    head, colon, trailing = rest.partition(' :')
+    command, _, middle = head.partition(' ')
+
+    if not command:
+        return None
+
+    params = middle.split()
+
+    if colon:
+        params.append(trailing)
+    else:
+        trailing = None
+
+    # Creating the object without going through __init__ saves a call per line.
+    msg = _new(Message)
+    msg.line = line
+    msg.tags = tags
+    msg.prefix = prefix
+    msg.command = command.upper()
+    msg.params = params
+    msg.trailing = trailing
+    msg._source = None
+
+    return msg
@@ -0,0 +1,467 @@
+# synarere -- a highly modular and stable IRC bot.
+# Copyright (C) 2010 Michael Rodriguez.
+# Rights to this code are documented in docs/LICENSE.
+
+'''
+Runtime metrics.
+
+Counters, gauges and histograms, each with optional labels, kept in one
+registry. They can be read in the Prometheus text format from the
+`stats_listen` socket, or summed up by the STATS private command.
+'''
+
+# Import required Python modules.
+import asyncore, bisect, errno, os, socket, sys, threading, time
+
+# Import required core modules.
+import logger, var
+
+# Every metric, by name, in the order they were made.
+registry = {}
+order = []
+
+# Buckets for durations, in seconds.
+time_buckets = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Functions returning [(shard, exposition text)] of other processes,
+# which are merged into ours. See shard.py.
+collectors = []
+
+# Taken for updates which come from worker threads. Metrics which
+# only the main loop updates don't need it.
+lock = threading.Lock()
+
+class Metric(object):
+    '''
+    Base class of all metrics.
+
+    name   -- The name the metric is exposed as.
+    help   -- What it measures.
+    labels -- The names of its labels. Values are given as a tuple in the same order.
+    func   -- If given, called when the metric is read. Returns {label values: value}.
+    '''
+
+    kind = None
+
+    def __init__(self, name, help, labels=(), func=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.func = func
+
+        if name not in registry:
+            order.append(name)
+
+        registry[name] = self
+
+    def samples(self):
+        '''Return (suffix, label values, extra labels, value) for every sample.'''
+
+        if self.func:
+            self.values = self.func()
+
+        return [('', key, (), value) for key, value in sorted(self.values.items())]
+
+class Counter(Metric):
+    '''A number which only goes up.'''
+
+    kind = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        return self.values.get(labels, 0)
+
+class Gauge(Metric):
+    '''A number which goes up and down.'''
+
+    kind = 'gauge'
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+class Histogram(Metric):
+    '''Counts of observations in buckets, along with their sum.'''
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=time_buckets):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        # [count per bucket..., count above the last bucket, sum]
+        try:
+            counts = self.values[labels]
+        except KeyError:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def count(self, labels=()):
+        counts = self.values.get(labels)
+        return sum(counts[:-1]) if counts else 0
+
+    def quantile(self, q, labels=()):
+        '''Estimate quantile `q` (0 to 1) as the upper bound of the bucket it falls in.'''
+
+        counts = self.values.get(labels)
+
+        if not counts:
+            return None
+
+        wanted, seen = q * sum(counts[:-1]), 0
+
+        for i, bound in enumerate(self.buckets):
+            seen += counts[i]
+
+            if seen >= wanted:
+                return bound
+
+        return float('inf')
+
+    def samples(self):
+        samples = []
+
+        for key, counts in sorted(self.values.items()):
+            seen = 0
+
+            for bound, count in zip(self.buckets, counts):
+                seen += count
+                samples.append(('_bucket', key, (('le', '%g' % bound),), seen))
+
+            seen += counts[-2]
+            samples.append(('_bucket', key, (('le', '+Inf'),), seen))
+            samples.append(('_sum', key, (), counts[-1]))
+            samples.append(('_count', key, (), seen))
+
+        return samples
+
+def escape(value):
+    '''Escape a label value.'''
+
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def exposition():
+    '''Return every metric in the Prometheus text exposition format.'''
+
+    text = local()
+
+    if not collectors:
+        return text
+
+    sources = [('supervisor', text)]
+
+    for collect in collectors:
+        sources.extend(collect())
+
+    return merge(sources)
+
+def reset():
+    '''Forget everything counted so far, like a new process would.'''
+
+    for metric in registry.itervalues():
+        if not metric.func:
+            metric.values.clear()
+
+def local():
+    '''Return the metrics of this process in the Prometheus text exposition format.'''
+
+    out = []
+
+    for name in order:
+        metric = registry[name]
+
+        out.append('# HELP %s %s' % (name, metric.help))
+        out.append('# TYPE %s %s' % (name, metric.kind))
+
+        for suffix, key, extra, value in metric.samples():
+            pairs = zip(metric.labels, key) + list(extra)
+            labels = ','.join('%s="%s"' % (k, escape(v)) for k, v in pairs)
+
+            out.append('%s%s%s %s' % (name, suffix, '{%s}' % labels if labels else '', repr(float(value)) if isinstance(value, float) else value))
+
+    return '\n'.join(out) + '\n'
+
+def merge(sources):
+    '''
+    Merge (shard, exposition text) pairs into one exposition, with a
+    `shard` label on every sample and each metric described only once.
+    '''
+
+    families, names = {}, []
+
+    for shard, text in sources:
+        family = None
+
+        for line in text.splitlines():
+            if line.startswith('# '):
+                family = line.split()[2]
+
+                if family not in families:
+                    families[family] = ([], [])
+                    names.append(family)
+
+                if line not in families[family][0]:
+                    families[family][0].append(line)
+
+                continue
+
+            if not line or family is None:
+                continue
+
+            name, brace, rest = line.partition('{')
+
+            if brace:
+                line = '%s{shard="%s",%s' % (name, escape(shard), rest)
+            else:
+                name, _, value = line.partition(' ')
+                line = '%s{shard="%s"} %s' % (name, escape(shard), value)
+
+            families[family][1].append(line)
+
+    out = []
+
+    for family in names:
+        out.extend(families[family][0])
+        out.extend(families[family][1])
+
+    return '\n'.join(out) + '\n'
+
+def summary():
+    '''Return a few lines for humans about how we're doing.'''
+
+    # Import required core modules.
+    import irc
+
+    lines = []
+
+    for conn in var.conns:
+        if not isinstance(conn, irc.Connection):
+            continue
+
+        net = (conn.server['id'],)
+        lines.append('%s: %d lines in, %d out, %d bytes in, %d out, sendq %d, recvq %d' %
+                     (net[0], lines_in.get(net), lines_out.get(net), bytes_in.get(net), bytes_out.get(net), len(conn.sendq), len(conn.recvq)))
+
+    busiest = sorted(((dispatch_time.count(key), key) for key in dispatch_time.values.keys()), reverse=True)[:5]
+
+    if busiest:
+        lines.append('Busiest commands: %s' % ', '.join('%s %s (%d)' % (kind, cmd, count) for count, (kind, cmd) in busiest))
+
+        for count, key in busiest[:3]:
+            lines.append('%s %s dispatch: p50 %s, p99 %s' % (key[0], key[1], fmt_seconds(dispatch_time.quantile(0.5, key)), fmt_seconds(dispatch_time.quantile(0.99, key))))
+
+    lines.append('Timer lag: p50 %s, p99 %s; %d thread%s' % (fmt_seconds(timer_lag.quantile(0.5)), fmt_seconds(timer_lag.quantile(0.99)), threading.activeCount(), 's' if threading.activeCount() != 1 else ''))
+
+    return lines
+
+def fmt_seconds(value):
+    '''Format a bucket bound for humans.'''
+
+    if value is None:
+        return 'n/a'
+
+    if value == float('inf'):
+        return '>%gs' % time_buckets[-1]
+
+    if value < 1:
+        return '<=%gms' % (value * 1000)
+
+    return '<=%gs' % value
+
+class StatsClient(asyncore.dispatcher):
+    '''Someone reading our metrics. Answers plain text, or HTTP if asked in HTTP.'''
+
+    def __init__(self, sock):
+        asyncore.dispatcher.__init__(self, sock)
+
+        self.request = ''
+        self.reply = None
+
+    def readable(self):
+        return self.reply is None
+
+    def writable(self):
+        return bool(self.reply)
+
+    def handle_read(self):
+        try:
+            data = self.recv(4096)
+        except socket.error, why:
+            if why.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+
+            raise
+
+        self.request += data
+
+        # We only care about the first line.
+        if '\n' not in self.request and data and len(self.request) < 8192:
+            return
+
+        body = exposition()
+
+        if self.request.startswith('GET '):
+            self.reply = 'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s' % (len(body), body)
+        else:
+            self.reply = body
+
+    def handle_write(self):
+        sent = self.send(self.reply)
+        self.reply = self.reply[sent:]
+
+        if not self.reply:
+            self.close()
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        logger.warning('Stats client failed: %s', traceback_line())
+        self.close()
+
+class StatsServer(asyncore.dispatcher):
+    '''Accepts readers of our metrics on a unix socket or a TCP port.'''
+
+    def __init__(self, where):
+        asyncore.dispatcher.__init__(self)
+
+        self.path = None
+
+        if '/' in where:
+            self.path = where
+
+            if os.path.exists(where):
+                os.remove(where)
+
+            self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.bind(where)
+        else:
+            host, _, port = where.rpartition(':')
+
+            self.create_socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+            self.bind((host.strip('[]') or '127.0.0.1', int(port)))
+
+        self.listen(5)
+
+    def handle_accept(self):
+        pair = self.accept()
+
+        if pair:
+            StatsClient(pair[0])
+
+    def handle_error(self):
+        logger.warning('Stats listener failed: %s', traceback_line())
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+def traceback_line():
+    '''Return the exception being handled, in one line.'''
+
+    kind, value = sys.exc_info()[:2]
+    return '%s: %s' % (kind.__name__, value)
+
+# The stats listener, if there is one.
+listener = None
+
+def listen():
+    '''Start the stats listener if `stats_listen` is set.'''
+
+    global listener
+
+    if listener or not var.options.stats_listen:
+        return
+
+    try:
+        listener = StatsServer(var.options.stats_listen)
+    except (socket.error, ValueError), e:
+        logger.error('Unable to listen for stats on %s: %s', var.options.stats_listen, e)
+        return
+
+    logger.info('Serving stats on %s', var.options.stats_listen)
+
+def stop():
+    '''Stop the stats listener.'''
+
+    global listener
+
+    if listener:
+        listener.close()
+        listener = None
+
+def conn_gauge(attr):
+    '''Make a gauge function reporting len(getattr(conn, attr)) per network.'''
+
+    def read():
+        # Import required core module.
+        import irc
+
+        return dict(((conn.server['id'],), len(getattr(conn, attr))) for conn in var.conns if isinstance(conn, irc.Connection))
+
+    return read
+
+def lag_gauge():
+    '''Report the lag of every network we've measured it on.'''
+
+    # Import required core module.
+    import irc
+
+    return dict(((conn.server['id'],), conn.lag) for conn in var.conns if isinstance(conn, irc.Connection) and conn.lag is not None)
+
+def listener_stats(field):
+    '''Make a function reporting one field of event.stats() per listener.'''
+
+    def read():
+        # Import required core module.
+        import event
+
+        values = {}
+
+        # Listeners with the same name are added up.
+        for stat in event.stats():
+            func = stat[1]
+            key = (stat[0], '%s.%s' % (getattr(func, '__module__', None), getattr(func, '__name__', repr(func))))
+            values[key] = values.get(key, 0) + stat[2 + field]
+
+        return values
+
+    return read
+
+def pool_gauge():
+    '''Report the worker pool's queue depth.'''
+
+    # Import required core module.
+    import pool
+
+    return { () : pool.depth() }
+
+# The metrics the core keeps.
+lines_in = Counter('synarere_lines_received_total', 'IRC lines received.', ('network',))
+lines_out = Counter('synarere_lines_sent_total', 'IRC lines sent.', ('network',))
+bytes_in = Counter('synarere_bytes_received_total', 'Bytes received from IRC servers.', ('network',))
+bytes_out = Counter('synarere_bytes_sent_total', 'Bytes sent to IRC servers.', ('network',))
+dispatch_time = Histogram('synarere_dispatch_seconds', 'Commands dispatched, and the time spent on the main loop doing so.', ('type', 'command'))
+job_time = Histogram('synarere_worker_job_seconds', 'Time worker threads spent running a command.', ('handler',))
+listener_calls = Counter('synarere_event_listener_calls_total', 'Calls to event listeners.', ('event', 'listener'), listener_stats(0))
+listener_time = Counter('synarere_event_listener_seconds_total', 'Time spent in event listeners.', ('event', 'listener'), listener_stats(1))
+listener_errors = Counter('synarere_event_listener_errors_total', 'Exceptions raised by event listeners.', ('event', 'listener'), listener_stats(2))
+connect_attempts = Counter('synarere_connect_attempts_total', 'Attempts to connect to IRC servers.', ('network',))
+connect_failures = Counter('synarere_connect_failures_total', 'Attempts to connect to IRC servers which failed before registering.', ('network',))
+timer_lag = Histogram('synarere_timer_lag_seconds', 'How late timers ran.')
+sendq_depth = Gauge('synarere_sendq_lines', 'Lines waiting in the send queue.', ('network',), conn_gauge('sendq'))
+recvq_depth = Gauge('synarere_recvq_lines', 'Lines waiting in the receive queue.', ('network',), conn_gauge('recvq'))
+worker_queue = Gauge('synarere_worker_queue_jobs', 'Jobs waiting for a worker thread.', (), pool_gauge)
+lag = Gauge('synarere_lag_seconds', 'Round trip time of our last PING to each network.', ('network',), lag_gauge)
+timers = Gauge('synarere_timers', 'Timers scheduled.', (), lambda: { () : len(var.timers) })
+threads = Gauge('synarere_threads', 'Threads running.', (), lambda: { () : threading.activeCount() })
+started = Gauge('synarere_start_time_seconds', 'When we started, in seconds since the epoch.')
+started.set(time.time())
@@ -2,53 +2,316 @@
 # Copyright (C) 2010 Michael Rodriguez.
 # Rights to this code are documented in docs/LICENSE.
 
-'''Module operations.'''
+'''
+Module operations.
 
-# Import required Python function.
+Modules are loaded from the file their `module` block names, and are
+known by that name. A loaded module can be reloaded in place: its new
+code is imported first, and only if that works is the old code finished
+and the new code started. Modules which want to keep something across a
+reload define module_state(), and whatever it returns is handed to the
+new code's module_restore() before its module_init() runs. The process
+pool is restarted too, since its workers were forked with the old code.
+
+A module block with `lazy` set only registers the commands listed there.
+The module itself is loaded the first time one of them is used.
+'''
+
+# Import required Python modules.
+import os, sys, traceback
 from imp import load_source
 
 # Import required core modules.
-import logger, var, event
+import logger, var, event, command, procpool
 
-def load(module):
-    '''Load a module.'''
+# Name -> modification time of its file when it was loaded, to spot changes on rehash.
+mtimes = {}
+
+# Name -> [(command table, command, stub)] for modules waiting to be loaded on first use.
+lazy = {}
+
+def mtime(name):
+    '''Return the modification time of the file of module `name`, or None.'''
+
+    try:
+        return os.stat(name).st_mtime
+    except OSError:
+        return None
+
+def _import(module):
+    '''Import the code of a module, without starting it. Returns None if that fails.'''
+
+    # Don't let load_source() import over a copy which is already running.
+    old = sys.modules.pop(module, None)
 
     try:
         mod = load_source(module, module)
-    except ImportError, e:
-        logger.error('Unable to load module %s: %s' % (module, e))
-        return
+    except (ImportError, IOError, SyntaxError), e:
+        logger.error('Unable to load module %s: %s', module, e)
+        mod = None
+    except Exception:
+        logger.error('Unable to load module %s, it raised an exception:\n%s', module, traceback.format_exc())
+        mod = None
+    finally:
+        # Whatever happened, the copy which is running stays in place.
+        if old is not None:
+            sys.modules[module] = old
+        else:
+            sys.modules.pop(module, None)
+
+    if not mod:
+        return None
 
     # Check to make sure the module has init/fini functions.
     if not hasattr(mod, 'module_init'):
-        logger.error('Unable to use module %s: No entry point has been defined.' % mod.__name__)
-        return
+        logger.error('Unable to use module %s: No entry point has been defined.', mod.__name__)
+        return None
 
     if not hasattr(mod, 'module_fini'):
-        logger.error('Unable to use module %s: No exit point has been defined.' % mod.__name__)
-        return
+        logger.error('Unable to use module %s: No exit point has been defined.', mod.__name__)
+        return None
+
+    return mod
+
+def start(mod, state=None):
+    '''
+    Start an imported module, giving it `state` from the copy it replaces.
+    Returns False if it raised an exception, in which case it is finished
+    again so it doesn't leave half of its commands behind.
+    '''
+
+    try:
+        if state is not None and hasattr(mod, 'module_restore'):
+            mod.module_restore(state)
+
+        mod.module_init()
+    except Exception:
+        logger.error('Module %s raised an exception while starting:\n%s', mod.__name__, traceback.format_exc())
+
+        try:
+            mod.module_fini()
+        except Exception:
+            logger.error('Module %s raised an exception while cleaning up after that:\n%s', mod.__name__, traceback.format_exc())
+
+        return False
 
-    mod.module_init()
-    logger.info('Module %s loaded.' % mod.__name__)
+    sys.modules[mod.__name__] = mod
+    mtimes[mod.__name__] = mtime(mod.__name__)
 
     # Add the module to the loaded modules list.
     var.modules_loaded.append(mod)
+    return True
+
+def load(module):
+    '''Load a module.'''
+
+    mod = _import(module)
+
+    if not mod or not start(mod):
+        return None
+
+    logger.info('Module %s loaded.', mod.__name__)
+
     event.dispatch('OnModuleLoad', module)
+    return mod
 
 def unload(module):
     '''Unload a module.'''
 
     # Make sure it is in the modules loaded list.
     if module not in var.modules_loaded:
-        logger.warning('%s is not in the loaded modules list.' % module)
+        logger.warning('%s is not in the loaded modules list.', module)
         return
 
-    module.module_fini()
+    try:
+        module.module_fini()
+    except Exception:
+        logger.error('Module %s raised an exception while unloading:\n%s', module.__name__, traceback.format_exc())
 
     # Remove the module from the loaded modules list.
     var.modules_loaded.remove(module)
+    mtimes.pop(module.__name__, None)
+
     event.dispatch('OnModuleUnload', module)
 
+def reload(name):
+    '''
+    Reload module `name` in place. If its new code doesn't load, the old
+    code keeps running. Returns the new module, or None.
+    '''
+
+    old = find(name)
+
+    if not old:
+        logger.warning('Unable to reload module %s: it is not loaded.', name)
+        return None
+
+    mod = _import(name)
+
+    if not mod:
+        logger.error('Keeping the old code of module %s running.', name)
+        return None
+
+    state = None
+
+    if hasattr(old, 'module_state'):
+        try:
+            state = old.module_state()
+        except Exception:
+            logger.error('Module %s raised an exception while saving its state:\n%s', name, traceback.format_exc())
+
+    unload(old)
+
+    # If the new code doesn't start, bring the old code back up.
+    if not start(mod, state):
+        logger.error('Starting the old code of module %s again.', name)
+
+        if not start(old, state):
+            logger.error('Module %s is no longer loaded.', name)
+
+        return None
+
+    # The worker processes were forked with the old code. The next job
+    # forks new ones.
+    procpool.stop()
+
+    logger.info('Module %s reloaded.', name)
+
+    event.dispatch('OnModuleReload', name)
+    return mod
+
+def declare(name, commands):
+    '''
+    Register the commands of module `name` without loading it. `commands`
+    lists them as type:name, like 'chan:.quit priv:help'. The module is
+    loaded when one of them is first used.
+    '''
+
+    stubs = []
+
+    for word in commands.split():
+        kind, sep, cmd = word.partition(':')
+
+        if not sep or kind not in command.aliases:
+            logger.error('Module %s: lazy command %s should look like type:name, with type one of %s.', name, word, ', '.join(sorted(command.aliases)))
+            continue
+
+        cmd_type = getattr(command, kind)
+        stub = make_stub(name, kind, cmd)
+
+        command.add(cmd, stub, cmd_type)
+        stubs.append((cmd_type, cmd, stub))
+
+    lazy[name] = stubs
+    logger.info('Module %s will be loaded when first used.', name)
+
+def make_stub(name, kind, cmd):
+    '''Make the handler which stands in for command `cmd` of lazy module `name`.'''
+
+    def stub(*args):
+        # Let the dispatch which called us finish before we change its command.
+        yield
+
+        # If it doesn't load, we are still the command, so don't run it again.
+        if not activate(name):
+            return
+
+        entry = getattr(command, kind).get(cmd.upper())
+
+        if not entry or not (entry['funcs'] or entry['first'] or entry['last']):
+            logger.warning('Module %s did not register the %s command %s it was declared with.', name, kind, cmd)
+            return
+
+        on_thread = getattr(var.options, '%s_cmd_thread' % kind)
+
+        if kind == 'irc':
+            command.run(on_thread, entry, *args)
+        else:
+            args[0].run(on_thread, entry, cmd, args[:-1], args[-1])
+
+    return stub
+
+def activate(name):
+    '''Load lazy module `name` now, if it hasn't been already.'''
+
+    stubs = lazy.pop(name, None)
+
+    if stubs is None:
+        return find(name)
+
+    for cmd_type, cmd, stub in stubs:
+        command.delete(cmd, stub, cmd_type)
+
+    mod = load(name)
+
+    # Keep waiting, so it can be tried again once it's been fixed.
+    if not mod:
+        for cmd_type, cmd, stub in stubs:
+            command.add(cmd, stub, cmd_type)
+
+        lazy[name] = stubs
+
+    return mod
+
+def forget(name):
+    '''Drop the stubs of lazy module `name`, which hasn't been loaded yet.'''
+
+    for cmd_type, cmd, stub in lazy.pop(name, []):
+        command.delete(cmd, stub, cmd_type)
+
+def find(name):
+    '''Find a loaded module by the name it was loaded with.'''
+
+    for mod in var.modules_loaded:
+        if mod.__name__ == name:
+            return mod
+
+def setup(block):
+    '''Load the module of a `module` block, or declare it if it's lazy.'''
+
+    name = block.get('name')
+
+    if block.get('lazy'):
+        declare(name, block.get('lazy'))
+    else:
+        load(name)
+
+def rehash(added, removed, changed):
+    '''
+    Load and unload modules added to and removed from the configuration,
+    and reload modules whose block or file changed.
+    '''
+
+    for block in removed:
+        forget(block.get('name'))
+        mod = find(block.get('name'))
+
+        if mod:
+            unload(mod)
+
+    for old, new in changed:
+        name = new.get('name')
+        forget(name)
+        mod = find(name)
+
+        if new.get('lazy'):
+            if mod:
+                unload(mod)
+
+            declare(name, new.get('lazy'))
+        elif mod:
+            reload(name)
+        else:
+            load(name)
+
+    for block in added:
+        if block.get('name') != None:
+            setup(block)
+
+    for mod in var.modules_loaded[:]:
+        if mtimes.get(mod.__name__) != mtime(mod.__name__):
+            reload(mod.__name__)
+
 def load_all():
     '''Load all modules listed in the configuration.'''
 
@@ -56,16 +319,19 @@ def load_all():
         name = i.get('name')
 
         if name != None:
-           load(name)
+            setup(i)
 
         event.dispatch('OnLoadAllModules', name)
 
 def unload_all():
-    '''Unload all loaded modules.'''
+    '''Unload all loaded modules, the last loaded first.'''
 
     logger.info('Unloading all modules.')
 
-    for i in var.modules_loaded:
+    for name in lazy.keys():
+        forget(name)
+
+    for i in reversed(var.modules_loaded[:]):
         unload(i)
 
     event.dispatch('OnUnloadAllModules')
@@ -0,0 +1,180 @@
+# synarere -- a highly modular and stable IRC bot.
+# Copyright (C) 2010 Michael Rodriguez.
+# Rights to this code are documented in docs/LICENSE.
+
+'''Bounded worker thread pool for threaded command dispatch.'''
+
+# Import required Python modules.
+import Queue, threading, time, traceback
+
+# Import required core modules.
+import logger, var, event, metrics, sendq
+
+# The job queue and the threads working on it.
+# These are created the first time a job is submitted.
+jobs = None
+workers = []
+
+# Pool settings, taken from var.options when the pool starts.
+size, queue_size, overload = None, None, None
+
+# Counters describing how the pool is doing.
+stats = { 'submitted' : 0,
+          'completed' : 0,
+          'failed'    : 0,
+          'dropped'   : 0,
+          'max_depth' : 0,
+          'wait_total': 0.0,
+          'wait_max'  : 0.0 }
+
+# Guards `stats`, which is updated from every worker.
+lock = threading.Lock()
+
+# (network, folded nick) -> when we last told them we're busy. Nobody is
+# told more than once every `busy_interval` seconds, and no more than
+# `busy_max` people are told in that time, however many commands drop.
+told = {}
+busy_interval, busy_max = 60, 100
+
+def configure():
+    '''Read the pool settings from the configuration.'''
+
+    global size, queue_size, overload
+
+    size = max(1, var.options.workers)
+    queue_size = max(1, var.options.worker_queue)
+    overload = var.options.worker_overload
+
+def start():
+    '''Start the worker threads.'''
+
+    global jobs
+
+    configure()
+    jobs = Queue.Queue(queue_size)
+
+    for i in xrange(size):
+        worker = threading.Thread(target=work, name='synarere-worker-%d' % i)
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+
+    logger.info('Started %d worker thread%s (queue size %d, overload policy %s)', size, 's' if size != 1 else '', queue_size, overload)
+
+def work():
+    '''Run jobs from the queue forever.'''
+
+    while True:
+        func, args, queued = jobs.get()
+        start = time.time()
+        wait = start - queued
+
+        try:
+            func(*args)
+            failed = False
+        except:
+            logger.error('Worker job %s raised an exception:\n%s', func, traceback.format_exc())
+            failed = True
+
+        took = time.time() - start
+
+        lock.acquire()
+        try:
+            stats['completed'] += 1
+            stats['failed'] += failed
+            stats['wait_total'] += wait
+            stats['wait_max'] = max(stats['wait_max'], wait)
+        finally:
+            lock.release()
+
+        metrics.lock.acquire()
+        try:
+            metrics.job_time.observe(took, (getattr(func, '__name__', repr(func)),))
+        finally:
+            metrics.lock.release()
+
+def submit(func, args):
+    '''Queue `func(*args)` to be run by a worker. Returns False if the pool is full.'''
+
+    if jobs is None:
+        start()
+
+    try:
+        jobs.put_nowait((func, args, time.time()))
+    except Queue.Full:
+        overloaded(func, args, queue_size)
+        return False
+
+    depth = jobs.qsize()
+
+    lock.acquire()
+    try:
+        stats['submitted'] += 1
+        stats['max_depth'] = max(stats['max_depth'], depth)
+    finally:
+        lock.release()
+
+    return True
+
+def overloaded(func, args, limit):
+    '''Deal with a job that didn't fit into a queue of `limit` jobs.'''
+
+    lock.acquire()
+    try:
+        stats['dropped'] += 1
+    finally:
+        lock.release()
+
+    logger.warning('Worker queue is full (%d jobs), dropping %s', limit, func)
+    event.dispatch('OnWorkerOverload', func, args)
+
+    if overload != 'busy':
+        return
+
+    # Only user commands have someone to tell: (conn, (nick, user, host), ...)
+    try:
+        conn, (nick, user, host) = args[0], args[1]
+        key = (conn.server['id'], nick.translate(conn.router.table))
+    except (IndexError, TypeError, ValueError, AttributeError, KeyError):
+        return
+
+    now = time.time()
+
+    lock.acquire()
+    try:
+        if now - told.get(key, 0) < busy_interval:
+            return
+
+        if len(told) >= busy_max:
+            for who, when in told.items():
+                if now - when >= busy_interval:
+                    del told[who]
+
+            if len(told) >= busy_max:
+                return
+
+        told[key] = now
+    finally:
+        lock.release()
+
+    conn.notice(nick, 'I am busy right now, please try again later.', sendq.BULK)
+
+def depth():
+    '''Return the number of jobs waiting in the queue.'''
+
+    return jobs.qsize() if jobs else 0
+
+def get_stats():
+    '''Return a snapshot of the pool counters, including queue depth and average wait.'''
+
+    lock.acquire()
+    try:
+        snapshot = dict(stats)
+    finally:
+        lock.release()
+
+    snapshot['depth'] = depth()
+    snapshot['workers'] = len(workers)
+    snapshot['wait_avg'] = snapshot['wait_total'] / snapshot['completed'] if snapshot['completed'] else 0.0
+
+    return snapshot
@@ -0,0 +1,167 @@
+# synarere -- a highly modular and stable IRC bot.
+# Copyright (C) 2010 Michael Rodriguez.
+# Rights to this code are documented in docs/LICENSE.
+
+'''Process pool for CPU-heavy command handlers.'''
+
+# Import required Python modules.
+import cPickle, multiprocessing, signal, sys, threading, traceback
+
+# Import required Python function.
+from imp import load_source
+
+# Import required core modules.
+import logger, var, event, pool
+
+# The multiprocessing pool. Created the first time a job is submitted,
+# so that the workers are forked with every module already loaded.
+workers = None
+
+# Pool settings, taken from var.options when the pool starts.
+size, queue_size = None, None
+
+# Number of jobs submitted but not finished yet.
+pending = 0
+lock = threading.Lock()
+
+def init_worker():
+    '''Set up a freshly forked worker process.'''
+
+    # The parent deals with these, not us.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    logger.forked()
+
+def find(modname, funcname):
+    '''Find a handler in the worker by module and function name.'''
+
+    try:
+        mod = sys.modules[modname]
+    except KeyError:
+        # The module was loaded after we were forked.
+        mod = load_source(modname, modname)
+
+    return getattr(mod, funcname)
+
+def lines(result):
+    '''Make what a handler returned into something which always pickles: None, a string, or a list of them.'''
+
+    if result is None or isinstance(result, basestring):
+        return result
+
+    if isinstance(result, (list, tuple)):
+        return [line if isinstance(line, basestring) else str(line) for line in result]
+
+    return str(result)
+
+def execute(modname, funcname, payload):
+    '''Run a handler inside a worker, with its pickled arguments. Returns (ok, result).'''
+
+    try:
+        return True, lines(find(modname, funcname)(*cPickle.loads(payload)))
+    except:
+        return False, traceback.format_exc()
+
+def start():
+    '''Start the worker processes.'''
+
+    global workers, size, queue_size
+
+    size = var.options.process_workers or multiprocessing.cpu_count()
+    queue_size = max(1, var.options.process_queue)
+
+    workers = multiprocessing.Pool(size, init_worker)
+    logger.info('Started %d worker process%s', size, 'es' if size != 1 else '')
+
+def stop():
+    '''Stop the worker processes.'''
+
+    global workers, pending
+
+    if workers is None:
+        return
+
+    workers.terminate()
+    workers.join()
+    workers = None
+
+    # Whatever they were running is gone with them.
+    lock.acquire()
+    try:
+        pending = 0
+    finally:
+        lock.release()
+
+def submit(func, args):
+    '''
+    Run `func` in a worker process.
+
+    The first argument is expected to be the Connection. The worker gets
+    a copy of its server dict instead, and anything the handler returns
+    (a line, or a list of lines) is queued on the connection's sendq.
+    '''
+
+    global pending
+
+    if workers is None:
+        start()
+
+    lock.acquire()
+    try:
+        full = pending >= queue_size
+
+        if not full:
+            pending += 1
+    finally:
+        lock.release()
+
+    if full:
+        pool.overloaded(func, args, queue_size)
+        return False
+
+    conn = args[0]
+
+    # The pool only calls back on success, and a job it can't pickle
+    # never succeeds, so pickle it here where we can give the slot back.
+    try:
+        payload = cPickle.dumps((dict(conn.server),) + tuple(args[1:]), cPickle.HIGHEST_PROTOCOL)
+    except Exception:
+        release()
+        logger.error('Unable to send the arguments of process handler %s to a worker:\n%s', func, traceback.format_exc())
+        return False
+
+    workers.apply_async(execute, (func.__module__, func.__name__, payload), callback=lambda result: done(conn, func, result))
+    return True
+
+def release(count=1):
+    '''Give back `count` job slots.'''
+
+    global pending
+
+    lock.acquire()
+    try:
+        pending = max(0, pending - count)
+    finally:
+        lock.release()
+
+def done(conn, func, (ok, result)):
+    '''Queue the lines a handler gave back. Called on the pool's result thread.'''
+
+    release()
+
+    if not ok:
+        logger.error('Process handler %s raised an exception:\n%s', func, result)
+        return
+
+    if not result:
+        return
+
+    if isinstance(result, basestring):
+        result = [result]
+
+    for line in result:
+        conn.sendq.appendleft(line)
+
+    event.dispatch('OnProcessHandlerDone', conn.server, func, result)
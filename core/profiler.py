@@ -0,0 +1,125 @@
+# synarere -- a highly modular and stable IRC bot.
+# Copyright (C) 2010 Michael Rodriguez.
+# Rights to this code are documented in docs/LICENSE.
+
+'''
+Sampling profiler.
+
+While running, a thread looks at the stack of every other thread a
+hundred times a second. When stopped, the stacks it saw are written next
+to the `tbfile` in the collapsed format flamegraph.pl and speedscope
+read, one `thread;outer;...;inner count` line per distinct stack.
+
+Send synarere SIGUSR1 to start it and SIGUSR2 to stop it.
+'''
+
+# Import required Python modules.
+import os, sys, threading, time
+
+# Import required core modules.
+import logger, var
+
+# Seconds between samples.
+interval = 0.01
+
+# The sampling thread while we're running, and what it has seen so far.
+sampler = None
+stacks = {}
+started = None
+
+class Sampler(threading.Thread):
+    '''Take samples until told to stop.'''
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='profiler')
+        self.setDaemon(True)
+
+        self.stopping = threading.Event()
+        self.samples = 0
+
+    def run(self):
+        me = threading.currentThread().ident
+
+        while not self.stopping.isSet():
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+
+                key = collapse(names.get(ident, 'thread-%d' % ident), frame)
+                stacks[key] = stacks.get(key, 0) + 1
+
+            self.samples += 1
+            self.stopping.wait(interval)
+
+def label(code):
+    '''Name a stack frame: the file it's in and the function.'''
+
+    return '%s:%s' % (os.path.basename(code.co_filename), code.co_name)
+
+def collapse(name, frame):
+    '''Turn the stack ending in `frame` into one collapsed stack line.'''
+
+    calls = []
+
+    while frame is not None:
+        calls.append(label(frame.f_code))
+        frame = frame.f_back
+
+    calls.append(name)
+    calls.reverse()
+
+    # ';' separates frames and a space separates the count.
+    return ';'.join(calls).replace(' ', '_')
+
+def path():
+    '''Return the file the next profile goes into.'''
+
+    base = os.path.splitext(var.options.tbfile)[0]
+    return '%s.%d.%s.folded' % (base, os.getpid(), time.strftime('%Y%m%d-%H%M%S'))
+
+def start():
+    '''Start sampling. Does nothing if we already are.'''
+
+    global sampler, started
+
+    if sampler:
+        return False
+
+    stacks.clear()
+    started = time.time()
+
+    sampler = Sampler()
+    sampler.start()
+
+    logger.info('Profiler started, sampling every %gms.', interval * 1000)
+    return True
+
+def stop():
+    '''Stop sampling and write the profile out. Returns the file it went into.'''
+
+    global sampler
+
+    if not sampler:
+        return None
+
+    sampler.stopping.set()
+    sampler.join()
+
+    samples, sampler = sampler.samples, None
+    filename = path()
+
+    try:
+        fh = open(filename, 'w')
+
+        for stack, count in sorted(stacks.items()):
+            fh.write('%s %d\n' % (stack, count))
+
+        fh.close()
+    except IOError, e:
+        logger.error('Unable to write profile to %s: %s', filename, os.strerror(e.args[0]))
+        return None
+
+    logger.info('Profiler stopped after %.1f seconds (%d samples), profile written to %s', time.time() - started, samples, filename)
+    return filename
@@ -0,0 +1,120 @@
+# synarere -- a highly modular and stable IRC bot.
+# Copyright (C) 2010 Michael Rodriguez.
+# Rights to this code are documented in docs/LICENSE.
+
+'''
+When and where to reconnect.
+
+A network which loses its connection is reconnected to after `recontime`
+seconds, doubling with every attempt which fails to register, up to
+`recontime_max`. A random part of up to half of that is taken off, so
+bots which lost the same server don't all come back at the same moment.
+Networks with several addresses move on to the next one whenever an
+attempt fails.
+
+Reconnects are also kept at least 1 / `reconnect_rate` seconds apart
+from each other across all networks, so losing many at once (our own
+link going down, say) doesn't turn into a storm of connections.
+'''
+
+# Import required Python modules.
+import bisect, random, time
+
+# Import required core modules.
+import logger, var, timer, metrics
+
+# When the reconnects we scheduled are due, in order.
+slots = []
+
+def parse_addresses(address, port):
+    '''
+    Split the `address` of a network block into [(host, port)]. It is a
+    comma separated list of host, host:port or [IPv6 address]:port, and
+    `port` is used where none is given.
+    '''
+
+    servers = []
+
+    for item in address.split(','):
+        item = item.strip()
+
+        if not item:
+            continue
+
+        host, item_port = item, port
+
+        if item.startswith('['):
+            host, _, rest = item[1:].partition(']')
+
+            if rest.startswith(':'):
+                item_port = int(rest[1:])
+        elif item.count(':') == 1:
+            host, item_port = item.split(':')
+            item_port = int(item_port)
+
+        servers.append((host, item_port))
+
+    return servers
+
+def attempt(server):
+    '''We're about to connect to `server`. Pick the address to use and count it.'''
+
+    server['address'], server['port'] = server['servers'][server['current']]
+    server['tries'] += 1
+    server['attempts'] += 1
+
+    metrics.connect_attempts.inc(1, (server['id'],))
+
+def registered(server):
+    '''The server welcomed us, so the connection works.'''
+
+    server['tries'] = 0
+
+def delay(server):
+    '''Work out how long to wait before connecting to `server` again.'''
+
+    wait = min(server['recontime_max'], server['recontime'] * 2 ** server['tries'])
+    return wait - random.uniform(0, wait / 2.0)
+
+def spread(now, when):
+    '''Move `when` later until it is far enough from every other reconnect.'''
+
+    if var.options.reconnect_rate <= 0:
+        return when
+
+    gap = 1.0 / var.options.reconnect_rate
+
+    # Forget the ones which have happened.
+    del slots[:bisect.bisect_left(slots, now - gap)]
+
+    for slot in slots[bisect.bisect_left(slots, when - gap):]:
+        if slot - when >= gap:
+            break
+
+        when = slot + gap
+
+    bisect.insort(slots, when)
+    return when
+
+def lost(server, func):
+    '''
+    The connection to `server` closed, or couldn't be made. Schedule
+    func(server) to connect again, and return how long that will be.
+    '''
+
+    # The last attempt never got as far as registering.
+    if server['tries']:
+        server['failures'] += 1
+        metrics.connect_failures.inc(1, (server['id'],))
+
+        server['current'] = (server['current'] + 1) % len(server['servers'])
+
+    now = time.time()
+    when = spread(now, now + delay(server))
+
+    timer.add('io.reconnect', True, func, when - now, server)
+
+    if logger.tracing:
+        logger.debug('%s: %d attempt%s failed in a row', server['id'], server['tries'], 's' if server['tries'] != 1 else '')
+
+    return when - now
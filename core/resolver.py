@@ -0,0 +1,127 @@
+# synarere -- a highly modular and stable IRC bot.
+# Copyright (C) 2010 Michael Rodriguez.
+# Rights to this code are documented in docs/LICENSE.
+
+'''
+Name lookups off the main loop.
+
+getaddrinfo() blocks, for as long as the slowest DNS server likes. It is
+called from a few threads of our own instead, and the answers handed
+back to the main loop with io.call_soon(). Answers are cached for
+`dns_ttl` seconds, and lookups of a name which is already being looked
+up wait for that one instead of asking again.
+'''
+
+# Import required Python modules.
+import Queue, socket, threading, time, traceback
+
+# Import required core modules.
+import logger, var, io, metrics
+
+# How many lookups may run at once.
+max_threads = 4
+
+# Failed lookups are remembered for this long, so a broken name doesn't
+# get asked about on every reconnect.
+negative_ttl = 30
+
+# (host, port) -> (when it expires, getaddrinfo() result or None, error or None)
+cache = {}
+
+# (host, port) -> [callbacks waiting for the lookup in progress]
+waiting = {}
+
+# The lookups to do, the threads doing them and how many lookups are
+# queued or running.
+jobs = Queue.Queue()
+threads = []
+pending = 0
+
+# Guards `threads` and `pending`.
+lock = threading.Lock()
+
+lookups = metrics.Counter('synarere_dns_lookups_total', 'Name lookups, by whether the cache answered them.', ('result',))
+
+def resolve(host, port, callback):
+    '''
+    Look up `host`, and call callback(addresses, error) on the main loop.
+    `addresses` is what getaddrinfo() returns for TCP, or None if the
+    lookup failed, in which case `error` is the socket.error.
+    '''
+
+    key = (host, port)
+    cached = cache.get(key)
+
+    if cached and cached[0] > time.time():
+        lookups.inc(1, ('hit',))
+        callback(cached[1], cached[2])
+        return
+
+    if key in waiting:
+        waiting[key].append(callback)
+        return
+
+    lookups.inc(1, ('miss',))
+    waiting[key] = [callback]
+    grow()
+    jobs.put(key)
+
+def grow():
+    '''Count a new lookup, and start another thread for it if the others all have one and we may.'''
+
+    global pending
+
+    lock.acquire()
+
+    try:
+        pending += 1
+
+        if pending <= len(threads) or len(threads) >= max_threads:
+            return
+
+        worker = threading.Thread(target=work, name='synarere-resolver-%d' % len(threads))
+        worker.daemon = True
+        threads.append(worker)
+    finally:
+        lock.release()
+
+    worker.start()
+
+def work():
+    '''Do lookups forever.'''
+
+    global pending
+
+    while True:
+        key = jobs.get()
+
+        try:
+            result, error = socket.getaddrinfo(key[0], key[1], 0, socket.SOCK_STREAM), None
+        except socket.error, e:
+            result, error = None, e
+
+        lock.acquire()
+        pending -= 1
+        lock.release()
+
+        io.call_soon(done, key, result, error)
+
+def done(key, result, error):
+    '''A lookup finished. Cache it and tell everyone who was waiting for it.'''
+
+    if error:
+        lookups.inc(1, ('error',))
+        cache[key] = (time.time() + negative_ttl, None, error)
+    else:
+        cache[key] = (time.time() + var.options.dns_ttl, result, None)
+
+    for callback in waiting.pop(key, []):
+        try:
+            callback(result, error)
+        except Exception:
+            logger.error('Lookup callback %s for %s raised an exception:\n%s', callback, key[0], traceback.format_exc())
+
+def forget(host, port):
+    '''Drop the cached answer for `host`, so it's looked up again next time.'''
+
+    cache.pop((host, port), None)
@@ -0,0 +1,139 @@
+# synarere -- a highly modular and stable IRC bot.
+# Copyright (C) 2010 Michael Rodriguez.
+# Rights to this code are documented in docs/LICENSE.
+
+'''
+Compiled command routing.
+
+Every connection has a Router, which turns the command tables of
+command.py into one dict per kind of command, keyed by the command word
+exactly as a user would type it on that network: with the network's
+trigger, folded by the server's CASEMAPPING, aliases included. Routing
+a message is then a single dict lookup.
+
+Channel commands registered with a leading trigger character, like
+'.list', answer to the network's `trigger` instead of that character.
+Private commands answer both with and without the trigger.
+'''
+
+# Import required Python module.
+import string
+
+# Import required core module.
+import command
+
+# Case folding tables for the CASEMAPPING values servers announce in 005.
+casemappings = { 'ascii'           : string.maketrans(string.ascii_uppercase, string.ascii_lowercase),
+                 'rfc1459'         : string.maketrans(string.ascii_uppercase + '[]\\~', string.ascii_lowercase + '{}|^'),
+                 'strict-rfc1459'  : string.maketrans(string.ascii_uppercase + '[]\\', string.ascii_lowercase + '{}|') }
+
+# What servers that don't say use, according to the RFC.
+default_casemapping = 'rfc1459'
+
+def triggered(name):
+    '''Split a registered command name into (trigger, name). The trigger may be empty.'''
+
+    if name[:1].isalnum():
+        return '', name
+
+    return name[:1], name[1:]
+
+class Router(object):
+    '''
+    The compiled command tables of one network.
+
+    chan, chanme, priv, ctcp -- Folded command word -> command entry.
+    '''
+
+    __slots__ = ['server', 'casemapping', 'table', 'generation', 'chan', 'chanme', 'priv', 'ctcp']
+
+    def __init__(self, server):
+        self.server = server
+        self.generation = None
+        self.casemapping = None
+        self.set_casemapping(default_casemapping)
+
+    def set_casemapping(self, name):
+        '''Fold by CASEMAPPING `name`. Unknown ones are treated as rfc1459.'''
+
+        name = name.lower()
+
+        if name not in casemappings:
+            name = default_casemapping
+
+        if name == self.casemapping:
+            return
+
+        self.casemapping = name
+        self.table = casemappings[name]
+        self.generation = None
+
+    def fold(self, text):
+        '''Fold `text` the way the server compares nicks and channels.'''
+
+        return text.translate(self.table)
+
+    def invalidate(self):
+        '''Recompile before routing the next message.'''
+
+        self.generation = None
+
+    def compile(self):
+        '''Build the lookup tables from the command tables.'''
+
+        table, trigger = self.table, self.server.get('trigger')
+        routes = { 'chan' : {}, 'chanme' : {}, 'priv' : {}, 'ctcp' : {} }
+
+        def words(kind, name):
+            '''Every way of typing the command `name` of kind `kind`.'''
+
+            if kind == 'chan':
+                char, base = triggered(name)
+
+                if char and trigger:
+                    return [trigger + base]
+
+                return [name]
+
+            if kind == 'priv':
+                char, base = triggered(name)
+                return [base, (trigger or char or '') + base]
+
+            return [name]
+
+        for kind, routed in routes.items():
+            cmd_type = getattr(command, kind)
+
+            for name, entry in cmd_type.items():
+                for word in words(kind, name):
+                    routed[word.translate(table)] = entry
+
+            for name, target in command.aliases[kind].items():
+                if target in cmd_type:
+                    for word in words(kind, name):
+                        routed.setdefault(word.translate(table), cmd_type[target])
+
+        self.chan, self.chanme = routes['chan'], routes['chanme']
+        self.priv, self.ctcp = routes['priv'], routes['ctcp']
+        self.generation = command.generation
+
+    def current(self):
+        '''Make sure the tables are up to date. Returns self.'''
+
+        if self.generation != command.generation:
+            self.compile()
+
+        return self
+
+    def addressed(self, text, nick):
+        '''
+        If `text` starts by addressing `nick` ('nick: ...', 'nick, ...' or
+        'nick ...'), return what follows. Otherwise return None.
+        '''
+
+        size = len(nick)
+
+        if len(text) <= size or text[size] not in ':, ' or text[:size].translate(self.table) != nick.translate(self.table):
+            return None
+
+        return text[size + 1:].lstrip(':, ')
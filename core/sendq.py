@@ -0,0 +1,136 @@
+# synarere -- a highly modular and stable IRC bot.
+# Copyright (C) 2010 Michael Rodriguez.
+# Rights to this code are documented in docs/LICENSE.
+
+'''Send queue with priority lanes and token bucket flood control.'''
+
+# Import required Python modules.
+import time
+from collections import deque
+
+# Import required core modules.
+import io, timer
+
+# The lanes, highest priority first.
+# PROTOCOL -- Replies the server expects from us, such as PONG. These are
+#             never held back by flood control.
+# INTERACTIVE -- Everything else, unless told otherwise.
+# BULK -- Long output which may wait for the others.
+PROTOCOL, INTERACTIVE, BULK = 0, 1, 2
+
+# Commands which go into the PROTOCOL lane.
+protocol_cmds = frozenset(['PONG', 'PING', 'PASS', 'NICK', 'USER', 'QUIT', 'CAP', 'AUTHENTICATE'])
+
+def classify(line):
+    '''Return the lane `line` belongs in.'''
+
+    cmd = line.split(' ', 1)[0].upper()
+
+    if cmd in protocol_cmds:
+        return PROTOCOL
+
+    return INTERACTIVE
+
+class SendQueue(object):
+    '''
+    Lines waiting to be sent to a server.
+
+    Lines are queued with appendleft() and taken with pop(), just like the
+    deque this replaces, but pop() always takes the oldest line from the
+    highest priority lane that has one. If `rate` is set, a token bucket
+    holding up to `burst` lines which refills at `rate` lines per second
+    decides when ready() lets the next line go. `conn` is the dispatcher
+    writing the lines, which the loop is told about when it may write.
+    '''
+
+    def __init__(self, conn, burst=0, rate=0):
+        self.conn = conn
+        self.lanes = (deque(), deque(), deque())
+        self.burst = burst
+        self.rate = rate
+        self.tokens = float(self.capacity())
+        self.stamp = time.time()
+
+        # Timer which wakes the loop up once a token is available again.
+        self.refill_timer = None
+
+    def __len__(self):
+        return len(self.lanes[PROTOCOL]) + len(self.lanes[INTERACTIVE]) + len(self.lanes[BULK])
+
+    def __nonzero__(self):
+        return bool(self.lanes[PROTOCOL] or self.lanes[INTERACTIVE] or self.lanes[BULK])
+
+    def appendleft(self, line, lane=None):
+        '''Queue `line`, in `lane` if given, otherwise in the lane its command belongs in.'''
+
+        if lane is None:
+            lane = classify(line)
+
+        self.lanes[lane].appendleft(line)
+        io.notify(self.conn)
+
+    def pop(self):
+        '''Take the next line to send, using up a token.'''
+
+        for lane in self.lanes:
+            if lane:
+                # PROTOCOL lines go out even without a token. Let them run
+                # up a debt of at most one burst, so a lot of them doesn't
+                # hold everything else back for ever.
+                self.tokens = max(self.tokens - 1, -float(self.capacity()))
+                return lane.pop()
+
+        raise IndexError('pop from an empty send queue')
+
+    def clear(self):
+        '''Throw away everything queued.'''
+
+        for lane in self.lanes:
+            lane.clear()
+
+    def capacity(self):
+        '''How many tokens the bucket holds. A rate without a burst still lets one line at a time through.'''
+
+        return max(1, self.burst)
+
+    def refill(self):
+        '''Add the tokens that accumulated since we last looked.'''
+
+        now = time.time()
+        self.tokens = min(float(self.capacity()), self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def ready(self):
+        '''See if the next line may be sent now.'''
+
+        if not self:
+            return False
+
+        if not self.rate or self.lanes[PROTOCOL]:
+            return True
+
+        self.refill()
+
+        if self.tokens >= 1:
+            return True
+
+        # Make sure the loop wakes up when we can send again.
+        if not self.refill_timer or not self.refill_timer['active']:
+            self.refill_timer = timer.add('sendq.refill', True, lambda q: io.notify(q.conn), (1 - self.tokens) / self.rate, self)
+
+        return False
+
+    def delay(self, lane=INTERACTIVE):
+        '''Predict how many seconds a line queued in `lane` now would wait before being sent.'''
+
+        if not self.rate or lane == PROTOCOL:
+            return 0.0
+
+        self.refill()
+
+        ahead = 0
+
+        for queued in self.lanes[:lane + 1]:
+            ahead += len(queued)
+
+        return max(0.0, (ahead + 1 - self.tokens) / self.rate)
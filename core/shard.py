@@ -0,0 +1,454 @@
+# synarere -- a highly modular and stable IRC bot.
+# Copyright (C) 2010 Michael Rodriguez.
+# Rights to this code are documented in docs/LICENSE.
+
+'''
+Network sharding.
+
+With `shards` set in the options block, synarere runs as a supervisor
+and that many worker processes. Every worker loads all modules but only
+connects to its share of the networks: the networks in the configuration
+are dealt out in order when we start, and networks added by a rehash go
+to the worker picked by a hash of their id.
+
+Workers send their log messages and metrics to the supervisor over a
+socketpair. The supervisor writes the logs, serves the metrics of all of
+them from `stats_listen`, restarts workers which die and passes lines for
+networks on other workers along (see push()).
+'''
+
+# Import required Python modules.
+import asyncore, errno, json, logging, os, signal, socket, time, traceback, zlib
+from collections import deque
+from core import shutdown
+
+# Import required core modules.
+import logger, var, timer, irc, io, module, metrics, confparse, procpool
+
+# 'supervisor' or 'worker' while sharding, None otherwise.
+role = None
+
+# Which worker we are, in a worker.
+index = None
+
+# Network id -> worker, for the networks dealt out at startup.
+assigned = {}
+
+# Worker number -> { 'pid', 'link', 'started', 'crashes', 'metrics' }, in the supervisor.
+workers = {}
+
+# Our link to the supervisor, in a worker.
+link = None
+
+# The signal handlers workers get, as they were before the supervisor changed them.
+handlers = {}
+
+# How often workers send their metrics, in seconds.
+metrics_interval = 5
+
+# Workers which ran for this long before dying are restarted right away.
+stable_time = 60
+
+# Set while shutting down, so dead workers aren't restarted.
+stopping = False
+
+restarts = metrics.Counter('synarere_shard_restarts_total', 'Worker processes restarted after dying.', ('worker',))
+
+class Link(asyncore.dispatcher):
+    '''
+    One end of the socketpair between the supervisor and a worker.
+    Messages are dicts of strings and numbers, sent as JSON, one per line.
+    '''
+
+    def __init__(self, sock, received, lost):
+        asyncore.dispatcher.__init__(self, sock)
+
+        self.received = received
+        self.lost = lost
+        self.inbuf = ''
+
+        # Appended to by any thread, written out by the main loop.
+        self.outbuf = deque()
+
+    def send_message(self, message):
+        '''Queue `message` for the other end. Safe to call from any thread.'''
+
+        # IRC isn't always UTF-8, so pass bytes through as latin-1.
+        message = dict((k, v.decode('latin-1') if isinstance(v, str) else v) for k, v in message.iteritems())
+
+        self.outbuf.append(json.dumps(message) + '\n')
+        io.notify(self)
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return bool(self.outbuf)
+
+    def handle_read(self):
+        try:
+            data = self.recv(65536)
+        except socket.error, why:
+            if why.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+
+            raise
+
+        if not data:
+            self.handle_close()
+            return
+
+        lines = (self.inbuf + data).split('\n')
+        self.inbuf = lines.pop()
+
+        for line in lines:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+
+            self.received(dict((str(k), v.encode('latin-1') if isinstance(v, unicode) else v) for k, v in message.iteritems()))
+
+    def handle_write(self):
+        chunks, size = [], 0
+
+        while self.outbuf and size < 65536:
+            chunks.append(self.outbuf.popleft())
+            size += len(chunks[-1])
+
+        data = ''.join(chunks)
+        sent = self.send(data)
+
+        if sent < len(data):
+            self.outbuf.appendleft(data[sent:])
+
+    def handle_close(self):
+        # asyncore can tell us more than once.
+        lost, self.lost = self.lost, None
+        self.close()
+
+        if lost:
+            lost()
+
+    def handle_error(self):
+        logger.error('Shard link failed:\n%s', traceback.format_exc())
+        self.handle_close()
+
+class LinkHandler(logging.Handler):
+    '''Send a worker's log records to the supervisor.'''
+
+    def emit(self, record):
+        text = record.getMessage()
+
+        if record.exc_info:
+            text += '\n' + logging.Formatter().formatException(record.exc_info)
+
+        if link:
+            link.send_message({ 'type' : 'log', 'level' : record.levelno, 'text' : text })
+
+def owner(id):
+    '''Return the number of the worker which runs network `id`.'''
+
+    if id in assigned:
+        return assigned[id]
+
+    return (zlib.crc32(id) & 0xffffffff) % var.options.shards
+
+def owns(id):
+    '''See if network `id` is ours to connect to.'''
+
+    if role is None:
+        return True
+
+    if role == 'supervisor':
+        return False
+
+    return owner(id) == index
+
+def push(network, line):
+    '''
+    Send `line` to network `network`, even if another worker runs it.
+    Returns False if we don't know about that network.
+    '''
+
+    conn = irc.find_conn(irc.find_server(network))
+
+    if conn:
+        conn.push(line)
+        return True
+
+    if role == 'worker' and link:
+        link.send_message({ 'type' : 'push', 'network' : network, 'line' : line })
+        return True
+
+    return False
+
+def start():
+    '''
+    Start sharding, if the options block asks for it.
+    If it does, this never returns: we either supervise or run a worker.
+    '''
+
+    global role
+
+    count = var.options.shards
+
+    if not count:
+        return
+
+    role = 'supervisor'
+
+    for i, block in enumerate(var.conf.get('network')):
+        assigned[block.get('id')] = i % count
+
+    for sig in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM, signal.SIGCHLD):
+        handlers[sig] = signal.getsignal(sig)
+
+    # We need to wait for our workers to know why they died.
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, lambda signum, frame: io.call_soon(rehash))
+
+    for i in xrange(count):
+        spawn(i)
+
+    logger.info('Supervising %d worker%s.', count, 's' if count != 1 else '')
+
+    metrics.collectors.append(collect)
+    metrics.listen()
+
+    io.io()
+
+def spawn(i):
+    '''Start worker `i`.'''
+
+    ours, theirs = socket.socketpair()
+    pid = os.fork()
+
+    if pid == 0:
+        ours.close()
+        become_worker(i, theirs)
+
+    theirs.close()
+
+    old = workers.get(i, {})
+    workers[i] = { 'pid'     : pid,
+                   'link'    : Link(ours, lambda message: received(i, message), lambda: lost(i)),
+                   'started' : time.time(),
+                   'crashes' : old.get('crashes', 0),
+                   'metrics' : None }
+
+    logger.info('Started worker %d (pid %d).', i, pid)
+
+def become_worker(i, sock):
+    '''Turn a freshly forked child into worker `i`. Never returns.'''
+
+    global role, index, link
+
+    role, index = 'worker', i
+
+    # Forget everything of the supervisor's without closing it for the supervisor too.
+    for obj in asyncore.socket_map.values():
+        try:
+            obj.socket.close()
+        except (AttributeError, socket.error):
+            pass
+
+    asyncore.socket_map.clear()
+    io.reset()
+
+    var.timers[:] = []
+    timer.cancelled = 0
+
+    metrics.listener = None
+    del metrics.collectors[:]
+    metrics.reset()
+    workers.clear()
+
+    for sig, handler in handlers.iteritems():
+        signal.signal(sig, handler)
+
+    # shutdown() is the supervisor's way out. Ours is leave().
+    signal.signal(signal.SIGINT, lambda signum, frame: io.call_soon(leave, signal.SIGINT, 'Caught SIGINT (terminal interrupt)'))
+    signal.signal(signal.SIGTERM, lambda signum, frame: io.call_soon(leave, signal.SIGTERM, 'Caught SIGTERM'))
+
+    # Our logs go through the supervisor.
+    logger.forked()
+    var.log.addHandler(LinkHandler())
+    logger.tracing = var.log.isEnabledFor(logging.DEBUG)
+
+    link = Link(sock, worker_received, lambda: leave(os.EX_SOFTWARE, 'Lost the supervisor'))
+
+    # Never go back up into the supervisor's code, whatever happens.
+    try:
+        module.load_all()
+        irc.connect_to_all()
+
+        timer.add('shard.metrics', False, send_metrics, metrics_interval)
+        send_metrics(None)
+
+        io.io()
+    except SystemExit, e:
+        os._exit(e.code if isinstance(e.code, int) else os.EX_SOFTWARE)
+    except:
+        traceback.print_exc()
+        os._exit(os.EX_SOFTWARE)
+
+    os._exit(os.EX_OK)
+
+def leave(code=0, reason='No reason specified.'):
+    '''
+    Quit IRC and exit, in a worker. The pidfile and the stats listener are
+    the supervisor's, so unlike shutdown() this leaves them alone.
+    '''
+
+    try:
+        logger.info('Exiting with code %d: %s', code, reason)
+        irc.quit_all('shutdown(): exiting with code %d: %s' % (code, reason))
+        irc.flush_all()
+        module.unload_all()
+        procpool.stop()
+    except Exception:
+        logger.error('Cleaning up failed:\n%s', traceback.format_exc())
+
+    # Get our last log messages to the supervisor, if it is still there.
+    if link and link.connected and link.writable():
+        try:
+            link.handle_write()
+        except socket.error:
+            pass
+
+    # become_worker() turns this into os._exit().
+    raise SystemExit(code)
+
+def send_metrics(args):
+    '''Send our metrics to the supervisor.'''
+
+    link.send_message({ 'type' : 'metrics', 'text' : metrics.local() })
+
+def worker_received(message):
+    '''Handle a message from the supervisor.'''
+
+    if message.get('type') == 'push':
+        conn = irc.find_conn(irc.find_server(message['network']))
+
+        if conn:
+            conn.push(message['line'])
+        else:
+            logger.warning('Asked to send to network %s, which is not connected.', message['network'])
+
+def received(i, message):
+    '''Handle a message from worker `i`.'''
+
+    kind = message.get('type')
+
+    if kind == 'log':
+        var.log.log(message['level'], 'worker %d: %s', i, message['text'])
+
+    elif kind == 'metrics':
+        workers[i]['metrics'] = message['text']
+
+    elif kind == 'push':
+        target = workers.get(owner(message['network']))
+
+        if target and target['link']:
+            target['link'].send_message(message)
+        else:
+            logger.warning('Worker %d sent a line to network %s, whose worker is not running.', i, message['network'])
+
+def lost(i):
+    '''Worker `i` went away. Find out why, and restart it.'''
+
+    worker = workers[i]
+    worker['link'] = None
+
+    pid, status = reap(worker['pid'])
+
+    if os.WIFSIGNALED(status):
+        why = 'killed by signal %d' % os.WTERMSIG(status)
+    else:
+        why = 'exit status %d' % os.WEXITSTATUS(status)
+
+    if stopping:
+        logger.info('Worker %d (pid %d) stopped (%s).', i, worker['pid'], why)
+        return
+
+    if time.time() - worker['started'] > stable_time:
+        worker['crashes'] = 0
+
+    delay = min(60, 2 ** worker['crashes'] - 1)
+    worker['crashes'] += 1
+
+    logger.error('Worker %d (pid %d) died (%s), restarting it in %d second%s.', i, worker['pid'], why, delay, 's' if delay != 1 else '')
+    restarts.inc(1, (str(i),))
+
+    timer.add('shard.restart', True, spawn, delay, i)
+
+def reap(pid):
+    '''Wait for `pid` to exit, killing it if it hasn't already. Returns (pid, status).'''
+
+    try:
+        done, status = os.waitpid(pid, os.WNOHANG)
+
+        if done:
+            return done, status
+
+        # It closed the link but is still around, so it's no use to us.
+        os.kill(pid, signal.SIGKILL)
+        return os.waitpid(pid, 0)
+    except OSError:
+        return pid, 0
+
+def rehash():
+    '''Reload what the supervisor uses of the configuration, and tell every worker to rehash.'''
+
+    logger.info('Rehashing configuration due to SIGHUP, and telling the workers to.')
+
+    try:
+        var.conf.parse()
+    except (confparse.Exception, IOError), e:
+        logger.error('Rehash of %s failed, keeping the old configuration: %s', var.conf.file, e)
+    else:
+        logger.rehash()
+
+    for worker in workers.itervalues():
+        if worker['link']:
+            os.kill(worker['pid'], signal.SIGHUP)
+
+def collect():
+    '''Return the latest metrics of every worker, for metrics.exposition().'''
+
+    return [(str(i), worker['metrics']) for i, worker in sorted(workers.items()) if worker['metrics']]
+
+def stop():
+    '''Stop every worker, waiting a few seconds for them to quit IRC properly.'''
+
+    global stopping
+
+    if role != 'supervisor':
+        return
+
+    stopping = True
+    alive = [worker['pid'] for worker in workers.itervalues() if worker['link']]
+
+    for pid in alive:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    deadline = time.time() + 5
+
+    while alive and time.time() < deadline:
+        for pid in alive[:]:
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0]:
+                    alive.remove(pid)
+            except OSError:
+                alive.remove(pid)
+
+        # Meanwhile, read what they have to say on the way out.
+        io.update()
+        io.poll(0.05)
+
+    for pid in alive:
+        reap(pid)
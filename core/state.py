@@ -0,0 +1,411 @@
+# synarere -- a highly modular and stable IRC bot.
+# Copyright (C) 2010 Michael Rodriguez.
+# Rights to this code are documented in docs/LICENSE.
+
+'''
+Who is on the channels we're on.
+
+Every Connection has a State, kept up to date from JOIN, PART, QUIT,
+NICK, KICK, MODE and the NAMES (353) and WHO (352) replies as they are
+parsed, before any handlers see them. Modules ask it instead of sending
+NAMES and WHO themselves:
+
+    if conn.state.is_on('#synarere', nick): ...
+    if '@' in (conn.state.status('#synarere', nick) or ''): ...
+
+Only the channels we are on are tracked, and only the users on them. A
+user is forgotten as soon as we no longer share a channel with them, so
+what is kept never grows past the size of those channels. Each user is
+a single User, however many channels they're on, and nicks, idents,
+hosts and channel names are interned, so the thousands of users behind
+one cloak share one copy of the host.
+
+The state is only changed on the main loop. Handlers running on a
+worker thread may read it, but should copy what they go through, like
+list(conn.state.channel(name).users), since it can change under them.
+'''
+
+# Import required core modules.
+import var, metrics, message, sendq
+
+# The commands the state is fed from.
+tracked = frozenset(['JOIN', 'PART', 'QUIT', 'NICK', 'KICK', 'MODE', '353', '352'])
+
+# What servers which don't say use, according to the RFC.
+default_prefix = '(ov)@+'
+default_chanmodes = 'beI,k,l,imnpst'
+
+class User(object):
+    '''
+    Someone on a channel we're on.
+
+    nick, user, host -- Their nick!user@host. The user and host are None
+                        until we've seen them.
+    channels         -- The Channels we share with them.
+    '''
+
+    __slots__ = ['nick', 'user', 'host', 'channels']
+
+    def __init__(self, nick, user, host):
+        self.nick = nick
+        self.user = user
+        self.host = host
+        self.channels = []
+
+    def __repr__(self):
+        return '<User %s!%s@%s on %d channel%s>' % (self.nick, self.user, self.host, len(self.channels), 's' if len(self.channels) != 1 else '')
+
+class Channel(object):
+    '''
+    A channel we're on.
+
+    name  -- Its name, as the server spelt it.
+    users -- User -> their status prefixes on it, like '@', '@+' or ''.
+    '''
+
+    __slots__ = ['name', 'users']
+
+    def __init__(self, name):
+        self.name = name
+        self.users = {}
+
+    def __repr__(self):
+        return '<Channel %s with %d user%s>' % (self.name, len(self.users), 's' if len(self.users) != 1 else '')
+
+class State(object):
+    '''
+    The channels we're on and the users on them, for one connection.
+
+    users    -- Folded nick -> User.
+    channels -- Folded channel name -> Channel.
+    '''
+
+    __slots__ = ['router', 'users', 'channels', 'modes', 'symbols', 'param_always', 'param_set']
+
+    def __init__(self, router):
+        self.router = router
+        self.users = {}
+        self.channels = {}
+
+        self.set_prefix(default_prefix)
+        self.set_chanmodes(default_chanmodes)
+
+    def set_prefix(self, value):
+        '''Use the PREFIX from 005, like '(ov)@+', for the status modes of channel members.'''
+
+        modes, _, symbols = value.lstrip('(').partition(')')
+
+        if len(modes) != len(symbols):
+            return
+
+        # Highest first, the way the server listed them.
+        self.modes = dict(zip(modes, symbols))
+        self.symbols = symbols
+
+    def set_chanmodes(self, value):
+        '''Use the CHANMODES from 005, to know which channel modes take a parameter.'''
+
+        groups = (value.split(',') + ['', '', ''])[:4]
+
+        # Lists and keys always take one, limits and the like only when set.
+        self.param_always = frozenset(groups[0] + groups[1])
+        self.param_set = frozenset(groups[2])
+
+    def channel(self, name):
+        '''Return the Channel `name`, or None if we're not on it.'''
+
+        return self.channels.get(name.translate(self.router.table))
+
+    def user(self, nick):
+        '''Return the User `nick`, or None if we share no channel with them.'''
+
+        return self.users.get(nick.translate(self.router.table))
+
+    def is_on(self, name, nick):
+        '''See if `nick` is on channel `name`.'''
+
+        table = self.router.table
+        chan = self.channels.get(name.translate(table))
+        user = self.users.get(nick.translate(table))
+
+        return chan is not None and user is not None and user in chan.users
+
+    def status(self, name, nick):
+        '''Return the status prefixes of `nick` on channel `name`, or None if they're not on it.'''
+
+        table = self.router.table
+        chan = self.channels.get(name.translate(table))
+        user = self.users.get(nick.translate(table))
+
+        if chan is None or user is None:
+            return None
+
+        return chan.users.get(user)
+
+    def clear(self):
+        '''Forget everything. The connection is gone.'''
+
+        for user in self.users.itervalues():
+            user.channels = []
+
+        for chan in self.channels.itervalues():
+            chan.users.clear()
+
+        self.users.clear()
+        self.channels.clear()
+
+    def update(self, conn, msg):
+        '''Apply `msg`, which is one of the `tracked` commands, received on `conn`.'''
+
+        handlers[msg.command](self, conn, msg)
+
+    def seen(self, nick, user, host):
+        '''Return the User `nick`, making one if we didn't know them, and fill in their user@host.'''
+
+        key = nick.translate(self.router.table)
+        found = self.users.get(key)
+
+        if found is None:
+            found = User(intern(nick), user and intern(user), host and intern(host))
+            self.users[intern(key)] = found
+        elif host and found.host != host:
+            found.user, found.host = user and intern(user), intern(host)
+
+        return found
+
+    def add(self, chan, user, status=''):
+        '''Put `user` on `chan`, with `status` if given.'''
+
+        if user not in chan.users:
+            user.channels.append(chan)
+
+        chan.users[user] = status and intern(status)
+
+    def remove(self, chan, user):
+        '''Take `user` off `chan`, forgetting them if that was the last channel we shared.'''
+
+        if chan.users.pop(user, None) is None:
+            return
+
+        user.channels.remove(chan)
+
+        if not user.channels:
+            self.users.pop(user.nick.translate(self.router.table), None)
+
+    def drop(self, key):
+        '''We left the channel `key`. Forget it, and everyone we only knew from it.'''
+
+        chan = self.channels.pop(key, None)
+
+        if chan is None:
+            return
+
+        for user in chan.users.keys():
+            self.remove(chan, user)
+
+    def is_me(self, conn, nick):
+        '''See if `nick` is us on `conn`.'''
+
+        return nick.translate(self.router.table) == conn.nick.translate(self.router.table)
+
+    def on_join(self, conn, msg):
+        '''Someone joined a channel. If it was us, start tracking it.'''
+
+        nick, user, host = msg.source()
+
+        if not nick or not msg.params:
+            return
+
+        for name in msg.params[0].split(','):
+            key = name.translate(self.router.table)
+            chan = self.channels.get(key)
+
+            if self.is_me(conn, nick):
+                if chan is None:
+                    chan = self.channels[intern(key)] = Channel(intern(name))
+
+                # NAMES comes by itself, but only has the nicks.
+                conn.push('WHO %s' % name, sendq.BULK)
+
+            if chan is not None:
+                self.add(chan, self.seen(nick, user, host))
+
+    def on_part(self, conn, msg):
+        '''Someone left a channel.'''
+
+        nick = msg.nick
+
+        if not nick or not msg.params:
+            return
+
+        for name in msg.params[0].split(','):
+            self.leave(conn, name.translate(self.router.table), nick)
+
+    def on_kick(self, conn, msg):
+        '''Someone was kicked from a channel.'''
+
+        if len(msg.params) < 2:
+            return
+
+        self.leave(conn, msg.params[0].translate(self.router.table), msg.params[1])
+
+    def leave(self, conn, key, nick):
+        '''`nick` left the channel `key`.'''
+
+        if self.is_me(conn, nick):
+            self.drop(key)
+            return
+
+        chan = self.channels.get(key)
+        user = self.users.get(nick.translate(self.router.table))
+
+        if chan is not None and user is not None:
+            self.remove(chan, user)
+
+    def on_quit(self, conn, msg):
+        '''Someone left IRC, and so every channel.'''
+
+        nick = msg.nick
+
+        if not nick:
+            return
+
+        user = self.users.pop(nick.translate(self.router.table), None)
+
+        if user is None:
+            return
+
+        for chan in user.channels:
+            chan.users.pop(user, None)
+
+        user.channels = []
+
+    def on_nick(self, conn, msg):
+        '''Someone changed their nick.'''
+
+        nick = msg.nick
+
+        if not nick or not msg.params:
+            return
+
+        table = self.router.table
+        user = self.users.pop(nick.translate(table), None)
+
+        if user is None:
+            return
+
+        new = msg.params[-1]
+        user.nick = intern(new)
+        self.users[intern(new.translate(table))] = user
+
+    def on_mode(self, conn, msg):
+        '''Channel modes changed. Only the status of members is tracked.'''
+
+        if len(msg.params) < 2:
+            return
+
+        chan = self.channels.get(msg.params[0].translate(self.router.table))
+
+        if chan is None:
+            return
+
+        args = msg.params[2:]
+        adding, i = True, 0
+
+        for mode in msg.params[1]:
+            if mode == '+':
+                adding = True
+            elif mode == '-':
+                adding = False
+            elif mode in self.modes:
+                if i < len(args):
+                    self.set_status(chan, args[i], self.modes[mode], adding)
+
+                i += 1
+            elif mode in self.param_always or (adding and mode in self.param_set):
+                i += 1
+
+    def set_status(self, chan, nick, symbol, adding):
+        '''Give `nick` on `chan` the status `symbol`, or take it away.'''
+
+        user = self.users.get(nick.translate(self.router.table))
+        status = chan.users.get(user)
+
+        if status is None:
+            return
+
+        if adding:
+            status = ''.join(s for s in self.symbols if s in status or s == symbol)
+        else:
+            status = status.replace(symbol, '')
+
+        chan.users[user] = status and intern(status)
+
+    def on_names(self, conn, msg):
+        '''A line of NAMES reply: <me> [=*@] <channel> :<names>'''
+
+        if len(msg.params) < 3:
+            return
+
+        chan = self.channels.get(msg.params[-2].translate(self.router.table))
+
+        if chan is None:
+            return
+
+        symbols = self.symbols
+
+        for name in msg.params[-1].split():
+            i = 0
+
+            while i < len(name) and name[i] in symbols:
+                i += 1
+
+            # Some servers send nick!user@host here.
+            nick, user, host = message.split_prefix(name[i:])
+
+            if nick:
+                self.add(chan, self.seen(nick, user, host), name[:i])
+
+    def on_who(self, conn, msg):
+        '''A line of WHO reply: <me> <channel> <user> <host> <server> <nick> <H|G>[*][status] :<hops> <real name>'''
+
+        if len(msg.params) < 7:
+            return
+
+        table = self.router.table
+        chan = self.channels.get(msg.params[1].translate(table))
+        user, host, nick, flags = msg.params[2], msg.params[3], msg.params[5], msg.params[6]
+
+        if chan is None:
+            found = self.users.get(nick.translate(table))
+
+            if found is not None:
+                found.user, found.host = intern(user), intern(host)
+
+            return
+
+        self.add(chan, self.seen(nick, user, host), ''.join(s for s in flags[1:] if s in self.symbols))
+
+# Command -> what to do with it.
+handlers = { 'JOIN' : State.on_join,
+             'PART' : State.on_part,
+             'KICK' : State.on_kick,
+             'QUIT' : State.on_quit,
+             'NICK' : State.on_nick,
+             'MODE' : State.on_mode,
+             '353'  : State.on_names,
+             '352'  : State.on_who }
+
+def tracked_gauge(attr):
+    '''Make a gauge function reporting len(getattr(conn.state, attr)) per network.'''
+
+    def read():
+        # Import required core module.
+        import irc
+
+        return dict(((conn.server['id'],), len(getattr(conn.state, attr))) for conn in var.conns if isinstance(conn, irc.Connection))
+
+    return read
+
+users = metrics.Gauge('synarere_users', 'Users we share a channel with.', ('network',), tracked_gauge('users'))
+channels = metrics.Gauge('synarere_channels', 'Channels we are on.', ('network',), tracked_gauge('channels'))
@@ -0,0 +1,97 @@
+# synarere -- a highly modular and stable IRC bot.
+# Copyright (C) 2010 Michael Rodriguez.
+# Rights to this code are documented in docs/LICENSE.
+
+'''Cooperative tasks for command handlers written as generators.'''
+
+# Import required Python modules.
+import inspect, traceback, types
+
+# Import required core modules.
+import logger, timer, event
+
+# Tasks which are currently suspended.
+tasks = []
+
+def is_task(func):
+    '''See if `func` is a generator function, and so runs as a task.'''
+
+    return inspect.isgeneratorfunction(func)
+
+def spawn(gen, name=None):
+    '''
+    Start running the generator `gen` as a task.
+
+    The generator is resumed on the main loop whenever it yields:
+        yield            -- let everything else run, resume on the next loop pass.
+        yield <seconds>  -- sleep for that many seconds.
+    '''
+
+    task = { 'name' : name or getattr(gen, '__name__', repr(gen)),
+             'gen'  : gen,
+             'timer': None }
+
+    tasks.append(task)
+    event.dispatch('OnTaskSpawn', task)
+
+    step(task)
+    return task
+
+def step(task):
+    '''Resume `task` until it yields again or finishes.'''
+
+    task['timer'] = None
+
+    try:
+        delay = task['gen'].next()
+    except StopIteration:
+        finish(task)
+        return
+    except:
+        logger.error('Task %s raised an exception:\n%s', task['name'], traceback.format_exc())
+        finish(task)
+        return
+
+    if delay is None:
+        delay = 0
+
+    if not isinstance(delay, (int, long, float)):
+        logger.error('Task %s yielded %r, which is not a number of seconds.', task['name'], delay)
+        kill(task)
+        return
+
+    task['timer'] = timer.add('task.step', True, step, delay, task)
+
+def finish(task):
+    '''Forget about a task that has finished.'''
+
+    try:
+        tasks.remove(task)
+    except ValueError:
+        return
+
+    event.dispatch('OnTaskFinish', task)
+
+def kill(task):
+    '''Stop `task` and close its generator.'''
+
+    if task['timer']:
+        timer.cancel(task['timer'])
+        task['timer'] = None
+
+    try:
+        task['gen'].close()
+    except:
+        logger.error('Task %s raised an exception while closing:\n%s', task['name'], traceback.format_exc())
+
+    finish(task)
+
+def run(func, args):
+    '''Call `func` with `args`, running the result as a task if it's a generator.'''
+
+    result = func(*args)
+
+    if isinstance(result, types.GeneratorType):
+        return spawn(result, func.__name__)
+
+    return result
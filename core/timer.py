@@ -5,19 +5,43 @@
 '''Timer stuff.'''
 
 # Import required Python modules.
-import time
+import heapq, itertools, time
 
 # Import required core modules.
-import var, event
+import var, event, metrics
 
-# The lowest time when a timer must execute.
-timer_min = -1
+# `var.timers` is a binary min-heap of [when, seq, timer] entries.
+# `seq` breaks ties between timers due at the same moment, so that
+# they run in the order they were added and dicts are never compared.
+_seq = itertools.count()
+
+# Number of cancelled timers still sitting in the heap.
+# They are discarded lazily when they reach the top, or all at once
+# when they make up more than half of the heap.
+cancelled = 0
+
+def _push(timer):
+    '''Schedule `timer` at its current `when`.'''
+
+    entry = [timer['when'], next(_seq), timer]
+    timer['entry'] = entry
+    heapq.heappush(var.timers, entry)
+
+def _compact():
+    '''Drop every cancelled timer from the heap.'''
+
+    global cancelled
+
+    var.timers = [entry for entry in var.timers if entry[2]['active']]
+    heapq.heapify(var.timers)
+    cancelled = 0
 
 def add(name, only_once, func, freq, args=None):
-    '''Add a new timer to be executed every `freq` seconds.'''
+    '''
+    Add a new timer to be executed every `freq` seconds.
+    Returns a handle which can be given to cancel().
+    '''
 
-    global timer_min
-    
     timer = { 'name'  : name,
               'func'  : func,
               'args'  : args,
@@ -25,51 +49,84 @@ def add(name, only_once, func, freq, args=None):
               'when'  : (time.time() + freq),
               'active': True }
 
-    if timer['when'] < timer_min or timer_min == -1:
-        timer_min = timer['when']
-
-    var.timers.append(timer)
+    _push(timer)
     event.dispatch('OnAddTimer', timer)
 
+    return timer
+
+def cancel(timer):
+    '''Cancel the timer behind the handle returned by add().'''
+
+    global cancelled
+
+    if not timer['active']:
+        return False
+
+    timer['active'] = False
+
+    # Only count it if it is still waiting in the heap.
+    if timer.get('entry'):
+        cancelled += 1
+
+        if cancelled > len(var.timers) / 2:
+            _compact()
+
+    event.dispatch('OnTimerCancel', timer)
+    return True
+
 def delete(func, args=None):
     '''Delete all timers with matching `func` and `args`.'''
 
-    var.timers = [timer for timer in var.timers if timer['func'] != func and timer['args'] != args]
+    for entry in var.timers:
+        timer = entry[2]
+
+        if timer['active'] and timer['func'] == func and timer['args'] == args:
+            timer['active'] = False
+
+    _compact()
     event.dispatch('OnTimerDelete', func, args)
 
 def next_run():
-    '''Return the time the next timer has to be executed.'''
+    '''Return the time the next timer has to be executed, or -1 if there are none.'''
 
-    global timer_min
+    global cancelled
 
-    for timer in var.timers:
-        if timer['when'] < timer_min or timer_min == -1:
-            timer_min = timer['when']
+    # Throw away cancelled timers sitting on top.
+    while var.timers and not var.timers[0][2]['active']:
+        heapq.heappop(var.timers)[2]['entry'] = None
+        cancelled -= 1
 
-    return timer_min
+    if not var.timers:
+        return -1
+
+    return var.timers[0][0]
 
 def run():
     '''Execute all timers that need to be executed.'''
 
-    global timer_min
+    global cancelled
 
-    for timer in var.timers:
-        if timer['when'] <= time.time():
-            timer['func'](timer['args'])
-            timer_min = -1
+    now = time.time()
 
-            event.dispatch('OnTimerCallFunction', timer['func'], timer['args'])
+    while var.timers and var.timers[0][0] <= now:
+        timer = heapq.heappop(var.timers)[2]
+        timer['entry'] = None
 
-        # If it's scheduled more than once updated its `when`.
-        if timer['freq']:
-            timer['when'] = (time.time() + timer['freq'])
+        if not timer['active']:
+            cancelled -= 1
+            continue
 
-            if timer['when'] < timer_min or timer_min == -1:
-                timer_min = timer['when']
+        metrics.timer_lag.observe(now - timer['when'])
 
-        # Otherwise mark it as inactive.
+        # If it's scheduled more than once, put it back with its new `when`.
+        # This is done before the call so that the function may cancel it.
+        if timer['freq']:
+            timer['when'] = now + timer['freq']
+            _push(timer)
         else:
             timer['active'] = False
 
-    # Delete any timers that aren't useful anymore.
-    var.timers = [timer for timer in var.timers if timer['active']]
+        timer['func'](timer['args'])
+
+        if 'OnTimerCallFunction' in event.active:
+            event.dispatch('OnTimerCallFunction', timer['func'], timer['args'])
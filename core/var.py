@@ -10,8 +10,8 @@ config_file = 'conf/synarere.conf'
 # Fork into the background? We do so by default.
 fork = True
 
-# Configuration parser and logger instance.
-conf, log = None, None
+# Configuration parser, compiled `options` block and logger instance.
+conf, options, log = None, None, None
 
 # Servers, connections, modules loaded, dead connections, and timers list.
 servers, conns, modules_loaded, dead_conns, timers = [], [], [], [], []
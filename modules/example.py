@@ -7,12 +7,12 @@
 # Import required source module.
 from core import command, shutdown
 
-def on_topic(conn, origin, parv):
+def on_topic(conn, msg):
     '''Handle the TOPIC command.'''
     
-    who = origin.split('!')[0] # the nick of the person who set the topic
-    where = parv[0]            # which channel the topic was set in
-    what = ' '.join(parv[1:])  # the new topic of the channel
+    who = msg.nick        # the nick of the person who set the topic
+    where = msg.params[0] # which channel the topic was set in
+    what = msg.params[-1] # the new topic of the channel
     
     # the bot will have to be in #spying for this to work..
     conn.privmsg('#spying', '%s set the topic of %s to %r!' % (who, where, what))
@@ -33,14 +33,82 @@ def module_init():
     # There are several types of commands you may create.
     # The following are available:
     #
-    # irc -- Raw IRC commands. AWAY, KICK, etc.
+    # irc -- Raw IRC commands. AWAY, KICK, etc. These get the parsed message (see core/message.py).
     # chan -- Channel commands, for example: '.register'.
     # chanme -- Same as chan, except the bot's nick is prepended. Example: <user> synarere: register
     # priv -- Private message commands.
     # ctcp -- CTCP commands.
     #
     # NOTE: For irc, these are top priority, so you should use command.add_first() instead of command.add()!
-    
+    #
+    # Handlers which have to wait for something don't need a thread. Write them
+    # as generators instead, and they will run as tasks on the main loop:
+    #
+    #     def chan_countdown(conn, (nick, user, host), target, message):
+    #         for i in (3, 2, 1):
+    #             conn.privmsg(target, '%d...' % i)
+    #             yield 1 # sleep for one second without blocking anything
+    #
+    # A bare `yield` just lets everything else run before continuing.
+    #
+    # Handlers which do a lot of computation can run in a worker process instead,
+    # so they don't hold up the bot:
+    #
+    #     command.add('.factor', chan_factor, command.chan, process=True)
+    #
+    # These get a copy of the network's server dict instead of the connection,
+    # and return the line (or list of lines) to send:
+    #
+    #     def chan_factor(server, (nick, user, host), target, message):
+    #         return 'PRIVMSG %s :%s' % (target, factor(int(message)))
+    #
+    # A channel command registered as '.quit' answers to the `trigger` of each
+    # network, so it is '!quit' on a network with 'trigger = !'. Commands are
+    # matched the way the server compares nicks (its CASEMAPPING).
+    #
+    # Commands may have other names too:
+    #
+    #     command.alias('.q', '.quit', command.chan)
+    #
+    # If you tell synarere what arguments a command takes, the message is split
+    # up for you and the handler gets a list instead. Optional arguments are in
+    # brackets, and '...' takes the rest of the message. Anyone who gets it wrong
+    # is told how it's used, and the handler isn't called:
+    #
+    #     command.add('.kick', chan_kick, command.chan, args='nick [reason...]')
+    #
+    #     def chan_kick(conn, (nick, user, host), target, (victim, reason)):
+    #         conn.push('KICK %s %s :%s' % (target, victim, reason or 'Bye'))
+    #
+    # With `shards` set, every worker process loads your module but only has
+    # some of the networks in var.servers. To send to any network, use:
+    #
+    #     shard.push('freenode', 'PRIVMSG #synarere :Hello from elsewhere')
+    #
+    # There's no need to send NAMES or WHO to find out who is on a channel.
+    # Every connection keeps track of the channels it is on (see core/state.py):
+    #
+    #     if conn.state.is_on(target, victim) and '@' in (conn.state.status(target, nick) or ''):
+    #         ...
+    #
+    #     chan = conn.state.channel(target)
+    #
+    #     if chan:
+    #         for user in list(chan.users):
+    #             print user.nick, user.user, user.host
+    #
+    # Your irc handlers are called after it has seen the message, so someone
+    # who QUIT is already gone from it. The state is only changed on the main
+    # loop, while threaded handlers keep running, so copy channel().users (as
+    # above) before going through it in one of those.
+    #
+    # Ignored users never get to your handlers, and commands listed in an
+    # access block are only run for the people it lists. To check someone
+    # against an access block yourself, give it a name and ask:
+    #
+    #     if masks.is_in('admins', (nick, user, host)):
+    #         ...
+
     command.add_first('TOPIC', on_topic, command.irc)
     command.add('.quit', chan_example, command.chan)
     command.add('quit', chanme_example, command.chanme)
@@ -53,3 +121,15 @@ def module_fini():
     command.delete_first('TOPIC', on_topic, command.irc)
     command.delete('.quit', chan_quit, command.chan)
     command.delete('quit', chanme_quit, command.chanme)
+
+# A module is reloaded in place when its file changes and synarere is
+# rehashed: module_fini() of the old code runs, then module_init() of the
+# new code. Anything worth keeping across that can be passed along:
+#
+#     def module_state():
+#         return counts
+#
+#     def module_restore(state):
+#         counts.update(state)
+#
+# module_restore() is called before module_init(), and only on reloads.
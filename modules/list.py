@@ -7,15 +7,15 @@
 from core import command, shutdown
 import pprint
 
-def list_end(conn, origin, parv):
+def list_end(conn, msg):
     global channels
     pprint.pprint(channels)
     del channels
     
-def list_chan(conn, origin, parv):
+def list_chan(conn, msg):
     global channels
-    groups = re.match(r'^(.+) (\d+) :(.*)', parv[1]).groups()
-    channels.append(groups)
+    # me, channel, users, topic
+    channels.append(tuple(msg.params[1:4]))
 
 def cmd_list(conn, (nick, user, host), target, message):
     global channels
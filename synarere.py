@@ -10,7 +10,7 @@
 import getopt, os, signal, sys
 
 # Import required core modules.
-from core import module, irc, logger, io, var, confparse, command
+from core import module, irc, logger, io, var, confparse, command, metrics, profiler, sendq, shard, masks
 
 # Import required core function.
 from core import shutdown
@@ -27,6 +27,12 @@ def ctcp_ping(conn, (nick, user, host), message):
     conn.sendq.appendleft('NOTICE %s :\001PING %s\001' % (nick, message))
     return
 
+def priv_stats(conn, (nick, user, host), message):
+    '''Handle the STATS private command.'''
+
+    for line in metrics.summary():
+        conn.notice(nick, line, sendq.BULK)
+
 def print_clo_help():
     '''Output command line options and their meanings.'''
 
@@ -67,10 +73,14 @@ def main(argv=sys.argv[1:]):
             print 'synarere: version %s' % var.version
             sys.exit(os.EX_OK)
 
-    # Attach signals to handlers.
-    signal.signal(signal.SIGHUP, lambda h: var.conf.rehash(True))
-    signal.signal(signal.SIGINT, lambda i: shutdown(signal.SIGINT, 'Caught SIGINT (terminal interrupt)'))
-    signal.signal(signal.SIGTERM, lambda t: shutdown(signal.SIGTERM, 'Caught SIGTERM'))
+    # Attach signals to handlers. The work is done on the main loop, since
+    # the handler may have interrupted something holding a lock it needs
+    # (logging does).
+    signal.signal(signal.SIGHUP, lambda signum, frame: io.call_soon(var.conf.rehash, True))
+    signal.signal(signal.SIGINT, lambda signum, frame: io.call_soon(shutdown, signal.SIGINT, 'Caught SIGINT (terminal interrupt)'))
+    signal.signal(signal.SIGTERM, lambda signum, frame: io.call_soon(shutdown, signal.SIGTERM, 'Caught SIGTERM'))
+    signal.signal(signal.SIGUSR1, lambda signum, frame: io.call_soon(profiler.start))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: io.call_soon(profiler.stop))
     signal.signal(signal.SIGPIPE, signal.SIG_IGN)
     signal.signal(signal.SIGALRM, signal.SIG_IGN)
     signal.signal(signal.SIGCHLD, signal.SIG_IGN)
@@ -90,7 +100,7 @@ def main(argv=sys.argv[1:]):
 
     # Check to see if we are already running.
     try:
-        pid_file = open(var.conf.get('options', 'pidfile')[0], 'r')
+        pid_file = open(var.options.pidfile, 'r')
 
         try:
             pid = pid_file.read()
@@ -143,7 +153,7 @@ def main(argv=sys.argv[1:]):
 
         # Try to write the PID file.
         try:
-            pid_file = open(var.conf.get('options', 'pidfile')[0], 'w')
+            pid_file = open(var.options.pidfile, 'w')
             pid_file.write(str(os.getpid()))
             pid_file.close()
         except IOError, e:
@@ -173,16 +183,29 @@ def main(argv=sys.argv[1:]):
     # Initialize the logger.
     logger.init()
 
+    # Compile the ignore and access blocks.
+    masks.load()
+
     # These have to be in the main file.
     command.add('VERSION', ctcp_version, command.ctcp)
     command.add('PING', ctcp_ping, command.ctcp)
 
+    if var.options.stats_command:
+        command.add('STATS', priv_stats, command.priv)
+
+    # With `shards` set, this is where we split into a supervisor and
+    # workers, and the workers do the rest themselves.
+    shard.start()
+
     # Load all modules listed in the configuration.
     module.load_all()
 
     # Connect to all IRC networks.
     irc.connect_to_all()
 
+    # Serve our metrics, if we're supposed to.
+    metrics.listen()
+
     # Start the loop.
     io.io()
 